@@ -3,15 +3,13 @@
 # This is responsible for abstracting all development needs
 # and assembling outputs for windows/linux/android targets.
 
-# Required 3rdparty packages:
-# python3 -m pip install --user requests py7zr
+# Required 3rdparty packages (imported where used, see import_or_install in btool.utils):
+# python3 -m pip install --user requests py7zr Pillow
 
 
 import os
 import sys
 import subprocess
-import inspect
-import urllib.request
 import tarfile
 import shutil
 import time
@@ -24,24 +22,44 @@ import platform
 # Internal libs
 from btool.utils import *
 from btool.tools import *
+from btool.taskgraph import *
 from btool.buildall import buildall
+from btool.daemon import *
+from btool.watch import watch_builds
+from btool.explain import explain_tasks
+from btool.critpath import critical_path_report
+from btool.pgo import pgo_build, apply_pgo_state
+from btool.variants import variants_report
+from btool.startupbench import startup_benchmark
 
 # See individual setup functions in btool.tools
 def download_tools():
+  # The daemon ran this once at startup and every request inherits its environment
+  if in_daemon():
+    return
+
   if not e('build'):
     os.makedirs(j('build'))
 
   os.environ['LOCI_REPO_DIR'] = os.path.abspath('.')
 
-  download_dotnetcore()
-  download_rust()
-  download_java8()
-  download_gradle()
-  download_android_sdk()
-  # download_gdal() # TODO implement this so we can use tools like ogr2ogr in build stages
+  # Once every toolchain is downloaded the download_* functions only set up the
+  # environment, which build/toolchain-env.json (see btool.toolenv) replays
+  if not load_toolchain_env():
+    env_before = dict(os.environ)
+    download_dotnetcore()
+    download_rust()
+    download_java8()
+    download_gradle()
+    download_android_sdk()
+    # download_gdal() # TODO implement this so we can use tools like ogr2ogr in build stages
+    save_toolchain_env(env_before)
 
   set_env_from_dev_env_conf('dev-env.conf')
 
+  # After dev-env.conf, which may set COMPILER_CACHE_MAX_MB
+  download_sccache()
+
   # Finally print warnings for host tools we expect and have not yet
   # fully bootstraped above
   expected_bins = [
@@ -58,8 +76,59 @@ def main(args=sys.argv):
   
   if not e('readme.md'):
     die('Must be run from loci root like "python -m btool [args]')
-  
-  download_tools()
+
+  # python -m btool --version
+  if '--version' in args:
+    git_hash = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False).stdout
+    print('btool {} (python {})'.format(git_hash.decode('utf-8').strip() or 'unknown', platform.python_version()))
+    return
+
+  # python -m btool startup_benchmark
+  if 'startup_benchmark' in args:
+    startup_benchmark()
+    return
+
+  # python -m btool pin_downloads url=<url> sha256=<upstream checksum>
+  if 'pin_downloads' in args:
+    pin_downloads(arg_value(args, 'url'), arg_value(args, 'sha256'))
+    return
+
+  # python -m btool daemon [stop]
+  if 'daemon' in args:
+    if 'stop' in args:
+      stop_daemon()
+    else:
+      serve_forever(main, download_tools, watch_stat_index)
+    return
+
+  # python -m btool worker port=7300 [bind=0.0.0.0], or "worker stdio" when started over ssh
+  if 'worker' in args:
+    workspace = os.path.abspath(arg_value(args, 'workspace', REMOTE_WORKSPACE))
+    if 'stdio' in args:
+      serve_stdio_worker(workspace)
+    else:
+      serve_tcp_worker(int(arg_value(args, 'port', REMOTE_WORKER_PORT)), workspace, arg_value(args, 'bind', REMOTE_WORKER_BIND))
+    return
+
+  # Hand plain builds to a running daemon, "nodaemon" (and see IN_PROCESS_MODES) builds in this process
+  if daemon_handles(args):
+    code = run_in_daemon(args)
+    if code is not None:
+      if code != 0:
+        raise Exception('btool daemon build exited with code {}'.format(code))
+      return
+
+  # python -m btool trace=out/build-trace.json
+  if arg_value(args, 'trace'):
+    start_trace(arg_value(args, 'trace'))
+  else:
+    stop_trace()
+
+  # Per-command CPU/RSS/IO records, rolled up into out/build-report.json
+  reset_usage_log()
+
+  with trace_span('download_tools', 'setup'):
+    download_tools()
 
   if 'shell' in args:
     if host_is_linux():
@@ -85,6 +154,15 @@ def main(args=sys.argv):
     build_linux_aarch64 = False
     build_win64 = False
     build_android = True
+
+  # python -m btool targets=linux_x86_64,win64 (used by remote workers)
+  if arg_value(args, 'targets') is not None:
+    targets = arg_value(args, 'targets').split(',')
+    build_linux_x86_64 = 'linux_x86_64' in targets
+    build_linux_aarch64 = 'linux_aarch64' in targets
+    build_win64 = 'win64' in targets
+    build_android = 'android' in targets
+    set_flag('hostonly') # no www/ distributables for a partial build
   
   if debug_build:
     set_flag('debug_build')
@@ -97,6 +175,30 @@ def main(args=sys.argv):
   if build_android:
     set_flag('build_android')
 
+  if 'parallel_targets' in args:
+    set_flag('parallel_targets')
+  else:
+    if flag_name('parallel_targets') in os.environ:
+      os.environ.pop(flag_name('parallel_targets'))
+
+  if 'shared_cargo_target' in args:
+    set_flag('shared_cargo_target')
+  else:
+    if flag_name('shared_cargo_target') in os.environ:
+      os.environ.pop(flag_name('shared_cargo_target'))
+
+  if 'link_assembly' in args:
+    set_flag('link_assembly')
+  else:
+    if flag_name('link_assembly') in os.environ:
+      os.environ.pop(flag_name('link_assembly'))
+
+  if 'split_debuginfo' in args:
+    set_flag('split_debuginfo')
+  else:
+    if flag_name('split_debuginfo') in os.environ:
+      os.environ.pop(flag_name('split_debuginfo'))
+
   if 'force_code_rebuilds' in args:
     set_flag('force_code_rebuilds')
   else:
@@ -110,9 +212,54 @@ def main(args=sys.argv):
 
   # Begin building all sub-programs and assembling outputs into ./out/<platform>/
 
+  # python -m btool artifact_cache=http://build-cache.local:8080/loci (or a directory)
+  if arg_value(args, 'artifact_cache'):
+    os.environ[ARTIFACT_CACHE_ENV_VAR] = arg_value(args, 'artifact_cache')
+
+  # Shared GNU make jobserver, cargo/cc/make children and gradle/dotnet workers draw from one core budget
+  start_jobserver(int(arg_value(args, 'cores', os.cpu_count() or 1)))
+
+  # python -m btool critical_path
+  if 'critical_path' in args:
+    critical_path_report(args)
+    return
+
+  # python -m btool pgo
+  if 'pgo' in args:
+    pgo_build(args)
+    return
+
+  # python -m btool variants[=baseline,lto-fat]
+  if 'variants' in args or arg_value(args, 'variants'):
+    variants_report(args)
+    return
+
+  # python -m btool keep_pgo, builds with the profile from the last "python -m btool pgo"
+  args = apply_pgo_state(args)
+
+  # python -m btool hostonly explain
+  if 'explain' in args:
+    explain_tasks(args)
+    return
+
+  # python -m btool hostonly watch [restart]
+  if 'watch' in args:
+    watch_builds(args)
+    return
+
+  reset_compiler_cache_stats()
   build_start = time.time()
   
-  buildall(args)
+  try:
+    with trace_span('buildall', 'build'):
+      # python -m btool only_tasks=app-lib,desktop-cli
+      buildall(args, only_tasks=set(arg_value(args, 'only_tasks').split(',')) if arg_value(args, 'only_tasks') else None)
+  finally:
+    trace_file = write_trace()
+    if trace_file:
+      print('Wrote build trace to {}'.format(trace_file))
+    report = write_build_report(j('out', 'build-report.json'), round(time.time() - build_start, 2))
+    print('Wrote resource report to {} (peak RSS {:,}mb)'.format(j('out', 'build-report.json'), int(report['peak_rss_kb'] / 1000)))
 
   build_end = time.time()
   duration_s = round(build_end - build_start, 2)
@@ -121,6 +268,9 @@ def main(args=sys.argv):
   print('Size of out/win64: {:,}mb'.format( int(directory_size(j('out', 'win64')) / (1000*1000) )) )
   print('Size of out/linux_x86_64: {:,}mb'.format( int(directory_size(j('out', 'linux_x86_64')) / (1000*1000) )) )
   print('Size of out/linux_aarch64: {:,}mb'.format( int(directory_size(j('out', 'linux_aarch64')) / (1000*1000) )) )
+  cache_stats = compiler_cache_stats()
+  if cache_stats is not None:
+    print(format_compiler_cache_stats(cache_stats))
 
   kernel_desktop_exe = None
   if build_linux_x86_64 or build_win64:
@@ -0,0 +1,199 @@
+# Shared cache of build task outputs, keyed by input fingerprints.
+#
+#   LOCI_ARTIFACT_CACHE=/mnt/shared/loci-artifacts        local (or network mounted) directory
+#   LOCI_ARTIFACT_CACHE=http://build-cache.local:8080/loci  plain HTTP GET/PUT store
+#
+# After a task builds, its outputs(...) are packed once per target into
+# <key>.tar.gz and published; the key hashes the task's input file contents,
+# tool versions, fingerprinted flags and the target (CC by compiler name and
+# version, not its path). Another machine at the same commit unpacks those
+# archives instead of compiling. Tasks declaring uses(artifacts=False), like
+# app-lib whose .rlib is useless without the rest of its target dir, are skipped.
+# Set LOCI_ARTIFACT_CACHE_READONLY=1 to fetch without publishing.
+#
+# Every archive is published with a <key>.tar.gz.sha256 sidecar, written after
+# the archive itself. Fetches without a sidecar count as misses, and an archive
+# whose sha256 does not match its sidecar (a truncated upload, a proxy serving
+# an error page) is rejected before anything is unpacked.
+
+import os
+import json
+import shutil
+import tarfile
+import hashlib
+import tempfile
+
+from btool.resources import TARGET_NAMES
+
+ARTIFACT_CACHE_ENV_VAR = 'LOCI_ARTIFACT_CACHE'
+HTTP_TIMEOUT_S = 60
+CHUNK_BYTES = 1024 * 1024
+
+def artifact_cache_location():
+  return os.environ.get(ARTIFACT_CACHE_ENV_VAR, '').strip()
+
+def artifact_cache_enabled():
+  return len(artifact_cache_location()) > 0
+
+def artifact_cache_readonly():
+  return os.environ.get('LOCI_ARTIFACT_CACHE_READONLY', '0') == '1'
+
+def artifact_cache_is_http():
+  return artifact_cache_location().startswith('http://') or artifact_cache_location().startswith('https://')
+
+# Target an output path belongs to (eg out/win64/loci.exe -> win64), or 'all'
+def output_target(path):
+  parts = os.path.normpath(path).split(os.sep)
+  for target in ['win64', 'linux_x86_64', 'linux_aarch64', 'android']:
+    if target in parts:
+      return target
+  for part in parts:
+    if part in TARGET_NAMES:
+      return TARGET_NAMES[part]
+  return 'all'
+
+def outputs_for_target(output_files, target):
+  return [o for o in output_files if output_target(o) in (target, 'all')]
+
+# settings holds tool versions, flags and env which change outputs;
+# input_hashes maps each input file (relative to the repo) to its sha256.
+def artifact_key(task_name, input_hashes, settings, target):
+  h = hashlib.sha256()
+  h.update(json.dumps({
+    'task': task_name,
+    'inputs': sorted(input_hashes.items()),
+    'settings': settings,
+    'target': target,
+  }, sort_keys=True).encode('utf-8'))
+  return h.hexdigest()
+
+def local_artifact_path(key):
+  return os.path.join(artifact_cache_location(), key[:2], key+'.tar.gz')
+
+def http_artifact_url(key):
+  return artifact_cache_location().rstrip('/')+'/'+key+'.tar.gz'
+
+def file_sha256(path):
+  h = hashlib.sha256()
+  with open(path, 'rb') as fd:
+    while True:
+      chunk = fd.read(CHUNK_BYTES)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.hexdigest()
+
+# Copies the object at url into dst_file, returning False on a 404
+def http_get_file(url, dst_file):
+  import urllib.error
+  import urllib.request
+  try:
+    with urllib.request.urlopen(url, timeout=HTTP_TIMEOUT_S) as response:
+      with open(dst_file, 'wb') as fd:
+        shutil.copyfileobj(response, fd, CHUNK_BYTES)
+    return True
+  except urllib.error.HTTPError as e:
+    if e.code == 404:
+      return False
+    raise
+
+def http_put_file(url, src_file, content_type):
+  import urllib.request
+  with open(src_file, 'rb') as fd:
+    req = urllib.request.Request(url, data=fd, method='PUT', headers={
+      'Content-Type': content_type,
+      'Content-Length': str(os.path.getsize(src_file)),
+    })
+    with urllib.request.urlopen(req, timeout=HTTP_TIMEOUT_S) as response:
+      response.read()
+
+# Copies the archive for key into dst_file, returning False on a cache miss.
+# Raises when the archive does not match the sha256 published with it.
+def artifact_get(key, dst_file):
+  digest_file = dst_file+'.sha256'
+  if artifact_cache_is_http():
+    if not http_get_file(http_artifact_url(key)+'.sha256', digest_file) or not http_get_file(http_artifact_url(key), dst_file):
+      return False
+  else:
+    if not os.path.exists(local_artifact_path(key)+'.sha256') or not os.path.exists(local_artifact_path(key)):
+      return False
+    shutil.copy(local_artifact_path(key)+'.sha256', digest_file)
+    shutil.copy(local_artifact_path(key), dst_file)
+
+  with open(digest_file, 'r') as fd:
+    expected_sha256 = fd.read().strip()
+  actual_sha256 = file_sha256(dst_file)
+  if actual_sha256 != expected_sha256:
+    os.remove(dst_file)
+    raise Exception('Artifact {} has sha256 {} but was published as {}'.format(key, actual_sha256, expected_sha256))
+  return True
+
+def artifact_put(key, src_file):
+  digest_file = src_file+'.sha256'
+  with open(digest_file, 'w') as fd:
+    fd.write(file_sha256(src_file)+'\n')
+
+  # The sidecar goes last: readers treat an archive without one as a miss
+  if artifact_cache_is_http():
+    http_put_file(http_artifact_url(key), src_file, 'application/gzip')
+    http_put_file(http_artifact_url(key)+'.sha256', digest_file, 'text/plain')
+    return
+  dst_file = local_artifact_path(key)
+  os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+  # Other machines may read the directory at any time, so never expose a partial archive
+  for src, dst in [(src_file, dst_file), (digest_file, dst_file+'.sha256')]:
+    shutil.copy(src, dst+'.'+str(os.getpid())+'.tmp')
+    os.replace(dst+'.'+str(os.getpid())+'.tmp', dst)
+
+def pack_outputs(output_files, archive_file):
+  with tarfile.open(archive_file, 'w:gz', compresslevel=6) as tar:
+    for o in output_files:
+      if os.path.exists(o):
+        tar.add(o, arcname=os.path.relpath(o))
+
+# Unpacks into the current directory, refusing members outside of output_files.
+# Files are unpacked beside their destination and renamed over it, so outputs
+# hardlinked into other out/<target>/ trees (link_assembly) are never written through.
+def unpack_outputs(archive_file, output_files):
+  allowed = [os.path.normpath(os.path.relpath(o)) for o in output_files]
+  with tarfile.open(archive_file, 'r|gz') as tar:
+    for member in tar:
+      name = os.path.normpath(member.name)
+      if not any(name == a or name.startswith(a+os.sep) for a in allowed):
+        raise Exception('Artifact member {} is not one of the task outputs'.format(member.name))
+      if member.issym() or member.islnk():
+        link_target = os.path.normpath(os.path.join(os.path.dirname(name), member.linkname))
+        if os.path.isabs(member.linkname) or link_target.startswith('..'):
+          raise Exception('Artifact member {} links outside the repo'.format(member.name))
+      if member.isdir():
+        tar.extract(member, path='.')
+        continue
+      if os.path.isdir(name) and not os.path.islink(name):
+        shutil.rmtree(name)
+      member.name = name+'.unpacking'
+      if os.path.lexists(member.name):
+        os.remove(member.name)
+      tar.extract(member, path='.')
+      os.replace(member.name, name)
+
+# Returns True when every key was found and unpacked.
+# keys maps target -> (key, output files of that target)
+def fetch_artifacts(keys):
+  with tempfile.TemporaryDirectory(prefix='btool-artifacts-') as tmp_dir:
+    archives = []
+    for target, (key, output_files) in keys.items():
+      archive_file = os.path.join(tmp_dir, key+'.tar.gz')
+      if not artifact_get(key, archive_file):
+        return False
+      archives.append((archive_file, output_files))
+    # Only unpack once every target hit, so a partial hit never mixes old and new outputs
+    for archive_file, output_files in archives:
+      unpack_outputs(archive_file, output_files)
+  return True
+
+def publish_artifacts(keys):
+  with tempfile.TemporaryDirectory(prefix='btool-artifacts-') as tmp_dir:
+    for target, (key, output_files) in keys.items():
+      archive_file = os.path.join(tmp_dir, key+'.tar.gz')
+      pack_outputs(output_files, archive_file)
+      artifact_put(key, archive_file)
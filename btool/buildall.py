@@ -5,20 +5,70 @@
 
 from btool import *
 
-def buildall(args):
+# Tools and flags the outputs of each kind of task depend on, downloads use nothing
+RUST_TASK_USES = uses(tools=['rustc', 'cargo'], flags=FINGERPRINT_FLAGS, env=FINGERPRINT_ENV_VARS)
+DOTNET_TASK_USES = uses(tools=['dotnet'], flags=['parallel_targets', 'split_debuginfo'])
+GRADLE_TASK_USES = uses(tools=['java'])
+# app-lib's declared output is only its .rlib, crates depending on it need the rest
+# of its target dir (or rebuild it in theirs), so a cache hit would save nothing
+RUST_LIB_TASK_USES = uses(tools=['rustc', 'cargo'], flags=FINGERPRINT_FLAGS, env=FINGERPRINT_ENV_VARS, artifacts=False)
+
+# only_tasks limits the build to those task keys (see "python -m btool watch")
+def buildall(args, only_tasks=None):
   build_win64 = flag_set('build_win64')
   build_linux_x86_64 = flag_set('build_linux_x86_64')
   build_linux_aarch64 = flag_set('build_linux_aarch64')
   build_android = flag_set('build_android')
 
-  # Used to quicky refer to the repo root
-  r = os.path.abspath('.')
-
   download_OSM_BPF_FILE()
 
   create_selfsigned_ssl_certs()
 
-  silenced_task(
+  # Resolve compiler versions once so forked tasks share them in their fingerprints
+  tool_versions()
+  fingerprint_env_value('CC')
+
+  g = build_task_graph(args)
+  try:
+    # python -m btool jobs=N, one task at a time (jobs=1) unless asked
+    g.run(max_workers=int(arg_value(args, 'jobs', 1)), only_keys=only_tasks, executor=remote_executor(args))
+  finally:
+    flush_stat_index()
+
+  # geoserver, the jre etc. are byte-identical across desktop targets
+  if flag_set('link_assembly'):
+    desktop_out_dirs = [j('out', t) for t in ['win64', 'linux_x86_64', 'linux_aarch64'] if e('out', t)]
+    saved_bytes = dedupe_trees(desktop_out_dirs)
+    if saved_bytes > 0:
+      invalidate_stat_index(*desktop_out_dirs)
+    print('Deduplicated {:,}mb across {}'.format(int(saved_bytes / (1000*1000)), ', '.join(desktop_out_dirs)))
+
+  # Finally assemble a web www/ directory containing win64/linux64/android distributables
+  if not flag_set('hostonly') and only_tasks is None:
+    build_www(build_win64, build_linux_x86_64, build_linux_aarch64, build_android, not 'nobrowser' in args)
+
+# python -m btool remote_workers=buildhost1:7300,ssh:me@buildhost2:/home/me/loci [remote_tasks=app-lib,desktop-cli]
+def remote_executor(args):
+  if not arg_value(args, 'remote_workers'):
+    return None
+  remote_args = ['targets='+','.join(enabled_targets())] + [a for a in args if a in REMOTE_PASSTHROUGH_ARGS]
+  remote_env = {v: os.environ[v] for v in FINGERPRINT_ENV_VARS if v in os.environ}
+  task_keys = arg_value(args, 'remote_tasks').split(',') if arg_value(args, 'remote_tasks') else None
+  return RemoteExecutor(arg_value(args, 'remote_workers').split(','), remote_args, remote_env, task_keys)
+
+def build_task_graph(args):
+  build_win64 = flag_set('build_win64')
+  build_linux_x86_64 = flag_set('build_linux_x86_64')
+  build_linux_aarch64 = flag_set('build_linux_aarch64')
+  build_android = flag_set('build_android')
+
+  # Used to quicky refer to the repo root
+  r = os.path.abspath('.')
+
+  # Tasks run concurrently once all of their deps() have completed
+  g = TaskGraph()
+
+  g.add('pypy', deps(), silenced_task,
     'Downloading python runtime (pypy)', # See https://www.pypy.org/download.html
     inputs(),
     outputs(
@@ -42,7 +92,7 @@ def buildall(args):
   )
 
 
-  silenced_task(
+  g.add('java', deps(), silenced_task,
     'Downloading java (adoptopenjdk)', # See https://adoptopenjdk.net/releases.html?variant=openjdk16&jvmVariant=hotspot
     inputs(),
     outputs(
@@ -65,7 +115,7 @@ def buildall(args):
   )
 
 
-  silenced_task(
+  g.add('geoserver', deps(), silenced_task,
     'Downloading geoserver', # See http://geoserver.org/release/stable/
     inputs(),
     outputs(
@@ -88,30 +138,33 @@ def buildall(args):
   )
 
 
-  silenced_task(
+  g.add('app-lib', deps(), silenced_task,
     'Building app-lib',
     force_code_rebuilds_conditional_touch(inputs(
       j('app-lib', 'src'),
       j('app-lib', 'Cargo.toml')
     )),
     outputs(
-      j('app-lib', 'target', 'x86_64-pc-windows-gnu', 'release'),
-      j('app-lib', 'target', 'x86_64-unknown-linux-gnu', 'release'),
-      j('app-lib', 'target', 'aarch64-unknown-linux-gnu', 'release'),
+      j(cargo_release_dir(j('app-lib'), 'x86_64-pc-windows-gnu'), 'libapp_lib.rlib'),
+      j(cargo_release_dir(j('app-lib'), 'x86_64-unknown-linux-gnu'), 'libapp_lib.rlib'),
+      j(cargo_release_dir(j('app-lib'), 'aarch64-unknown-linux-gnu'), 'libapp_lib.rlib'),
     ),
     lambda: within(
       j('app-lib'),
-      lambda: c('rustup', 'run', 'stable', 'cargo', 'build', '--release', '--target', 'x86_64-pc-windows-gnu') if build_win64 else None,
-      lambda: c('rustup', 'run', 'stable', 'cargo', 'build', '--release', '--target', 'x86_64-unknown-linux-gnu') if build_linux_x86_64 else None,
+      lambda: c_targets(
+        cargo_build_cmd('x86_64-pc-windows-gnu') if build_win64 else None,
+        cargo_build_cmd('x86_64-unknown-linux-gnu') if build_linux_x86_64 else None,
+        cargo_build_cmd('aarch64-unknown-linux-gnu') if build_linux_aarch64 else None,
+      ),
       lambda: run_within_cargo_android_arm64_ndk_env(
-        lambda: c('rustup', 'run', 'nightly', 'cargo', 'build', '--release', '--target', 'aarch64-linux-android', '-Zbuild-std')
+        lambda: c(*cargo_build_cmd('aarch64-linux-android', toolchain='nightly'), '-Zbuild-std')
       ) if build_android else None,
-      lambda: c('rustup', 'run', 'stable', 'cargo', 'build', '--release', '--target', 'aarch64-unknown-linux-gnu') if build_linux_aarch64 else None,
     ),
+    task_uses=RUST_LIB_TASK_USES,
   )
 
 
-  silenced_task(
+  g.add('app-kernel-desktop', deps('app-lib'), silenced_task,
     'Building app-kernel-desktop (loci.exe)',
     force_code_rebuilds_conditional_touch(inputs(
       j('app-kernel-desktop', 'src'),
@@ -129,26 +182,29 @@ def buildall(args):
     ),
     lambda: within(
       j('app-kernel-desktop'),
-      lambda: c('rustup', 'run', 'stable', 'cargo', 'build', '--release', '--target', 'x86_64-pc-windows-gnu') if build_win64 else None,
-      lambda: c('rustup', 'run', 'stable', 'cargo', 'build', '--release', '--target', 'x86_64-unknown-linux-gnu') if build_linux_x86_64 else None,
-      lambda: c('rustup', 'run', 'stable', 'cargo', 'build', '--release', '--target', 'aarch64-unknown-linux-gnu') if build_linux_aarch64 else None,
+      lambda: c_targets(
+        cargo_build_cmd('x86_64-pc-windows-gnu') if build_win64 else None,
+        cargo_build_cmd('x86_64-unknown-linux-gnu') if build_linux_x86_64 else None,
+        cargo_build_cmd('aarch64-unknown-linux-gnu') if build_linux_aarch64 else None,
+      ),
     ),
     lambda: assemble_in_win64(
-      j('app-kernel-desktop', 'target', 'x86_64-pc-windows-gnu', 'release', 'app-kernel-desktop.exe'),
+      j(cargo_release_dir(j('app-kernel-desktop'), 'x86_64-pc-windows-gnu'), 'app-kernel-desktop.exe'),
       'loci.exe'
     ),
     lambda: assemble_in_linux_x86_64(
-      j('app-kernel-desktop', 'target', 'x86_64-unknown-linux-gnu', 'release', 'app-kernel-desktop'),
+      j(cargo_release_dir(j('app-kernel-desktop'), 'x86_64-unknown-linux-gnu'), 'app-kernel-desktop'),
       'loci'
     ),
     lambda: assemble_in_linux_aarch64(
-      j('app-kernel-desktop', 'target', 'aarch64-unknown-linux-gnu', 'release', 'app-kernel-desktop'),
+      j(cargo_release_dir(j('app-kernel-desktop'), 'aarch64-unknown-linux-gnu'), 'app-kernel-desktop'),
       'loci'
     ),
+    task_uses=RUST_TASK_USES,
   )
 
 
-  silenced_task(
+  g.add('server-webgui', deps('app-lib'), silenced_task,
     'Building server-webgui',
     force_code_rebuilds_conditional_touch(inputs(
       j('app-subprograms', 'server-webgui', 'src'),
@@ -191,34 +247,37 @@ def buildall(args):
       lambda: scale_image_once(j('..', '..', 'misc-res', 'icon.png'), j('www', 'gen', 'icon-192.png'), (192, 192)),
       lambda: scale_image_once(j('..', '..', 'misc-res', 'icon.png'), j('www', 'gen', 'icon-512.png'), (512, 512)),
       # Build standalone webserver
-      lambda: c('rustup', 'run', 'stable', 'cargo', 'build', '--release', '--target', 'x86_64-pc-windows-gnu') if build_win64 else None,
-      lambda: c('rustup', 'run', 'stable', 'cargo', 'build', '--release', '--target', 'x86_64-unknown-linux-gnu') if build_linux_x86_64 else None,
-      lambda: c('rustup', 'run', 'stable', 'cargo', 'build', '--release', '--target', 'aarch64-unknown-linux-gnu') if build_linux_aarch64 else None,
+      lambda: c_targets(
+        cargo_build_cmd('x86_64-pc-windows-gnu') if build_win64 else None,
+        cargo_build_cmd('x86_64-unknown-linux-gnu') if build_linux_x86_64 else None,
+        cargo_build_cmd('aarch64-unknown-linux-gnu') if build_linux_aarch64 else None,
+      ),
       lambda: run_within_cargo_android_arm64_ndk_env(
-        lambda: c('rustup', 'run', 'nightly', 'cargo', 'build', '--release', '--target', 'aarch64-linux-android', '-Zbuild-std')
+        lambda: c(*cargo_build_cmd('aarch64-linux-android', toolchain='nightly'), '-Zbuild-std')
       ) if build_android else None,
     ),
     lambda: assemble_in_win64(
-      j('app-subprograms', 'server-webgui', 'target', 'x86_64-pc-windows-gnu', 'release', 'server-webgui.exe'),
+      j(cargo_release_dir(j('app-subprograms', 'server-webgui'), 'x86_64-pc-windows-gnu'), 'server-webgui.exe'),
       'server-webgui.exe'
     ),
     lambda: assemble_in_linux_x86_64(
-      j('app-subprograms', 'server-webgui', 'target', 'x86_64-unknown-linux-gnu', 'release', 'server-webgui'),
+      j(cargo_release_dir(j('app-subprograms', 'server-webgui'), 'x86_64-unknown-linux-gnu'), 'server-webgui'),
       'server-webgui'
     ),
     lambda: assemble_in_linux_aarch64(
-      j('app-subprograms', 'server-webgui', 'target', 'aarch64-unknown-linux-gnu', 'release', 'server-webgui'),
+      j(cargo_release_dir(j('app-subprograms', 'server-webgui'), 'aarch64-unknown-linux-gnu'), 'server-webgui'),
       'server-webgui'
     ),
     lambda: assemble_in_android(
-      j('app-subprograms', 'server-webgui', 'target', 'aarch64-linux-android', 'release', 'server-webgui'),
+      j(cargo_release_dir(j('app-subprograms', 'server-webgui'), 'aarch64-linux-android'), 'server-webgui'),
       j('raw', 'server_webgui')
     ),
+    task_uses=RUST_TASK_USES,
   )
 
 
   # TODO hunt down build failure which showed up on all targets after modifying tools.py to add aarch64 tools to PATH
-  silenced_task(
+  g.add('desktop-cli', deps('app-lib'), silenced_task,
     'Building desktop-cli',
     force_code_rebuilds_conditional_touch(inputs(
       j('app-subprograms', 'desktop-cli', 'src'),
@@ -232,26 +291,29 @@ def buildall(args):
     lambda: within(
       j('app-subprograms', 'desktop-cli'),
       # Build standalone cli exe shell
-      lambda: c('rustup', 'run', 'stable', 'cargo', 'build', '--release', '--target', 'x86_64-pc-windows-gnu') if build_win64 else None,
-      lambda: c('rustup', 'run', 'stable', 'cargo', 'build', '--release', '--target', 'x86_64-unknown-linux-gnu') if build_linux_x86_64 else None,
-      lambda: c('rustup', 'run', 'stable', 'cargo', 'build', '--release', '--target', 'aarch64-unknown-linux-gnu') if build_linux_aarch64 else None,
+      lambda: c_targets(
+        cargo_build_cmd('x86_64-pc-windows-gnu') if build_win64 else None,
+        cargo_build_cmd('x86_64-unknown-linux-gnu') if build_linux_x86_64 else None,
+        cargo_build_cmd('aarch64-unknown-linux-gnu') if build_linux_aarch64 else None,
+      ),
     ),
     lambda: assemble_in_win64(
-      j('app-subprograms', 'desktop-cli', 'target', 'x86_64-pc-windows-gnu', 'release', 'desktop-cli.exe'),
+      j(cargo_release_dir(j('app-subprograms', 'desktop-cli'), 'x86_64-pc-windows-gnu'), 'desktop-cli.exe'),
       'desktop-cli.exe'
     ),
     lambda: assemble_in_linux_x86_64(
-      j('app-subprograms', 'desktop-cli', 'target', 'x86_64-unknown-linux-gnu', 'release', 'desktop-cli'),
+      j(cargo_release_dir(j('app-subprograms', 'desktop-cli'), 'x86_64-unknown-linux-gnu'), 'desktop-cli'),
       'desktop-cli'
     ),
     lambda: assemble_in_linux_aarch64(
-      j('app-subprograms', 'desktop-cli', 'target', 'aarch64-unknown-linux-gnu', 'release', 'desktop-cli'),
+      j(cargo_release_dir(j('app-subprograms', 'desktop-cli'), 'aarch64-unknown-linux-gnu'), 'desktop-cli'),
       'desktop-cli'
     ),
+    task_uses=RUST_TASK_USES,
   )
 
 
-  silenced_task(
+  g.add('desktop-mainwindow', deps(), silenced_task,
     'Building desktop-mainwindow',
     force_code_rebuilds_conditional_touch(inputs(
       j('app-subprograms', 'desktop-mainwindow', 'DesktopMainWindow.csproj'),
@@ -268,9 +330,13 @@ def buildall(args):
       # Copy the icon from misc-res into the .gitignore'd file www/icon.png
       lambda: cp(j(r, 'misc-res', 'icon.png'), j('www', 'icon.png')),
       # Run the usual dotnet builds
-      lambda: c('dotnet', 'publish', '-c', 'Release', '-r', 'win10-x64') if build_win64 else None,
-      lambda: c('dotnet', 'publish', '-c', 'Release', '-r', 'linux-x64') if build_linux_x86_64 else None,
-      lambda: c('dotnet', 'publish', '-c', 'Release', '-r', 'linux-arm64') if build_linux_aarch64 else None,
+      # Restore all runtimes up-front so concurrent publishes do not race on obj/project.assets.json
+      lambda: c('dotnet', 'restore', '-r', 'win10-x64', '-r', 'linux-x64', '-r', 'linux-arm64') if flag_set('parallel_targets') else None,
+      lambda: c_targets(
+        dotnet_publish_cmd('win10-x64') if build_win64 else None,
+        dotnet_publish_cmd('linux-x64') if build_linux_x86_64 else None,
+        dotnet_publish_cmd('linux-arm64') if build_linux_aarch64 else None,
+      ),
     ),
     lambda: assemble_in_win64(
       j('app-subprograms', 'desktop-mainwindow', 'bin', 'Release', 'net5.0', 'win10-x64', 'publish'),
@@ -284,10 +350,11 @@ def buildall(args):
       j('app-subprograms', 'desktop-mainwindow', 'bin', 'Release', 'net5.0', 'linux-arm64', 'publish'),
       'desktop-mainwindow'
     ),
+    task_uses=DOTNET_TASK_USES,
   )
 
 
-  silenced_task(
+  g.add('app-kernel-android', deps('server-webgui'), silenced_task,
     'Building app-kernel-android (loci.apk)',
     force_code_rebuilds_conditional_touch(inputs(
       j('app-kernel-android', 'src'), j('app-kernel-android', 'build.gradle')
@@ -299,19 +366,18 @@ def buildall(args):
     lambda: within(
       j('app-kernel-android'),
       lambda: silent_rm(j('build', 'outputs', 'apk', 'debug', 'loci-debug.apk')) if build_android else None,
-      lambda: c('gradle', 'assembleDebug') if build_android else None,
+      lambda: c(*gradle_cmd('assembleDebug')) if build_android else None,
     ),
     # TODO assemble android deployment-ready stuff
     lambda: assemble_in_android(
       j('app-kernel-android', 'build', 'outputs', 'apk', 'debug', 'loci-debug.apk'),
       'loci.apk'
     ),
+    task_uses=GRADLE_TASK_USES,
   )
 
 
-  # Finally assemble a web www/ directory containing win64/linux64/android distributables
-  if not flag_set('hostonly'):
-    build_www(build_win64, build_linux_x86_64, build_linux_aarch64, build_android, not 'nobrowser' in args)
+  return g
 
 def force_code_rebuilds_conditional_touch(inputs):
   if flag_set('force_code_rebuilds'):
@@ -334,11 +400,14 @@ def download_OSM_BPF_FILE():
         return
       print('')
       start = time.time()
-      c('curl',
-        '-o', os.environ['OSM_BPF_FILE'], # Where the data is output
-        '-L', '-O', '-C', '-',            # Continue flags
-        'https://download.bbbike.org/osm/planet/planet-latest.osm.pbf'
-      )
+      # Resumes from OSM_BPF_FILE.part + OSM_BPF_FILE.journal after interruptions
+      with trace_span('download planet-latest.osm.pbf', 'download'):
+        segmented_download(
+          'https://download.bbbike.org/osm/planet/planet-latest.osm.pbf',
+          os.environ['OSM_BPF_FILE'],
+          segments=8,
+          show_progress=True,
+        )
       pathlib.Path(completed_file).touch()
       end = time.time()
       duration_s = round(end - start, 2)
@@ -0,0 +1,79 @@
+# Compiler cache (sccache with its local disk backend) for rustc and the C
+# compilers cc-rs drives from build.rs scripts.
+#
+# download_sccache() in btool/tools.py bootstraps the binary and points
+# RUSTC_WRAPPER, CC and CC_<triple> at it. Cached objects live in
+# build/sccache/, capped at COMPILER_CACHE_MAX_MB (0 disables the cache),
+# so a cargo clean or a fresh checkout rebuilds dependency crates from the
+# cache. Hit and miss counts for each build are printed in the build summary.
+
+import os
+import json
+import shutil
+import subprocess
+
+COMPILER_CACHE_DIR = os.path.join('build', 'sccache')
+COMPILER_CACHE_WRAPPER = 'sccache'
+
+# Override with COMPILER_CACHE_MAX_MB in dev-env.conf
+COMPILER_CACHE_DEFAULT_MAX_MB = 10 * 1024
+
+def compiler_cache_max_mb():
+  return int(os.environ.get('COMPILER_CACHE_MAX_MB', COMPILER_CACHE_DEFAULT_MAX_MB))
+
+def compiler_cache_dir():
+  return os.path.abspath(os.path.join(os.environ.get('LOCI_REPO_DIR', '.'), COMPILER_CACHE_DIR))
+
+# True once download_sccache() has installed the wrapper
+def compiler_cache_active():
+  return os.environ.get('RUSTC_WRAPPER', '') == COMPILER_CACHE_WRAPPER
+
+# cc-rs accepts "<wrapper> <compiler>" in CC, TARGET_CC and CC_<triple>
+def compiler_cache_cc(compiler):
+  if not compiler_cache_active() or compiler.startswith(COMPILER_CACHE_WRAPPER+' '):
+    return compiler
+  return COMPILER_CACHE_WRAPPER+' '+compiler
+
+# The wrapper does not change what a compiler produces, so fingerprints ignore it
+def without_compiler_cache(value):
+  if value.startswith(COMPILER_CACHE_WRAPPER+' '):
+    return value[len(COMPILER_CACHE_WRAPPER)+1:]
+  return value
+
+def sccache_cmd(*args):
+  return subprocess.run(
+    [shutil.which(COMPILER_CACHE_WRAPPER)] + list(args), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False
+  )
+
+# Called before a build so the summary counts only this build's compiles
+def reset_compiler_cache_stats():
+  if compiler_cache_active() and shutil.which(COMPILER_CACHE_WRAPPER):
+    sccache_cmd('--zero-stats')
+
+# Returns {hits, misses, not_cacheable, cache_size_bytes, max_cache_size_bytes} or None
+def compiler_cache_stats():
+  if not compiler_cache_active() or not shutil.which(COMPILER_CACHE_WRAPPER):
+    return None
+  try:
+    out = json.loads(sccache_cmd('--show-stats', '--stats-format=json').stdout.decode('utf-8'))
+  except ValueError:
+    return None
+  stats = out.get('stats', {})
+  return {
+    'hits': sum(stats.get('cache_hits', {}).get('counts', {}).values()),
+    'misses': sum(stats.get('cache_misses', {}).get('counts', {}).values()),
+    'not_cacheable': sum(stats.get('not_cached', {}).values()) + stats.get('requests_not_cacheable', 0),
+    'cache_size_bytes': out.get('cache_size', None),
+    'max_cache_size_bytes': out.get('max_cache_size', None),
+  }
+
+def format_compiler_cache_stats(stats):
+  compiles = stats['hits'] + stats['misses']
+  line = 'Compiler cache: {:,} hits, {:,} misses ({}% hit rate), {:,} not cacheable'.format(
+    stats['hits'], stats['misses'], int(100 * stats['hits'] / compiles) if compiles > 0 else 0, stats['not_cacheable']
+  )
+  if stats['cache_size_bytes'] is not None and stats['max_cache_size_bytes'] is not None:
+    line += ', {:,}mb of {:,}mb used'.format(
+      int(stats['cache_size_bytes'] / (1024*1024)), int(stats['max_cache_size_bytes'] / (1024*1024))
+    )
+  return line
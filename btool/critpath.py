@@ -0,0 +1,141 @@
+# Critical-path report from recorded task durations.
+#
+#   python -m btool critical_path
+#
+# silenced_task/noisy_task record the wall time of every build of a task in its
+# fingerprint store, per set of enabled targets (durations_s, see
+# record_task_fingerprint). The report takes the median of the builds of the
+# targets being analysed (eg only hostonly builds for "python -m btool
+# hostonly critical_path") and combines it with the task graph: the longest
+# dependency chain bounds the build no matter how many workers run, slack says
+# how late a task may start without delaying the build, and a small scheduler
+# simulation projects build times for several worker counts, both in
+# TaskGraph's own start order and when tasks on longer chains are started first.
+
+import os
+import json
+import time
+import statistics
+
+from btool import *
+from btool.buildall import build_task_graph
+
+# Returns (median seconds or None, number of recorded builds) for the enabled targets
+def task_duration(task_name):
+  durations = recorded_durations(read_fingerprint_store(task_name))
+  if len(durations) < 1:
+    return None, 0
+  return statistics.median(durations), len(durations)
+
+# Earliest start/finish forwards, latest start backwards; keys are in dependency order.
+def critical_path(keys, deps_of, duration):
+  earliest_start = {}
+  earliest_finish = {}
+  for k in keys:
+    earliest_start[k] = max([earliest_finish[d] for d in deps_of[k]] + [0])
+    earliest_finish[k] = earliest_start[k] + duration[k]
+  build_s = max(list(earliest_finish.values()) + [0])
+
+  dependents = {k: [] for k in keys}
+  for k in keys:
+    for d in deps_of[k]:
+      dependents[d].append(k)
+  latest_finish = {}
+  for k in reversed(keys):
+    latest_finish[k] = min([latest_finish[c] - duration[c] for c in dependents[k]] + [build_s])
+  slack = {k: latest_finish[k] - earliest_finish[k] for k in keys}
+
+  # Walk back from the task finishing last through the dependency finishing last
+  chain = []
+  k = max(keys, key=lambda k: earliest_finish[k]) if len(keys) > 0 else None
+  while k is not None:
+    chain.insert(0, k)
+    k = max(deps_of[k], key=lambda d: earliest_finish[d]) if len(deps_of[k]) > 0 else None
+
+  # Longest chain from each task to the end of the build, used as a start priority
+  tail_s = {}
+  for k in reversed(keys):
+    tail_s[k] = duration[k] + max([tail_s[c] for c in dependents[k]] + [0])
+
+  return build_s, earliest_start, slack, chain, tail_s
+
+# List scheduling with `workers` slots; priority orders ready tasks (lower first)
+def simulate_build(keys, deps_of, duration, workers, priority):
+  done_at = {}
+  running = [] # (finish time, key)
+  pending = list(keys)
+  now = 0
+  while len(pending) > 0 or len(running) > 0:
+    ready = sorted([k for k in pending if all(d in done_at and done_at[d] <= now for d in deps_of[k])], key=priority)
+    while len(running) < workers and len(ready) > 0:
+      k = ready.pop(0)
+      pending.remove(k)
+      running.append((now + duration[k], k))
+    running.sort()
+    finish, k = running.pop(0)
+    now = finish
+    done_at[k] = finish
+  return now
+
+def critical_path_report(args):
+  g = build_task_graph(args)
+  keys = list(g.tasks.keys())
+  deps_of = {k: g.tasks[k]['deps'] for k in keys}
+
+  duration = {}
+  runs = {}
+  for k in keys:
+    d, n = task_duration(g.tasks[k]['name'])
+    duration[k] = d if d is not None else 0
+    runs[k] = n
+
+  build_s, earliest_start, slack, chain, tail_s = critical_path(keys, deps_of, duration)
+  serial_s = sum(duration.values())
+
+  print('')
+  print('Task durations for {} (median of up to {} recorded builds):'.format(', '.join(enabled_targets()), MAX_TASK_DURATIONS))
+  for k in keys:
+    print('  {:<22} {:>8}  start at {:>7.1f}s  slack {:>7.1f}s{}'.format(
+      k,
+      '{:.1f}s'.format(duration[k]) if runs[k] > 0 else 'unknown',
+      earliest_start[k], slack[k],
+      '  CRITICAL' if k in chain else '',
+    ))
+
+  print('')
+  print('Critical path ({:.1f}s): {}'.format(build_s, ' -> '.join(chain)))
+  print('All tasks one after another: {:.1f}s'.format(serial_s))
+
+  worker_counts = sorted(set([1, 2, 4, 8, os.cpu_count() or 1]))
+  projections = []
+  print('')
+  print('Projected build time by worker count (graph order / longest chain first):')
+  for workers in worker_counts:
+    in_order_s = simulate_build(keys, deps_of, duration, workers, keys.index)
+    longest_first_s = simulate_build(keys, deps_of, duration, workers, lambda k: -tail_s[k])
+    projections.append({'workers': workers, 'graph_order_s': in_order_s, 'longest_chain_first_s': longest_first_s})
+    print('  jobs={:<3} {:>7.1f}s / {:>7.1f}s  speedup x{:.2f}'.format(
+      workers, in_order_s, longest_first_s, serial_s / longest_first_s if longest_first_s > 0 else 1.0
+    ))
+
+  unknown = [k for k in keys if runs[k] < 1]
+  if len(unknown) > 0:
+    print('')
+    print('No recorded runs for {} (counted as 0s, build once with force_code_rebuilds to record them)'.format(', '.join(unknown)))
+
+  report_file = j('out', 'critical-path.json')
+  os.makedirs(os.path.dirname(report_file), exist_ok=True)
+  with open(report_file, 'w') as fd:
+    json.dump({
+      'generated_epoch_s': int(time.time()),
+      'critical_path': chain,
+      'critical_path_s': build_s,
+      'serial_s': serial_s,
+      'tasks': {k: {
+        'duration_s': duration[k], 'recorded_runs': runs[k],
+        'earliest_start_s': earliest_start[k], 'slack_s': slack[k], 'deps': deps_of[k],
+      } for k in keys},
+      'projections': projections,
+    }, fd, indent=2)
+  print('')
+  print('Wrote {}'.format(report_file))
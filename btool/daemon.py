@@ -0,0 +1,204 @@
+# Persistent build daemon keeping btool's state warm between builds.
+#
+#   python -m btool daemon        # serve on build/btool.sock until stopped
+#   python -m btool daemon stop
+#
+# While the daemon runs, main() (and therefore "python -m btool", tests, docs
+# and webpage_update_tool) forwards its arguments over the unix socket instead
+# of building in-process. The daemon has already imported everything, run
+# download_tools() and indexed the source trees with inotify, so a request only
+# pays for a fork(). Each request runs main() in a forked child with the
+# client's cwd and environment, and its output is streamed back over the socket.
+#
+# Only plain builds are forwarded. Requests are served one at a time, so modes
+# which run for a long time or interactively (watch, run, pgo, variants, ...)
+# stay in the client's process instead of blocking every other build.
+
+import os
+import sys
+import json
+import time
+import socket
+import traceback
+
+DAEMON_SOCKET = os.path.join('build', 'btool.sock')
+DAEMON_ENV_VAR = '_BTOOL_IN_DAEMON'
+# Written after a request's output so the client can tell it apart from build output
+EXIT_MARKER = b'\n\0btool-daemon-exit='
+
+# Source trees watched for changes; build outputs inside them are not
+WATCHED_DIRS = ['app-lib', 'app-kernel-desktop', 'app-kernel-android', 'app-subprograms', 'misc-res']
+UNWATCHED_DIR_NAMES = ['target', 'build', 'bin', 'obj', '.gradle', 'node_modules']
+
+# main() arguments which make a request more than a build; these run in-process
+IN_PROCESS_MODES = ['nodaemon', 'shell', 'watch', 'run', 'cleanrun', 'pgo', 'variants', 'critical_path', 'explain']
+
+def daemon_socket_path():
+  return os.path.abspath(DAEMON_SOCKET)
+
+def daemon_supported():
+  return hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork')
+
+def in_daemon():
+  return os.environ.get(DAEMON_ENV_VAR, '') == '1'
+
+def connect_to_daemon():
+  if not daemon_supported() or in_daemon() or not os.path.exists(daemon_socket_path()):
+    return None
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(daemon_socket_path())
+  except OSError:
+    sock.close()
+    return None # stale socket from a daemon which was killed
+  return sock
+
+def daemon_handles(args):
+  return not any(a in IN_PROCESS_MODES or a.split('=', 1)[0] in IN_PROCESS_MODES for a in args)
+
+def send_request(sock, request):
+  sock.sendall(json.dumps(request).encode('utf-8')+b'\n')
+
+def read_request(conn):
+  buff = b''
+  while not buff.endswith(b'\n'):
+    chunk = conn.recv(64 * 1024)
+    if not chunk:
+      break
+    buff += chunk
+  return json.loads(buff.decode('utf-8'))
+
+# Runs a build in the daemon, copying its output to our stdout. Returns the exit code,
+# or None if no daemon is listening.
+def run_in_daemon(args):
+  sock = connect_to_daemon()
+  if sock is None:
+    return None
+  with sock:
+    send_request(sock, {'args': list(args), 'cwd': os.path.abspath('.'), 'env': dict(os.environ)})
+    pending = b''
+    while True:
+      chunk = sock.recv(64 * 1024)
+      if not chunk:
+        break
+      pending += chunk
+      # The exit marker ends the stream, so holding back a marker's length
+      # of bytes guarantees it is never split across writes
+      keep = len(EXIT_MARKER) + 16
+      if len(pending) > keep:
+        write_stdout_bytes(pending[:-keep])
+        pending = pending[-keep:]
+
+  if not EXIT_MARKER in pending:
+    write_stdout_bytes(pending)
+    return 1 # daemon went away mid-build
+  output, code = pending.rsplit(EXIT_MARKER, 1)
+  write_stdout_bytes(output)
+  return int(code.decode('utf-8').strip())
+
+def write_stdout_bytes(data):
+  if hasattr(sys.stdout, 'buffer'):
+    sys.stdout.buffer.write(data)
+  else:
+    sys.stdout.write(data.decode('utf-8', errors='replace'))
+  sys.stdout.flush()
+
+def stop_daemon():
+  sock = connect_to_daemon()
+  if sock is None:
+    print('No btool daemon is running')
+    return
+  with sock:
+    send_request(sock, {'stop': True})
+    sock.recv(1024)
+  print('Stopped btool daemon')
+
+def watched_source_dirs():
+  dirs = []
+  for top in WATCHED_DIRS:
+    if not os.path.isdir(top):
+      continue
+    for subdir, subdirs, files in os.walk(top):
+      subdirs[:] = [d for d in subdirs if not d in UNWATCHED_DIR_NAMES]
+      dirs.append(subdir)
+  return dirs
+
+# Runs in a forked child: the connection becomes stdin/stdout/stderr and main_fn(args) runs
+def serve_request(conn, request, main_fn, tool_env):
+  os.chdir(request['cwd'])
+  # The client's environment, plus everything download_tools() set up in the daemon
+  os.environ.clear()
+  os.environ.update(request['env'])
+  os.environ.update(tool_env)
+  os.environ[DAEMON_ENV_VAR] = '1'
+
+  for fd in (0, 1, 2):
+    os.dup2(conn.fileno(), fd)
+  sys.stdout = os.fdopen(1, 'w', buffering=1, encoding='utf-8', errors='replace', closefd=False)
+  sys.stderr = os.fdopen(2, 'w', buffering=1, encoding='utf-8', errors='replace', closefd=False)
+
+  code = 0
+  try:
+    main_fn(request['args'])
+  except SystemExit as e:
+    code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+  except BaseException:
+    traceback.print_exc()
+    code = 1
+  sys.stdout.flush()
+  sys.stderr.flush()
+  os._exit(code)
+
+def serve_forever(main_fn, download_tools_fn, watch_fn):
+  if not daemon_supported():
+    raise Exception('The btool daemon needs unix sockets and fork(), which this OS does not have')
+  if connect_to_daemon() is not None:
+    raise Exception('A btool daemon is already listening on {}'.format(daemon_socket_path()))
+
+  env_before = dict(os.environ)
+  download_tools_fn()
+  tool_env = {k: v for k, v in os.environ.items() if env_before.get(k, None) != v}
+  watcher = watch_fn(watched_source_dirs())
+  os.environ[DAEMON_ENV_VAR] = '1'
+
+  if os.path.exists(daemon_socket_path()):
+    os.remove(daemon_socket_path())
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(daemon_socket_path())
+  server.listen(16)
+  print('btool daemon listening on {} (pid {}, inotify {})'.format(
+    daemon_socket_path(), os.getpid(), 'on' if watcher is not None else 'unavailable'
+  ), flush=True)
+
+  try:
+    while True:
+      conn, _ = server.accept()
+      with conn:
+        try:
+          request = read_request(conn)
+        except ValueError:
+          continue
+        if request.get('stop', False):
+          conn.sendall(b'ok')
+          break
+
+        # Builds in one tree must not overlap, so requests are served one at a time
+        # (daemon_handles() keeps long-running modes out of the queue)
+        start = time.time()
+        pid = os.fork()
+        if pid == 0:
+          server.close()
+          serve_request(conn, request, main_fn, tool_env)
+        _, status = os.waitpid(pid, 0)
+        code = os.waitstatus_to_exitcode(status)
+        try:
+          conn.sendall(EXIT_MARKER+str(code).encode('utf-8')+b'\n')
+        except OSError:
+          pass # client hung up
+        print('{} -> exit code {} in {:.2f}s'.format(' '.join(request['args']), code, time.time() - start), flush=True)
+  finally:
+    server.close()
+    if os.path.exists(daemon_socket_path()):
+      os.remove(daemon_socket_path())
+    if watcher is not None:
+      watcher.close()
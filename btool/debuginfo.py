@@ -0,0 +1,138 @@
+# Split debug info out of assembled binaries ("python -m btool split_debuginfo").
+#
+# Release builds still carry std's debug sections (and .symtab), which would end
+# up inside linux_x86_64.tar.gz, win64.zip etc. When assembling an ELF or PE
+# binary into out/<target>/, objcopy keeps the debug info in
+# out/symbols/<build-id>/<name>.debug, and out/<target>/ gets a copy with debug
+# sections stripped and a .gnu_debuglink to that file. Symbol tables stay in the
+# shipped binary so backtraces and perf still name functions; gdb, perf and
+# addr2line find the full debug info by build-id (ELF) or debuglink (PE).
+#
+# Binaries without a GNU build-id note (eg mingw PE files) are filed under the
+# sha256 of the unstripped binary instead.
+#
+# The split is opt-in because it needs an objcopy for every enabled target;
+# with it enabled a missing objcopy fails the build rather than quietly
+# shipping binaries with their debug info.
+
+import os
+import json
+import shutil
+import struct
+import subprocess
+
+from btool.linkcopy import file_sha256, same_file_contents
+
+SYMBOLS_DIR = os.path.join('out', 'symbols')
+
+# out/<target>/ dir name -> objcopy binaries able to handle that target's files, first found wins
+OBJCOPY_TOOLS = {
+  'linux_x86_64': ['x86_64-linux-gnu-objcopy', 'objcopy', 'llvm-objcopy'],
+  'linux_aarch64': ['aarch64-linux-gnu-objcopy', 'llvm-objcopy', 'objcopy'],
+  'win64': ['x86_64-w64-mingw32-objcopy', 'objcopy', 'llvm-objcopy'],
+  'android': ['llvm-objcopy', 'aarch64-linux-android-objcopy'],
+}
+
+NT_GNU_BUILD_ID = 3
+SHT_NOTE = 7
+
+def native_binary_kind(path):
+  try:
+    with open(path, 'rb') as fd:
+      magic = fd.read(4)
+  except OSError:
+    return None
+  if magic == b'\x7fELF':
+    return 'elf'
+  if magic[:2] == b'MZ':
+    return 'pe'
+  return None
+
+# Returns the hex GNU build-id of an ELF file, or None (also for truncated or non-ELF files)
+def elf_build_id(path):
+  try:
+    return read_elf_build_id(path)
+  except (struct.error, IndexError):
+    return None
+
+def read_elf_build_id(path):
+  with open(path, 'rb') as fd:
+    ident = fd.read(16)
+    is_64 = ident[4] == 2
+    endian = '<' if ident[5] == 1 else '>'
+    if is_64:
+      fd.seek(0x28)
+      shoff, = struct.unpack(endian+'Q', fd.read(8))
+      fd.seek(0x3A)
+    else:
+      fd.seek(0x20)
+      shoff, = struct.unpack(endian+'I', fd.read(4))
+      fd.seek(0x2E)
+    shentsize, shnum = struct.unpack(endian+'HH', fd.read(4))
+
+    for i in range(shnum):
+      fd.seek(shoff + i * shentsize)
+      if is_64:
+        name, sh_type, flags, addr, offset, size = struct.unpack(endian+'IIQQQQ', fd.read(40))
+      else:
+        name, sh_type, flags, addr, offset, size = struct.unpack(endian+'IIIIII', fd.read(24))
+      if sh_type != SHT_NOTE:
+        continue
+      fd.seek(offset)
+      notes = fd.read(size)
+      pos = 0
+      while pos + 12 <= len(notes):
+        namesz, descsz, note_type = struct.unpack(endian+'III', notes[pos:pos+12])
+        name_start = pos + 12
+        desc_start = name_start + ((namesz + 3) & ~3)
+        if note_type == NT_GNU_BUILD_ID and notes[name_start:name_start+namesz].rstrip(b'\0') == b'GNU':
+          return notes[desc_start:desc_start+descsz].hex()
+        pos = desc_start + ((descsz + 3) & ~3)
+  return None
+
+def binary_build_id(path, kind):
+  build_id = elf_build_id(path) if kind == 'elf' else None
+  return build_id or file_sha256(path)[:40]
+
+def find_objcopy(target):
+  for tool in OBJCOPY_TOOLS.get(target, []):
+    if shutil.which(tool):
+      return shutil.which(tool)
+  return None
+
+# Places src at dst with debug info split into out/symbols/<build-id>/.
+# Returns False (having done nothing) when src is not a native binary, so the
+# caller places it unchanged. Raises when no objcopy for target is installed.
+def place_split_debuginfo(src, dst, target):
+  kind = native_binary_kind(src)
+  if kind is None:
+    return False
+  objcopy = find_objcopy(target)
+  if objcopy is None:
+    raise Exception('split_debuginfo needs one of {} on the PATH to assemble {} for {}'.format(', '.join(OBJCOPY_TOOLS.get(target, [])), src, target))
+
+  build_id = binary_build_id(src, kind)
+  symbols_dir = os.path.abspath(os.path.join(os.environ.get('LOCI_REPO_DIR', '.'), SYMBOLS_DIR, build_id))
+  os.makedirs(symbols_dir, exist_ok=True)
+  debug_file = os.path.join(symbols_dir, os.path.basename(dst)+'.debug')
+  if not os.path.exists(debug_file):
+    subprocess.run([objcopy, '--only-keep-debug', src, debug_file+'.tmp'], check=True)
+    os.replace(debug_file+'.tmp', debug_file)
+    with open(os.path.join(symbols_dir, 'info.json'), 'w') as fd:
+      json.dump({
+        'target': target,
+        'name': os.path.basename(dst),
+        'source': os.path.abspath(src),
+        'git_hash': os.environ.get('GIT_HASH', None),
+        'build_id_kind': 'gnu' if kind == 'elf' and build_id == elf_build_id(src) else 'sha256',
+      }, fd, indent=2)
+
+  # objcopy output is deterministic, so an unchanged binary leaves dst untouched
+  tmp_dst = dst+'.assembling'
+  subprocess.run([objcopy, '--strip-debug', '--add-gnu-debuglink='+debug_file, src, tmp_dst], check=True)
+  shutil.copymode(src, tmp_dst)
+  if same_file_contents(tmp_dst, dst):
+    os.remove(tmp_dst)
+  else:
+    os.replace(tmp_dst, dst)
+  return True
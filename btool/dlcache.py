@@ -0,0 +1,193 @@
+# Content-addressed download cache shared by every dl_* helper.
+#
+# build/dl-cache/objects/<sha256>      downloaded bytes
+# build/dl-cache/urls/<sha256(url)>    json {"url", "sha256", "size"}
+#
+# A URL downloaded once (eg geoserver for 3 targets) is never fetched again,
+# so clean rebuilds work from the cache alone. Objects are touched on use and
+# the least-recently-used are evicted once the cache grows past its size cap.
+#
+# btool/download-pins.json maps the urls of the runtimes we ship (pypy, the
+# JRE, geoserver) and of build tools (gradle, sccache) to their sha256, and
+# every download of a pinned url is verified against it. Pins are taken from
+# the checksums upstream publishes next to each release, never from what a
+# download happened to return: "python -m btool pin_downloads url=... sha256=..."
+# checks the download against the given checksum before recording it.
+
+import os
+import json
+import time
+import hashlib
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+from btool.segdl import *
+from btool.trace import *
+
+DL_CACHE_DIR = os.path.join('build', 'dl-cache')
+
+# Override with DL_CACHE_MAX_MB in dev-env.conf
+DL_CACHE_DEFAULT_MAX_MB = 16 * 1024
+
+CHUNK_BYTES = 1024 * 1024
+
+def dl_cache_dir(*parts):
+  return os.path.abspath(os.path.join(os.environ.get('LOCI_REPO_DIR', '.'), DL_CACHE_DIR, *parts))
+
+def dl_cache_max_bytes():
+  return int(os.environ.get('DL_CACHE_MAX_MB', DL_CACHE_DEFAULT_MAX_MB)) * 1024 * 1024
+
+DOWNLOAD_PINS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'download-pins.json')
+
+def url_key(url):
+  return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+def read_download_pins():
+  try:
+    with open(DOWNLOAD_PINS_FILE, 'r') as fd:
+      return json.load(fd)
+  except FileNotFoundError:
+    return {}
+
+# The pinned sha256 of url, or None
+def pinned_sha256(url):
+  return read_download_pins().get(url, None)
+
+# python -m btool pin_downloads url=<url> sha256=<upstream checksum>: downloads
+# url, verifies it against the checksum upstream published and records the pin.
+def pin_downloads(url, sha256):
+  if url is None or sha256 is None or len(sha256) != 64:
+    raise Exception('pin_downloads needs url= and the sha256= upstream publishes for it')
+  cached_download(url, sha256=sha256.lower())
+  pins = read_download_pins()
+  pins[url] = sha256.lower()
+  print('{} {}'.format(pins[url], url))
+  with open(DOWNLOAD_PINS_FILE+'.tmp', 'w') as fd:
+    json.dump(pins, fd, indent=2, sort_keys=True)
+    fd.write('\n')
+  os.replace(DOWNLOAD_PINS_FILE+'.tmp', DOWNLOAD_PINS_FILE)
+
+# Default fetcher: resumable segmented download, returning the sha256 of dst_file.
+def fetch_url_segmented(url, dst_file):
+  return segmented_download(url, dst_file, hash_result=True)
+
+# Streams url into dst_file, returning its sha256.
+def fetch_url_to(url, dst_file):
+  import urllib.request
+  h = hashlib.sha256()
+  with urllib.request.urlopen(url) as response:
+    with open(dst_file, 'wb') as fd:
+      while True:
+        chunk = response.read(CHUNK_BYTES)
+        if not chunk:
+          break
+        h.update(chunk)
+        fd.write(chunk)
+  return h.hexdigest()
+
+def read_url_entry(url):
+  try:
+    with open(dl_cache_dir('urls', url_key(url)), 'r') as fd:
+      return json.load(fd)
+  except:
+    return None
+
+# Path of the cached object for url, or None on a cache miss
+def cached_object(url, sha256):
+  entry = read_url_entry(url)
+  if entry is not None and (sha256 is None or entry['sha256'] == sha256):
+    object_file = dl_cache_dir('objects', entry['sha256'])
+    if os.path.exists(object_file) and os.path.getsize(object_file) == entry['size']:
+      os.utime(object_file) # Most recently used
+      return object_file
+  return None
+
+# Returns a local path holding the contents of url, downloading it only if the cache misses.
+# When sha256 is given (or pinned in download-pins.json) the content must match it or an exception is raised.
+# fetch_fn(url, dst_file) -> sha256 lets callers supply a different downloader.
+def cached_download(url, sha256=None, fetch_fn=None):
+  if fetch_fn is None:
+    fetch_fn = fetch_url_segmented
+  if sha256 is None:
+    sha256 = pinned_sha256(url)
+
+  object_file = cached_object(url, sha256)
+  if object_file is not None:
+    return object_file
+
+  os.makedirs(dl_cache_dir('objects'), exist_ok=True)
+  os.makedirs(dl_cache_dir('urls'), exist_ok=True)
+
+  # Forked tasks fetching the same url (eg geoserver for 3 targets) take turns,
+  # and the ones which waited find the object already cached.
+  lock_fd = open(dl_cache_dir('objects', url_key(url)+'.lock'), 'w')
+  try:
+    if fcntl is not None:
+      fcntl.flock(lock_fd, fcntl.LOCK_EX)
+      object_file = cached_object(url, sha256)
+      if object_file is not None:
+        return object_file
+
+    # Named after the url (not random) so an interrupted fetch_fn can resume its partial files
+    tmp_file = dl_cache_dir('objects', url_key(url)+'.download')
+    with trace_span('download '+url.split('/')[-1], 'download', url=url):
+      actual_sha256 = fetch_fn(url, tmp_file)
+    if sha256 is not None and actual_sha256 != sha256:
+      os.remove(tmp_file)
+      raise Exception('Checksum mismatch for {}: expected sha256 {} but downloaded {}'.format(url, sha256, actual_sha256))
+    object_file = dl_cache_dir('objects', actual_sha256)
+    os.replace(tmp_file, object_file)
+
+    url_file = dl_cache_dir('urls', url_key(url))
+    with open(url_file+'.tmp', 'w') as fd:
+      json.dump({'url': url, 'sha256': actual_sha256, 'size': os.path.getsize(object_file)}, fd)
+    os.replace(url_file+'.tmp', url_file)
+  finally:
+    lock_fd.close()
+
+  evict_dl_cache(keep=object_file)
+  return object_file
+
+# Removes least-recently-used objects (and url entries pointing at them)
+# until the cache fits within dl_cache_max_bytes().
+def evict_dl_cache(keep=None):
+  objects_dir = dl_cache_dir('objects')
+  if not os.path.isdir(objects_dir):
+    return
+
+  objects = []
+  total_size = 0
+  for name in os.listdir(objects_dir):
+    if '.' in name:
+      continue # In-progress downloads
+    st = os.stat(os.path.join(objects_dir, name))
+    objects.append((st.st_mtime, name, st.st_size))
+    total_size += st.st_size
+
+  max_bytes = dl_cache_max_bytes()
+  if total_size <= max_bytes:
+    return
+
+  evicted = set()
+  for mtime, name, size in sorted(objects):
+    if total_size <= max_bytes:
+      break
+    object_file = os.path.join(objects_dir, name)
+    if object_file == keep:
+      continue
+    os.remove(object_file)
+    evicted.add(name)
+    total_size -= size
+
+  urls_dir = dl_cache_dir('urls')
+  for name in os.listdir(urls_dir):
+    try:
+      with open(os.path.join(urls_dir, name), 'r') as fd:
+        if json.load(fd)['sha256'] in evicted:
+          os.remove(os.path.join(urls_dir, name))
+    except:
+      continue
+
@@ -0,0 +1,133 @@
+# "python -m btool explain": why each task would (or would not) rebuild.
+#
+#   python -m btool hostonly explain
+#
+# For every task and enabled target this prints the newest input and output
+# files, the rebuild reason silenced_task/noisy_task would act on (down to the
+# input files, tools or flags which changed since that target's last build) and an
+# estimate from the durations recorded by previous builds of the same targets.
+# Nothing is built and no fingerprint store is written.
+
+import os
+import time
+import statistics
+
+from btool import *
+from btool.buildall import build_task_graph
+
+# Changed input files listed per task before the rest are summarized
+MAX_LISTED_CHANGES = 10
+
+def format_mtime(mtime):
+  return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime))
+
+# Returns (path, mtime) of the most recently modified file under paths, or (None, 0)
+def newest_file(paths):
+  newest = (None, 0)
+  for f in list_input_files(paths):
+    try:
+      mtime = os.path.getmtime(f)
+    except OSError:
+      continue
+    if mtime > newest[1]:
+      newest = (f, mtime)
+  return newest
+
+# entry is the target's entry in the fingerprint store
+def describe_changes(entry, current_hashes, task_uses):
+  if not 'built_inputs' in entry:
+    return ['inputs, tools or flags changed (details are recorded from the next build on)']
+  changes = []
+  built = entry['built_inputs']
+  for path in sorted(set(built.keys()) | set(current_hashes.keys())):
+    if not path in current_hashes:
+      changes.append('removed input {}'.format(path))
+    elif not path in built:
+      changes.append('new input {}'.format(path))
+    elif built[path] != current_hashes[path]:
+      changes.append('modified input {} (sha256 {} -> {})'.format(path, built[path][:12], current_hashes[path][:12]))
+
+  tools = task_tool_versions(task_uses)
+  for tool in sorted(set(entry.get('built_tools', {}).keys()) | set(tools.keys())):
+    if entry.get('built_tools', {}).get(tool, None) != tools.get(tool, None):
+      changes.append('{} changed: {} -> {}'.format(tool, entry.get('built_tools', {}).get(tool, None), tools.get(tool, None)))
+
+  if entry.get('built_settings', None) != fingerprint_settings(task_uses):
+    changes.append('flags or env changed: {} -> {}'.format(entry.get('built_settings', None), fingerprint_settings(task_uses)))
+
+  if len(changes) > MAX_LISTED_CHANGES:
+    changes = changes[:MAX_LISTED_CHANGES] + ['... and {} more'.format(len(changes) - MAX_LISTED_CHANGES)]
+  return changes
+
+# Same decision as check_task_fingerprint() (see target_rebuild_reason), without writing anything.
+# Returns a list of reason lines, empty when the target is up to date.
+def explain_target(task_name, target, store, fingerprint, current_hashes, input_files, output_files, task_uses):
+  reason = target_rebuild_reason(task_name, target, store, fingerprint, input_files, output_files)
+  if reason is None:
+    return []
+  entry = store['targets'].get(target, None)
+  if reason != 'force_code_rebuilds' and entry is not None and entry['fingerprint'] != fingerprint:
+    return describe_changes(entry, current_hashes, task_uses)
+  return [reason]
+
+# Median of the recorded builds of the enabled targets
+def estimate_duration(store):
+  durations = recorded_durations(store)
+  if len(durations) < 1:
+    return None
+  return statistics.median(durations)
+
+def explain_tasks(args):
+  tool_versions()
+  g = build_task_graph(args)
+  total_estimate_s = 0
+  unknown_estimates = 0
+
+  for task in g.tasks.values():
+    store = read_fingerprint_store(task['name'])
+    # Work on a copy so the on-disk hash cache is left alone
+    current_hashes = dict(store['file_hashes'])
+    fingerprint = task_fingerprint(task['inputs'], current_hashes, task['uses'])
+    current_hashes = {path: entry[2] for path, entry in current_hashes.items()}
+
+    print('')
+    print('{} ({})'.format(task['key'], task['name']))
+    newest_in, newest_in_mtime = newest_file(task['inputs'])
+    if newest_in is not None:
+      print('  newest input:  {}  {}  sha256 {}'.format(
+        newest_in, format_mtime(newest_in_mtime), current_hashes.get(newest_in, '?')[:12]
+      ))
+    else:
+      print('  newest input:  (task has no input files)')
+
+    rebuild = False
+    for target in enabled_targets():
+      newest_out, newest_out_mtime = newest_file(outputs_for_target(task['outputs'], target))
+      if newest_out is not None:
+        print('  {} newest output: {}  {}'.format(target, newest_out, format_mtime(newest_out_mtime)))
+      else:
+        print('  {} newest output: (none)'.format(target))
+
+      reasons = explain_target(task['name'], target, store, fingerprint, current_hashes, task['inputs'], task['outputs'], task['uses'])
+      if len(reasons) < 1:
+        print('  {} up to date'.format(target))
+      else:
+        rebuild = True
+        print('  {} REBUILD:'.format(target))
+        for reason in reasons:
+          print('    {}'.format(reason))
+
+    if rebuild:
+      estimate_s = estimate_duration(store)
+      if estimate_s is None:
+        unknown_estimates += 1
+        print('  estimated: unknown (no recorded builds of {})'.format(', '.join(enabled_targets())))
+      else:
+        total_estimate_s += estimate_s
+        print('  estimated: {}s (median of {} recorded builds)'.format(round(estimate_s, 1), len(recorded_durations(store))))
+
+  print('')
+  print('Estimated rebuild time if run one task at a time: {}s{}'.format(
+    round(total_estimate_s, 1),
+    ' (+{} tasks without recorded builds)'.format(unknown_estimates) if unknown_estimates > 0 else ''
+  ))
@@ -0,0 +1,139 @@
+# Content-hash fingerprints of build task inputs.
+#
+# A task fingerprint is the sha256 of every input file's contents, combined
+# with the versions of the tools and the flags each task declares (see uses()
+# in btool.utils).
+# Per-file hashes are cached by (size, mtime) so a "touch" or "git checkout"
+# only costs re-hashing the touched files instead of a full rebuild.
+#
+# Stores live under build/fingerprints/<task>.json, one file per task
+# so tasks running in parallel never write the same file.
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import subprocess
+
+FINGERPRINT_DIR = os.path.join('build', 'fingerprints')
+
+def hash_file(path):
+  h = hashlib.sha256()
+  with open(path, 'rb') as fd:
+    while True:
+      chunk = fd.read(1024 * 1024)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.hexdigest()
+
+# Accepts list of paths, directory paths, and single file paths.
+# Returns every file under them, sorted so hashes are stable.
+def list_input_files(input_files):
+  files = []
+  for item in input_files:
+    if os.path.isdir(item):
+      for subdir, dirs, dir_files in os.walk(item):
+        for f in dir_files:
+          files.append(os.path.join(subdir, f))
+    elif os.path.exists(item):
+      files.append(item)
+  return sorted(files)
+
+# Returns hex digest of all input contents.
+# file_hash_cache maps path -> [size, mtime_ns, sha256] and is updated in-place;
+# stale entries for files which no longer exist are dropped.
+def hash_inputs(input_files, file_hash_cache):
+  h = hashlib.sha256()
+  seen = set()
+  for path in list_input_files(input_files):
+    st = os.stat(path)
+    cached = file_hash_cache.get(path, None)
+    if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+      file_hash = cached[2]
+    else:
+      file_hash = hash_file(path)
+      file_hash_cache[path] = [st.st_size, st.st_mtime_ns, file_hash]
+    seen.add(path)
+    h.update('{}\0{}\n'.format(path, file_hash).encode('utf-8'))
+
+  for path in list(file_hash_cache.keys()):
+    if not path in seen:
+      file_hash_cache.pop(path)
+
+  return h.hexdigest()
+
+# Version strings of compilers used by build tasks.
+# Computed once and kept in os.environ so forked task processes share it.
+def tool_versions():
+  if '_BTOOL_TOOL_VERSIONS' in os.environ:
+    return json.loads(os.environ['_BTOOL_TOOL_VERSIONS'])
+
+  version_cmds = [
+    ['rustc', '--version'],
+    ['cargo', '--version'],
+    ['dotnet', '--version'],
+    ['java', '-version'], # java prints to stderr
+  ]
+  versions = {}
+  for cmd in version_cmds:
+    if not shutil.which(cmd[0]):
+      continue
+    try:
+      versions[cmd[0]] = subprocess.run(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False
+      ).stdout.decode('utf-8', errors='replace').strip()
+    except Exception as e:
+      versions[cmd[0]] = 'error: {}'.format(e)
+
+  os.environ['_BTOOL_TOOL_VERSIONS'] = json.dumps(versions, sort_keys=True)
+  return versions
+
+# A C compiler command (eg "/usr/bin/x86_64-linux-gnu-gcc-12 -m64") as its file
+# name, arguments and the first line of its --version, so machines with the
+# same compiler installed elsewhere fingerprint it the same.
+# Cached in os.environ like tool_versions().
+def compiler_identity(cc):
+  if cc.strip() == '':
+    return ''
+  identities = json.loads(os.environ.get('_BTOOL_CC_IDENTITIES', '{}'))
+  if not cc in identities:
+    cmd = cc.split()
+    version = 'not found'
+    if shutil.which(cmd[0]):
+      try:
+        out = subprocess.run(
+          cmd + ['--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False
+        ).stdout.decode('utf-8', errors='replace').strip()
+        version = out.splitlines()[0] if out else ''
+      except Exception as e:
+        version = 'error: {}'.format(e)
+    name = re.sub(r'\.exe$', '', os.path.basename(cmd[0]))
+    identities[cc] = '{} ({})'.format(' '.join([name] + cmd[1:]), version)
+    os.environ['_BTOOL_CC_IDENTITIES'] = json.dumps(identities, sort_keys=True)
+  return identities[cc]
+
+def fingerprint_store_path(task_name):
+  return os.path.join(FINGERPRINT_DIR, re.sub(r'[^A-Za-z0-9_.-]+', '_', task_name)+'.json')
+
+def read_fingerprint_store(task_name):
+  store = {}
+  try:
+    with open(fingerprint_store_path(task_name), 'r') as fd:
+      store = json.load(fd)
+  except:
+    pass
+  if not 'targets' in store:
+    store['targets'] = {}
+  if not 'file_hashes' in store:
+    store['file_hashes'] = {}
+  return store
+
+def write_fingerprint_store(task_name, store):
+  os.makedirs(FINGERPRINT_DIR, exist_ok=True)
+  store_file = fingerprint_store_path(task_name)
+  with open(store_file+'.tmp', 'w') as fd:
+    json.dump(store, fd)
+  os.replace(store_file+'.tmp', store_file)
+
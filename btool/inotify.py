@@ -0,0 +1,109 @@
+# Minimal linux inotify bindings using ctypes so we need no 3rd-party package.
+# Used to follow changes to build inputs and outputs without re-walking them.
+
+import os
+import sys
+import struct
+import select
+import ctypes
+import ctypes.util
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+def _get_libc():
+  global _libc
+  if _libc is None:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+  return _libc
+
+def inotify_available():
+  if not sys.platform.startswith('linux'):
+    return False
+  try:
+    return hasattr(_get_libc(), 'inotify_init1')
+  except OSError:
+    return False
+
+# Recursively watches directories; read() returns the paths which changed.
+# Directories created after the watcher started are watched as they appear.
+class InotifyWatcher():
+  def __init__(self, directories):
+    libc = _get_libc()
+    self.fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    self.wd_to_path = {}
+    # Absolute paths of the directories currently watched
+    self.watched = set()
+    for directory in directories:
+      self.add_tree(directory)
+
+  def add_tree(self, directory):
+    if not os.path.isdir(directory):
+      return
+    for subdir, dirs, files in os.walk(directory):
+      self.add_dir(subdir)
+
+  def add_dir(self, directory):
+    wd = _get_libc().inotify_add_watch(self.fd, os.fsencode(os.path.abspath(directory)), WATCH_MASK)
+    if wd >= 0:
+      self.wd_to_path[wd] = os.path.abspath(directory)
+      self.watched.add(os.path.abspath(directory))
+
+  # Blocks for up to timeout_s and returns a list of changed absolute paths,
+  # or None if the kernel queue overflowed and everything must be assumed changed.
+  def read(self, timeout_s=None):
+    readable, _, _ = select.select([self.fd], [], [], timeout_s)
+    if len(readable) < 1:
+      return []
+
+    changed = []
+    try:
+      buff = os.read(self.fd, 64 * 1024)
+    except BlockingIOError:
+      return []
+
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(buff):
+      wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(buff, offset)
+      offset += EVENT_HEADER.size
+      name = buff[offset:offset+name_len].rstrip(b'\0')
+      offset += name_len
+
+      if mask & IN_Q_OVERFLOW:
+        return None
+      if mask & IN_IGNORED:
+        self.watched.discard(self.wd_to_path.pop(wd, None))
+        continue
+
+      parent = self.wd_to_path.get(wd, None)
+      if parent is None:
+        continue
+      path = os.path.join(parent, os.fsdecode(name)) if name_len > 0 else parent
+      changed.append(path)
+      if (mask & IN_ISDIR) and (mask & (IN_CREATE | IN_MOVED_TO)):
+        self.add_tree(path)
+
+    return changed
+
+  def close(self):
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
+
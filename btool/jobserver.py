@@ -0,0 +1,107 @@
+# GNU make compatible jobserver shared by every command btool runs.
+#
+#   python -m btool cores=8
+#
+# A pipe is filled with one token per core in the budget and advertised through
+# MAKEFLAGS/CARGO_MAKEFLAGS, so cargo (and the rustc, cc and make processes below it)
+# take a token for each extra job they start. Those variables only go into the
+# environment of commands which also inherit the pipe (see jobserver_popen_kwargs),
+# never into os.environ, so other processes never see fds they do not have. btool takes one token before
+# starting any command, so the command's own implicit job is paid for too.
+# gradle and dotnet cannot read the pipe, so they get a fixed worker limit (a
+# share of the budget, leaving the rest to the tasks running beside them) and
+# btool takes that many tokens for them up front.
+
+import os
+import re
+import contextlib
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+JOBSERVER_LOCK = os.path.join('build', 'jobserver.lock')
+
+# (read fd, write fd, budget), inherited by forked task processes
+_jobserver = None
+
+def start_jobserver(budget):
+  global _jobserver
+  stop_jobserver()
+  if os.name == 'nt' or budget < 1:
+    return # make on windows uses named semaphores instead
+  read_fd, write_fd = os.pipe()
+  os.write(write_fd, b'+' * budget)
+  _jobserver = (read_fd, write_fd, budget)
+
+def stop_jobserver():
+  global _jobserver
+  if _jobserver is not None:
+    os.close(_jobserver[0])
+    os.close(_jobserver[1])
+    _jobserver = None
+
+def jobserver_budget():
+  if _jobserver is None:
+    return os.cpu_count() or 1
+  return _jobserver[2]
+
+# Worker limit for tools which run their own pool, when `concurrent` of them run side by side
+def jobserver_worker_share(concurrent=1):
+  return max(1, jobserver_budget() // max(1, concurrent))
+
+# Extra Popen() arguments so the child inherits the token pipe and the MAKEFLAGS pointing at it
+def jobserver_popen_kwargs():
+  if _jobserver is None:
+    return {}
+  read_fd, write_fd, budget = _jobserver
+  makeflags = '-j{budget} --jobserver-fds={r},{w} --jobserver-auth={r},{w}'.format(budget=budget, r=read_fd, w=write_fd)
+  return {
+    'pass_fds': (read_fd, write_fd),
+    'env': dict(os.environ, MAKEFLAGS=makeflags, CARGO_MAKEFLAGS=makeflags),
+  }
+
+# Tokens held on behalf of a command: its worker limit for gradle/dotnet, else 1
+def cmd_job_tokens(cmd):
+  for arg in cmd:
+    m = re.match(r'^(--max-workers=|-maxcpucount:|-m:)(\d+)$', arg)
+    if m:
+      return max(1, min(int(m.group(2)), jobserver_budget()))
+  return 1
+
+def jobserver_lock_file():
+  return os.path.abspath(os.path.join(os.environ.get('LOCI_REPO_DIR', '.'), JOBSERVER_LOCK))
+
+def read_token():
+  while True:
+    try:
+      return os.read(_jobserver[0], 1)
+    except InterruptedError:
+      continue
+
+# with job_tokens(cmd): subprocess.Popen(cmd, **jobserver_popen_kwargs())
+@contextlib.contextmanager
+def job_tokens(cmd):
+  if _jobserver is None:
+    yield
+    return
+  count = cmd_job_tokens(cmd)
+  tokens = []
+  try:
+    if count > 1 and fcntl is not None:
+      # Only one multi-token claim at a time, so two claims cannot each hold
+      # part of the budget while waiting on the other.
+      os.makedirs(os.path.dirname(jobserver_lock_file()), exist_ok=True)
+      with open(jobserver_lock_file(), 'a') as lock_fd:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        while len(tokens) < count:
+          tokens.append(read_token())
+    else:
+      while len(tokens) < count:
+        tokens.append(read_token())
+    yield
+  finally:
+    if len(tokens) > 0:
+      os.write(_jobserver[1], b''.join(tokens))
+
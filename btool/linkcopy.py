@@ -0,0 +1,190 @@
+# File placement for assembling ./out/<target>/ without rewriting unchanged bytes.
+#
+# mode='copy' copies like shutil.copy2 (keeping mtimes), but skips files which
+# already match: equal size and mtime are trusted, and only files with equal
+# sizes but different mtimes are hashed.
+# mode='link' reflinks (copy-on-write clones, btrfs/xfs) or else hardlinks files,
+# falling back to a copy across filesystems. Hardlinked files share one inode,
+# so anything editing them in place (rather than replacing them) edits every copy:
+# place_file(), replace_tree() (used by dl_archive_to in link mode) and
+# btool.artifactcache.unpack_outputs() therefore always write a new file beside
+# the old one and rename it over it.
+
+import os
+import shutil
+import hashlib
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+def file_sha256(path):
+  h = hashlib.sha256()
+  with open(path, 'rb') as fd:
+    while True:
+      chunk = fd.read(1024 * 1024)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.hexdigest()
+
+def same_file_contents(a, b):
+  try:
+    a_st = os.stat(a)
+    b_st = os.stat(b)
+  except FileNotFoundError:
+    return False
+  if a_st.st_ino == b_st.st_ino and a_st.st_dev == b_st.st_dev:
+    return True
+  if a_st.st_size != b_st.st_size:
+    return False
+  # place_file() keeps mtimes, so this is the common case for unchanged files
+  if a_st.st_mtime_ns == b_st.st_mtime_ns:
+    return True
+  if file_sha256(a) != file_sha256(b):
+    return False
+  # Same bytes, eg a fresh checkout or a rebuild which reproduced the file:
+  # take src's mtime so the next call does not hash them again
+  os.utime(b, ns=(b_st.st_atime_ns, a_st.st_mtime_ns))
+  return True
+
+def reflink_file(src, dst):
+  if fcntl is None:
+    return False
+  try:
+    with open(src, 'rb') as src_fd:
+      with open(dst, 'wb') as dst_fd:
+        fcntl.ioctl(dst_fd.fileno(), FICLONE, src_fd.fileno())
+    shutil.copystat(src, dst)
+    return True
+  except OSError:
+    if os.path.exists(dst):
+      os.remove(dst)
+    return False
+
+# Makes dst hold the contents of src, returning 'skipped', 'reflinked', 'hardlinked' or 'copied'.
+def place_file(src, dst, mode='copy'):
+  if same_file_contents(src, dst):
+    return 'skipped'
+
+  # Build beside dst and rename over it, so readers never see a partial file
+  # and the previous dst inode (which may be shared) is never written to.
+  tmp_dst = dst+'.assembling'
+  if os.path.exists(tmp_dst):
+    os.remove(tmp_dst)
+
+  result = 'copied'
+  if mode == 'link' and reflink_file(src, tmp_dst):
+    result = 'reflinked'
+  elif mode == 'link':
+    try:
+      os.link(src, tmp_dst)
+      result = 'hardlinked'
+    except OSError:
+      shutil.copy2(src, tmp_dst)
+  else:
+    shutil.copy2(src, tmp_dst)
+
+  os.replace(tmp_dst, dst)
+  return result
+
+# Makes dst a symlink to link_target, replacing whatever is there
+def place_symlink(link_target, dst):
+  if os.path.islink(dst) and os.readlink(dst) == link_target:
+    return 'skipped'
+  tmp_dst = dst+'.assembling'
+  if os.path.lexists(tmp_dst):
+    os.remove(tmp_dst)
+  os.symlink(link_target, tmp_dst)
+  if os.path.isdir(dst) and not os.path.islink(dst):
+    shutil.rmtree(dst)
+  os.replace(tmp_dst, dst)
+  return 'symlinked'
+
+# Symlinked directories pointing within src_dir are recreated as the same
+# relative links; others (absolute, or leaving src_dir) are placed as copies
+# of the directory they point to. Symlinked files are placed as copies.
+def place_tree(src_dir, dst_dir, mode='copy'):
+  real_src_dir = os.path.realpath(src_dir)
+  for subdir, dirs, files in os.walk(src_dir):
+    rel_dir = os.path.relpath(subdir, src_dir)
+    target_dir = os.path.normpath(os.path.join(dst_dir, rel_dir))
+    os.makedirs(target_dir, exist_ok=True)
+    for f in files:
+      place_file(os.path.join(subdir, f), os.path.join(target_dir, f), mode=mode)
+    # os.walk does not descend into symlinked dirs, they would be missing from dst
+    for d in dirs:
+      src_link = os.path.join(subdir, d)
+      if not os.path.islink(src_link):
+        continue
+      link_target = os.readlink(src_link)
+      resolved = os.path.realpath(src_link)
+      if not os.path.isabs(link_target) and (resolved == real_src_dir or resolved.startswith(real_src_dir+os.sep)):
+        place_symlink(link_target, os.path.join(target_dir, d))
+      else:
+        if os.path.islink(os.path.join(target_dir, d)):
+          os.remove(os.path.join(target_dir, d))
+        place_tree(resolved, os.path.join(target_dir, d), mode=mode)
+
+# Moves every file (and symlink) under src_dir to the same place under dst_dir
+# with os.replace, then removes src_dir. A hardlinked file at the destination is
+# swapped for the new one instead of being written through.
+def replace_tree(src_dir, dst_dir):
+  for subdir, dirs, files in os.walk(src_dir):
+    target_dir = os.path.normpath(os.path.join(dst_dir, os.path.relpath(subdir, src_dir)))
+    if os.path.lexists(target_dir) and (os.path.islink(target_dir) or not os.path.isdir(target_dir)):
+      os.remove(target_dir)
+    os.makedirs(target_dir, exist_ok=True)
+    # os.walk lists symlinked dirs without descending, they move like files
+    for name in files + [d for d in dirs if os.path.islink(os.path.join(subdir, d))]:
+      dst = os.path.join(target_dir, name)
+      if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+      os.replace(os.path.join(subdir, name), dst)
+  shutil.rmtree(src_dir)
+
+# Files smaller than this are not worth the hashing
+DEDUPE_MIN_BYTES = 4096
+
+# Replaces identical files across directories (eg geoserver under every out/<target>/)
+# with reflinks or hardlinks of one copy. Returns the number of bytes no longer stored twice.
+# Only one file per inode is hashed, so files hardlinked by an earlier run cost a stat.
+def dedupe_trees(directories):
+  by_size = {}
+  for directory in directories:
+    for subdir, dirs, files in os.walk(directory):
+      for f in files:
+        path = os.path.join(subdir, f)
+        if os.path.islink(path):
+          continue
+        st = os.stat(path)
+        if st.st_size >= DEDUPE_MIN_BYTES:
+          # Hardlinks share permissions, so only files with equal modes are merged
+          by_size.setdefault((st.st_size, st.st_mode), {}).setdefault((st.st_dev, st.st_ino), []).append(path)
+
+  saved_bytes = 0
+  for (size, file_mode), by_inode in by_size.items():
+    if len(by_inode) < 2:
+      continue # one file, or every copy already shares one inode
+    by_hash = {}
+    for inode_paths in by_inode.values():
+      by_hash.setdefault(file_sha256(inode_paths[0]), []).append(inode_paths)
+    for same_inodes in by_hash.values():
+      canonical = same_inodes[0][0]
+      for inode_paths in same_inodes[1:]:
+        merged = False
+        for path in inode_paths:
+          if place_file(canonical, path+'.dedupe', mode='link') != 'copied':
+            os.replace(path+'.dedupe', path)
+            merged = True
+          else:
+            os.remove(path+'.dedupe')
+        if merged:
+          saved_bytes += size
+
+  return saved_bytes
+
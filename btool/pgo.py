@@ -0,0 +1,366 @@
+# Profile-guided optimization of the rust binaries.
+#
+#   python -m btool pgo            # profile on the host, then build every target with the profile
+#   python -m btool hostonly pgo
+#
+# 1. loci, server-webgui and desktop-cli are built for the host with
+#    -Cprofile-generate into build/pgo/target/.
+# 2. The instrumented kernel is started without a GUI, server-webgui is driven
+#    over HTTP and /ws and desktop-cli runs sql-query loops. Profiles are
+#    written in LLVM's continuous mode because the servers are stopped by signals.
+# 3. The profiles are merged with rustup's llvm-profdata and the rust tasks are
+#    rebuilt with -Cprofile-use for every enabled target which shares the host's
+#    stable toolchain (android builds with nightly and is skipped).
+#
+# The same workload is timed against the binaries in out/<host>/ before and
+# after, and the comparison is written to out/pgo-report.json.
+#
+# The profile only lives in this process's RUSTFLAGS, so build/pgo/state.json
+# records it. A later "python -m btool keep_pgo" builds with it again; a plain
+# build says once that it drops the profile (rebuilding the rust tasks without it).
+
+import os
+import json
+import time
+import glob
+import base64
+import socket
+import signal
+import struct
+import hashlib
+
+from btool import *
+from btool.buildall import buildall
+
+PGO_DIR = os.path.join('build', 'pgo')
+PGO_STATE_FILE = 'state.json'
+PGO_CRATES = [
+  # (crate dir, binary name, name under out/<target>/)
+  (j('app-kernel-desktop'), 'app-kernel-desktop', 'loci'),
+  (j('app-subprograms', 'server-webgui'), 'server-webgui', 'server-webgui'),
+  (j('app-subprograms', 'desktop-cli'), 'desktop-cli', 'desktop-cli'),
+]
+PGO_RUST_TASKS = set(['app-lib', 'app-kernel-desktop', 'server-webgui', 'desktop-cli'])
+
+PGO_PORT = 7010
+PGO_STARTUP_TIMEOUT_S = 30
+PGO_IO_TIMEOUT_S = 5
+PGO_HTTP_REQUESTS = 600
+PGO_HTTP_PATHS = ['/', '/index.html', '/app_gui.js', '/style.css', '/api/something/more-junk?a=b']
+PGO_WS_MESSAGES = 300
+PGO_CLI_QUERIES = 100
+PGO_CLI_SQL = [
+  'system SELECT * FROM processes',
+  'system SELECT * FROM properties',
+  'gui SELECT * FROM menu',
+  'translations SELECT * FROM tkeys LIMIT 200',
+]
+
+def pgo_dir(*parts):
+  return os.path.abspath(os.path.join(os.environ.get('LOCI_REPO_DIR', '.'), PGO_DIR, *parts))
+
+def host_rust_target():
+  if host_is_linux_aarch64():
+    return 'aarch64-unknown-linux-gnu', 'linux_aarch64'
+  return 'x86_64-unknown-linux-gnu', 'linux_x86_64'
+
+# Runs fn with env vars temporarily assigned
+def with_env(env, fn):
+  orig_env = {k: os.environ.get(k, None) for k in env}
+  os.environ.update(env)
+  try:
+    return fn()
+  finally:
+    for k, v in orig_env.items():
+      if v is None:
+        os.environ.pop(k, None)
+      else:
+        os.environ[k] = v
+
+def find_llvm_profdata():
+  def search():
+    sysroot = subprocess.check_output(['rustup', 'run', 'stable', 'rustc', '--print', 'sysroot']).decode('utf-8').strip()
+    found = glob.glob(j(sysroot, 'lib', 'rustlib', '*', 'bin', 'llvm-profdata*'))
+    return found[0] if len(found) > 0 else None
+  # Must match rustc's LLVM, so the rustup component is used rather than a system llvm-profdata
+  if search() is None:
+    c('rustup', 'component', 'add', 'llvm-tools-preview', '--toolchain', 'stable')
+  if search() is None:
+    die('pgo could not find llvm-profdata from the llvm-tools-preview rustup component')
+  return search()
+
+# Same toolchain and flags as the optimized build (cargo_build_cmd), into its own target dir
+def build_instrumented(triple, profiles_dir):
+  rustflags = (os.environ.get('RUSTFLAGS', '')+' -Cprofile-generate={} -Cllvm-args=-runtime-counter-relocation'.format(profiles_dir)).strip()
+  cmd = cargo_build_cmd(triple, target_dir=pgo_dir('target'))
+  for crate_dir, bin_name, out_name in PGO_CRATES:
+    with_env({'RUSTFLAGS': rustflags}, lambda: within(crate_dir, lambda: c(*cmd)))
+  return {out_name: j(pgo_dir('target'), triple, 'release', bin_name) for crate_dir, bin_name, out_name in PGO_CRATES}
+
+# Copies {out name: binary} into a fresh directory the kernel can run from
+def stage_binaries(binaries, run_dir):
+  shutil.rmtree(run_dir, ignore_errors=True)
+  os.makedirs(run_dir)
+  for out_name, src in binaries.items():
+    shutil.copy2(src, j(run_dir, out_name))
+
+def wait_for_http(deadline):
+  import http.client
+  while time.time() < deadline:
+    try:
+      conn = http.client.HTTPConnection('127.0.0.1', PGO_PORT, timeout=PGO_IO_TIMEOUT_S)
+      conn.request('GET', '/')
+      ok = conn.getresponse().status == 200
+      conn.close()
+      if ok:
+        return True
+    except (OSError, http.client.HTTPException):
+      pass
+    time.sleep(0.05)
+  return False
+
+def percentile_ms(samples_s, pct):
+  if len(samples_s) < 1:
+    return None
+  samples_s = sorted(samples_s)
+  return round(1000 * samples_s[min(len(samples_s) - 1, int(len(samples_s) * pct / 100))], 3)
+
+def http_latencies():
+  import http.client
+  latencies = []
+  conn = http.client.HTTPConnection('127.0.0.1', PGO_PORT, timeout=PGO_IO_TIMEOUT_S)
+  for i in range(PGO_HTTP_REQUESTS):
+    start = time.perf_counter()
+    conn.request('GET', PGO_HTTP_PATHS[i % len(PGO_HTTP_PATHS)])
+    conn.getresponse().read()
+    latencies.append(time.perf_counter() - start)
+  conn.close()
+  return latencies
+
+# Just enough of RFC 6455 to exchange text frames with server-webgui's echo handler
+def ws_roundtrip_latencies():
+  sock = socket.create_connection(('127.0.0.1', PGO_PORT), timeout=PGO_IO_TIMEOUT_S)
+  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  r = sock.makefile('rb')
+  try:
+    sock.sendall((
+      'GET /ws HTTP/1.1\r\nHost: 127.0.0.1:{}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+      'Sec-WebSocket-Key: {}\r\nSec-WebSocket-Version: 13\r\n\r\n'
+    ).format(PGO_PORT, base64.b64encode(os.urandom(16)).decode('ascii')).encode('ascii'))
+    if not b' 101 ' in r.readline():
+      raise Exception('server-webgui refused the /ws upgrade')
+    while not r.readline() in (b'\r\n', b''):
+      pass
+
+    latencies = []
+    for i in range(PGO_WS_MESSAGES):
+      payload = json.dumps({'pgo': i, 'text': 'x' * (i % 200)}).encode('utf-8')
+      mask = os.urandom(4)
+      # Client frames are masked; payloads here stay under 64kb
+      header = bytes([0x81, 0x80 | 126]) + struct.pack('>H', len(payload)) if len(payload) >= 126 else bytes([0x81, 0x80 | len(payload)])
+      start = time.perf_counter()
+      sock.sendall(header + mask + bytes(b ^ mask[n % 4] for n, b in enumerate(payload)))
+      while True:
+        b0, b1 = read_exact(r, 2)
+        n = b1 & 0x7f
+        if n == 126:
+          n = struct.unpack('>H', read_exact(r, 2))[0]
+        elif n == 127:
+          n = struct.unpack('>Q', read_exact(r, 8))[0]
+        read_exact(r, n)
+        if b0 & 0x0f == 0x1:
+          break
+      latencies.append(time.perf_counter() - start)
+    return latencies
+  finally:
+    r.close()
+    sock.close()
+
+def cli_query_loop(cli_exe, env):
+  lines = ['sql-query '+PGO_CLI_SQL[i % len(PGO_CLI_SQL)] for i in range(PGO_CLI_QUERIES)] + ['quit']
+  start = time.perf_counter()
+  subprocess.run([cli_exe], input=('\n'.join(lines)+'\n').encode('utf-8'), env=env,
+    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=120, check=False)
+  return time.perf_counter() - start
+
+# Starts the kernel from run_dir and drives server-webgui and desktop-cli.
+# Returns timings; app data goes to build/pgo/data/ rather than the developer's own.
+def run_workload(run_dir, label):
+  env = dict(os.environ)
+  env['RUN_WITHOUT_GUI'] = '1'
+  env['XDG_DATA_HOME'] = pgo_dir('data')
+  os.makedirs(env['XDG_DATA_HOME'], exist_ok=True)
+
+  print('Running pgo workload against {} ({})'.format(run_dir, label), flush=True)
+  with open(pgo_dir(label+'.log'), 'wb') as log_fd:
+    start = time.perf_counter()
+    # Own process group so server-webgui (a child of the kernel) is stopped with it
+    kernel = subprocess.Popen([j(run_dir, 'loci')], cwd=run_dir, env=env, stdout=log_fd, stderr=subprocess.STDOUT, start_new_session=True)
+    try:
+      if not wait_for_http(time.time() + PGO_STARTUP_TIMEOUT_S):
+        raise Exception('server-webgui did not answer on port {} within {}s, see {}'.format(PGO_PORT, PGO_STARTUP_TIMEOUT_S, pgo_dir(label+'.log')))
+      startup_s = time.perf_counter() - start
+      http_s = http_latencies()
+      ws_s = ws_roundtrip_latencies()
+      cli_s = cli_query_loop(j(run_dir, 'desktop-cli'), env)
+    finally:
+      try:
+        os.killpg(kernel.pid, signal.SIGTERM)
+        kernel.wait(timeout=10)
+      except subprocess.TimeoutExpired:
+        os.killpg(kernel.pid, signal.SIGKILL)
+        kernel.wait()
+      except ProcessLookupError:
+        pass
+
+  return {
+    'startup_s': round(startup_s, 3),
+    'http_p50_ms': percentile_ms(http_s, 50),
+    'http_p95_ms': percentile_ms(http_s, 95),
+    'ws_p50_ms': percentile_ms(ws_s, 50),
+    'ws_p95_ms': percentile_ms(ws_s, 95),
+    'cli_queries_s': round(cli_s, 3),
+  }
+
+def merge_profiles(profiles_dir):
+  profraw_files = sorted(glob.glob(j(profiles_dir, '*.profraw')))
+  if len(profraw_files) < 1:
+    die('pgo workload wrote no profiles to {}'.format(profiles_dir))
+  merged_file = pgo_dir('merged.profdata')
+  c(find_llvm_profdata(), 'merge', '-o', merged_file, *profraw_files)
+
+  # Named by content so RUSTFLAGS, and with it every rust task's fingerprint, changes with the profile
+  h = hashlib.sha256()
+  with open(merged_file, 'rb') as fd:
+    for chunk in iter(lambda: fd.read(1024 * 1024), b''):
+      h.update(chunk)
+  profile_file = pgo_dir('loci-{}.profdata'.format(h.hexdigest()[:12]))
+  for old in glob.glob(pgo_dir('loci-*.profdata')):
+    if old != profile_file:
+      os.remove(old)
+  os.replace(merged_file, profile_file)
+  return profile_file, len(profraw_files)
+
+def out_binaries(target_name):
+  binaries = {out_name: j('out', target_name, out_name) for crate_dir, bin_name, out_name in PGO_CRATES}
+  if all(e(f) for f in binaries.values()):
+    return binaries
+  return None
+
+def read_pgo_state():
+  try:
+    with open(pgo_dir(PGO_STATE_FILE), 'r') as fd:
+      return json.load(fd)
+  except (OSError, ValueError):
+    return None
+
+def write_pgo_state(state):
+  with open(pgo_dir(PGO_STATE_FILE+'.tmp'), 'w') as fd:
+    json.dump(state, fd, indent=2)
+  os.replace(pgo_dir(PGO_STATE_FILE+'.tmp'), pgo_dir(PGO_STATE_FILE))
+
+def profile_use_flag(profile_file):
+  return '-Cprofile-use={}'.format(profile_file)
+
+# Called before builds other than "pgo": with keep_pgo the last profile goes
+# back into RUSTFLAGS, otherwise the first build after "pgo" says it drops it.
+# Returns args, minus remote_workers= when the profile is kept.
+def apply_pgo_state(args):
+  state = read_pgo_state()
+  if state is None or not os.path.exists(state['profile_file']):
+    if 'keep_pgo' in args:
+      die('keep_pgo needs a profile, run "python -m btool pgo" first')
+    return args
+
+  if not 'keep_pgo' in args:
+    if not state.get('dropped', False):
+      print('WARNING: building without the PGO profile {} from "python -m btool pgo", the rust tasks rebuild unoptimized. Pass keep_pgo to build with it.'.format(state['profile_file']))
+      state['dropped'] = True
+      write_pgo_state(state)
+    return args
+
+  print('Building with the PGO profile {} (keep_pgo)'.format(state['profile_file']))
+  state['dropped'] = False
+  write_pgo_state(state)
+  if flag_set('build_android'):
+    print('Skipping android, it builds with the nightly toolchain')
+    os.environ.pop(flag_name('build_android'))
+  os.environ['RUSTFLAGS'] = (os.environ.get('RUSTFLAGS', '')+' '+profile_use_flag(state['profile_file'])).strip()
+  # Workers would not find the profile file
+  return [a for a in args if not a.startswith('remote_workers=')]
+
+def print_comparison(before, after):
+  print('')
+  print('{:<16} {:>12} {:>12} {:>9}'.format('', 'before', 'after', 'change'))
+  for metric in after:
+    if before is None or before.get(metric, None) is None or after[metric] is None:
+      print('{:<16} {:>12} {:>12}'.format(metric, '-', after[metric]))
+      continue
+    change = 100 * (after[metric] - before[metric]) / before[metric] if before[metric] > 0 else 0
+    print('{:<16} {:>12} {:>12} {:>8.1f}%'.format(metric, before[metric], after[metric], change))
+
+def pgo_build(args):
+  if not host_is_linux():
+    die('pgo builds are only supported on linux hosts')
+
+  triple, target_name = host_rust_target()
+  profiles_dir = pgo_dir('profiles')
+  shutil.rmtree(profiles_dir, ignore_errors=True)
+  os.makedirs(profiles_dir)
+  shutil.rmtree(pgo_dir('data'), ignore_errors=True)
+
+  print('PGO phase 1: instrumented build for {}'.format(triple), flush=True)
+  with trace_span('pgo instrumented build', 'build'):
+    instrumented = build_instrumented(triple, profiles_dir)
+  stage_binaries(instrumented, pgo_dir('run-instrumented'))
+
+  print('PGO phase 2: profiling workload', flush=True)
+  with trace_span('pgo workload', 'build'):
+    with_env(
+      {'LLVM_PROFILE_FILE': j(profiles_dir, '%m-%p%c.profraw')},
+      lambda: run_workload(pgo_dir('run-instrumented'), 'instrumented'),
+    )
+  profile_file, profraw_count = merge_profiles(profiles_dir)
+  print('Merged {} profiles into {}'.format(profraw_count, profile_file))
+
+  before = None
+  if out_binaries(target_name) is not None:
+    stage_binaries(out_binaries(target_name), pgo_dir('run-before'))
+    before = run_workload(pgo_dir('run-before'), 'before')
+
+  if flag_set('build_android'):
+    # The nightly toolchain's LLVM may not read profiles written by the stable one
+    print('Skipping android, it builds with the nightly toolchain')
+    os.environ.pop(flag_name('build_android'))
+  print('PGO phase 3: optimized build of {}'.format(', '.join(enabled_targets())), flush=True)
+  os.environ['RUSTFLAGS'] = (os.environ.get('RUSTFLAGS', '')+' '+profile_use_flag(profile_file)).strip()
+  # Workers would not find the profile file
+  buildall([a for a in args if not a.startswith('remote_workers=')], only_tasks=PGO_RUST_TASKS)
+  write_pgo_state({
+    'generated_epoch_s': int(time.time()),
+    'profile_file': profile_file,
+    'profiled_target': triple,
+    'optimized_targets': enabled_targets(),
+    'dropped': False,
+  })
+
+  after = None
+  if out_binaries(target_name) is not None:
+    stage_binaries(out_binaries(target_name), pgo_dir('run-after'))
+    after = run_workload(pgo_dir('run-after'), 'after')
+    print_comparison(before, after)
+
+  report_file = j('out', 'pgo-report.json')
+  os.makedirs(os.path.dirname(report_file), exist_ok=True)
+  with open(report_file, 'w') as fd:
+    json.dump({
+      'generated_epoch_s': int(time.time()),
+      'profiled_target': triple,
+      'optimized_targets': enabled_targets(),
+      'profile_file': profile_file,
+      'profraw_files': profraw_count,
+      'before': before,
+      'after': after,
+    }, fd, indent=2)
+  print('')
+  print('Wrote {}'.format(report_file))
@@ -0,0 +1,358 @@
+# Runs build tasks on remote workers.
+#
+# On each build host (from a loci checkout):
+#   LOCI_REMOTE_TOKEN=<secret> python -m btool worker port=7300 [bind=0.0.0.0]
+# and on the machine driving the build:
+#   LOCI_REMOTE_TOKEN=<secret> python -m btool remote_workers=buildhost1:7300,ssh:me@buildhost2:/home/me/loci
+#
+# A task is shipped as a snapshot of the source tree (git tracked and untracked,
+# not ignored files) plus the outputs of the tasks it depends on. The worker
+# unpacks it into a persistent workspace, so toolchains, fingerprints,
+# downloads and cargo target dirs stay warm between tasks, removes source files
+# the previous snapshot shipped but this one does not (deleted or renamed since)
+# and builds it with "python -m btool only_tasks=<key> targets=...". Output
+# lines stream back as they are printed, followed by an archive of the task's
+# outputs(...). A client which disconnects mid-task has its build killed.
+# Host specific paths (CC, CARGO_TARGET_DIR) are resolved by the worker's own
+# toolchain setup rather than taken from the client.
+#
+# Workers are spoken to over TCP, or over ssh where "python -m btool worker stdio"
+# speaks the same protocol on stdin/stdout. A task runs arbitrary commands, so
+# TCP workers listen on 127.0.0.1 unless given bind=, and refuse to start
+# without LOCI_REMOTE_TOKEN; clients must send the same token before anything
+# else is read. ssh workers rely on ssh's authentication instead.
+# Transport failures are retried on the next worker, and a task which cannot
+# be built remotely is built locally.
+
+import os
+import sys
+import hmac
+import json
+import time
+import shutil
+import signal
+import struct
+import socket
+import tarfile
+import tempfile
+import threading
+import subprocess
+
+from btool.artifactcache import pack_outputs, unpack_outputs
+
+REMOTE_WORKER_PORT = 7300
+REMOTE_WORKER_BIND = '127.0.0.1'
+REMOTE_TOKEN_ENV_VAR = 'LOCI_REMOTE_TOKEN'
+# Read before the token is checked, so kept small
+MAX_HEADER_BYTES = 64 * 1024
+REMOTE_WORKSPACE = os.path.join('build', 'remote-workspace')
+# Attempts per task, each on the next worker
+REMOTE_ATTEMPTS = 3
+REMOTE_CONNECT_TIMEOUT_S = 10
+FRAME_BYTES = 1024 * 1024
+
+# Flags forwarded to the worker's "python -m btool", targets are sent explicitly
+REMOTE_PASSTHROUGH_ARGS = ['debug', 'parallel_targets', 'shared_cargo_target', 'link_assembly', 'split_debuginfo', 'force_code_rebuilds']
+# Paths on the client's disk, never forwarded: the worker's download_tools() sets its own
+REMOTE_HOST_ENV_VARS = ['CC', 'CARGO_TARGET_DIR']
+# Worker state kept in the workspace between tasks even though no snapshot contains it
+REMOTE_KEPT_DIR_NAMES = ['build', 'out', 'target', 'bin', 'obj', '.gradle', 'node_modules']
+# Gitignored downloads and generated files under source dirs, never pruned either
+REMOTE_KEPT_PATHS = [
+  os.path.join('app-subprograms', 'server-webgui', 'www', 'lib'),
+  os.path.join('app-subprograms', 'server-webgui', 'www', 'gen'),
+]
+# The last snapshot's file list, the only files pruning may remove
+REMOTE_MANIFEST_FILE = os.path.join('build', 'remote-snapshot-files.json')
+
+# Frames are a 1 byte kind, 4 byte big-endian length and the payload:
+#   H header json, S snapshot bytes, E end of snapshot with the snapshot's file list json  (client -> worker)
+#   K header accepted, L log bytes, A output archive bytes, X result json                 (worker -> client)
+# The client waits for K (or an X carrying an error) before sending the snapshot.
+def send_frame(w, kind, payload=b''):
+  w.write(kind + struct.pack('>I', len(payload)) + payload)
+  w.flush()
+
+def read_exact(r, n):
+  buff = b''
+  while len(buff) < n:
+    chunk = r.read(n - len(buff))
+    if not chunk:
+      raise EOFError('Connection closed mid-frame')
+    buff += chunk
+  return buff
+
+def recv_frame(r, max_bytes=None):
+  header = read_exact(r, 5)
+  n = struct.unpack('>I', header[1:])[0]
+  if max_bytes is not None and n > max_bytes:
+    raise Exception('Frame of {} bytes is larger than the {} allowed'.format(n, max_bytes))
+  return header[:1], read_exact(r, n)
+
+def send_file_frames(w, kind, path):
+  with open(path, 'rb') as fd:
+    while True:
+      chunk = fd.read(FRAME_BYTES)
+      if not chunk:
+        break
+      send_frame(w, kind, chunk)
+
+def safe_extract(tar_file, dst_dir):
+  with tarfile.open(tar_file, 'r|gz') as tar:
+    for member in tar:
+      name = os.path.normpath(member.name)
+      if os.path.isabs(name) or name.startswith('..') or member.issym() or member.islnk():
+        raise Exception('Refusing snapshot member {}'.format(member.name))
+      tar.extract(member, path=dst_dir)
+
+def pruning_kept(rel_path):
+  parts = rel_path.split(os.sep)
+  if any(p in REMOTE_KEPT_DIR_NAMES for p in parts[:-1]):
+    return True
+  return any(rel_path == k or rel_path.startswith(k+os.sep) for k in REMOTE_KEPT_PATHS)
+
+# Removes files the previous snapshot shipped which are not in manifest (and then
+# directories left empty), then records manifest for the next task. Anything the
+# worker's own builds created, downloads included, is never in a snapshot and stays.
+def prune_workspace(workspace, manifest):
+  manifest_file = os.path.join(workspace, REMOTE_MANIFEST_FILE)
+  previous = []
+  if os.path.exists(manifest_file):
+    with open(manifest_file, 'r') as fd:
+      previous = json.load(fd)
+  keep = set(os.path.normpath(p) for p in manifest)
+  for rel_path in sorted(set(os.path.normpath(p) for p in previous) - keep):
+    if os.path.isabs(rel_path) or rel_path.startswith('..') or pruning_kept(rel_path):
+      continue
+    path = os.path.join(workspace, rel_path)
+    if os.path.islink(path) or os.path.isfile(path):
+      os.remove(path)
+    parent = os.path.dirname(rel_path)
+    while parent != '' and os.path.isdir(os.path.join(workspace, parent)) and len(os.listdir(os.path.join(workspace, parent))) < 1:
+      os.rmdir(os.path.join(workspace, parent))
+      parent = os.path.dirname(parent)
+
+  os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+  with open(manifest_file+'.tmp', 'w') as fd:
+    json.dump(sorted(keep), fd)
+  os.replace(manifest_file+'.tmp', manifest_file)
+
+# Kills the task's btool and everything it started (cargo, rustc, compilers)
+def kill_task_process(proc):
+  try:
+    os.killpg(proc.pid, signal.SIGKILL)
+  except ProcessLookupError:
+    pass
+  proc.wait()
+
+# The client sends nothing after the snapshot, so a read returning means it went away
+def kill_task_on_disconnect(r, proc):
+  try:
+    r.read(1)
+  except (OSError, ValueError):
+    pass
+  if proc.poll() is None:
+    print('Client disconnected, killing its task', file=sys.stderr, flush=True)
+    kill_task_process(proc)
+
+# Worker side: serves one task request read from r, writing frames to w.
+# With a token set the header must carry the same token, else nothing more is read.
+def serve_task(r, w, workspace, token=None):
+  kind, payload = recv_frame(r, max_bytes=MAX_HEADER_BYTES)
+  if kind != b'H':
+    raise Exception('Expected a task header, got frame {}'.format(kind))
+  header = json.loads(payload.decode('utf-8'))
+  if token is not None and not hmac.compare_digest(str(header.get('token', '')).encode('utf-8'), token.encode('utf-8')):
+    send_frame(w, b'X', json.dumps({'error': 'worker rejected the {} token'.format(REMOTE_TOKEN_ENV_VAR)}).encode('utf-8'))
+    raise Exception('Rejected a task with a wrong or missing token')
+  send_frame(w, b'K')
+
+  os.makedirs(workspace, exist_ok=True)
+  with tempfile.TemporaryDirectory(prefix='btool-worker-') as tmp_dir:
+    snapshot_file = os.path.join(tmp_dir, 'snapshot.tar.gz')
+    with open(snapshot_file, 'wb') as fd:
+      while True:
+        kind, payload = recv_frame(r)
+        if kind == b'E':
+          manifest = json.loads(payload.decode('utf-8'))
+          break
+        fd.write(payload)
+    prune_workspace(workspace, manifest)
+    safe_extract(snapshot_file, workspace)
+
+    env = dict(os.environ)
+    env.update({k: v for k, v in header['env'].items() if not k in REMOTE_HOST_ENV_VARS})
+    # The snapshot's own btool must build the task, not one found on the worker's PYTHONPATH
+    env.pop('PYTHONPATH', None)
+    cmd = [sys.executable, '-m', 'btool', 'nodaemon', 'nobrowser', 'only_tasks='+header['task']] + header['args']
+    start = time.time()
+    # Own process group, so a disconnect kills the whole build and not just btool
+    proc = subprocess.Popen(cmd, cwd=workspace, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+    threading.Thread(target=kill_task_on_disconnect, args=(r, proc), daemon=True).start()
+    try:
+      while True:
+        chunk = proc.stdout.read1(64 * 1024)
+        if not chunk:
+          break
+        send_frame(w, b'L', chunk)
+    except OSError:
+      # EPIPE or a reset: nobody is left to collect the outputs
+      kill_task_process(proc)
+      raise
+    code = proc.wait()
+
+    if code == 0:
+      archive_file = os.path.join(tmp_dir, 'outputs.tar.gz')
+      cwd = os.getcwd()
+      os.chdir(workspace)
+      try:
+        pack_outputs(header['outputs'], archive_file)
+      finally:
+        os.chdir(cwd)
+      send_file_frames(w, b'A', archive_file)
+
+  send_frame(w, b'X', json.dumps({'exit_code': code, 'duration_s': round(time.time() - start, 2), 'host': socket.gethostname()}).encode('utf-8'))
+
+# python -m btool worker port=7300 [bind=0.0.0.0] [workspace=dir], with LOCI_REMOTE_TOKEN set
+def serve_tcp_worker(port, workspace, bind_host=REMOTE_WORKER_BIND):
+  token = os.environ.get(REMOTE_TOKEN_ENV_VAR, '')
+  if len(token) < 1:
+    raise Exception('Set {} to a shared secret before starting a TCP worker, clients must send the same one'.format(REMOTE_TOKEN_ENV_VAR))
+  server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  server.bind((bind_host, port))
+  server.listen(16)
+  print('btool worker listening on {}:{}, workspace {}'.format(bind_host, port, workspace), flush=True)
+  serve_tcp_connections(server, workspace, token)
+
+def serve_tcp_connections(server, workspace, token):
+  # One task at a time, they share the workspace
+  while True:
+    conn, addr = server.accept()
+    with conn:
+      start = time.time()
+      try:
+        with conn.makefile('rb') as r, conn.makefile('wb') as w:
+          serve_task(r, w, workspace, token=token)
+        print('Served task for {} in {:.1f}s'.format(addr[0], time.time() - start), flush=True)
+      except Exception as e:
+        print('Task from {} failed: {}'.format(addr[0], e), flush=True)
+
+# python -m btool worker stdio, started by the client over ssh
+def serve_stdio_worker(workspace):
+  # Frames own the real stdout, stray prints go to stderr
+  w = os.fdopen(os.dup(1), 'wb')
+  os.dup2(2, 1)
+  r = os.fdopen(os.dup(0), 'rb')
+  serve_task(r, w, workspace)
+  w.close()
+
+def git_snapshot_files():
+  out = subprocess.check_output(['git', 'ls-files', '-z', '--cached', '--others', '--exclude-standard'])
+  return [f for f in out.decode('utf-8').split('\0') if len(f) > 0 and os.path.isfile(f)]
+
+# Source tree plus dependency outputs (minus cargo's rebuildable target/ dirs).
+# Returns the paths in the snapshot, which the worker prunes its workspace to.
+def make_snapshot(snapshot_file, dep_outputs):
+  with tarfile.open(snapshot_file, 'w:gz', compresslevel=3) as tar:
+    for f in git_snapshot_files():
+      tar.add(f, recursive=False)
+    for o in dep_outputs:
+      if os.path.exists(o) and not 'target' in os.path.normpath(o).split(os.sep):
+        tar.add(o, arcname=os.path.relpath(o))
+    return tar.getnames()
+
+class RemoteExecutor():
+  # workers: 'host:port' or 'ssh:user@host:/path/to/loci' strings.
+  # token is sent to TCP workers, by default from LOCI_REMOTE_TOKEN.
+  def __init__(self, workers, remote_args, remote_env, task_keys=None, token=None):
+    self.workers = list(workers)
+    self.remote_args = list(remote_args)
+    self.remote_env = {k: v for k, v in remote_env.items() if not k in REMOTE_HOST_ENV_VARS}
+    self.task_keys = task_keys
+    self.token = token if token is not None else os.environ.get(REMOTE_TOKEN_ENV_VAR, '')
+
+  # Downloads stay local, code tasks (those with inputs) are shipped unless remote_tasks= picks them
+  def wants(self, task):
+    if len(self.workers) < 1:
+      return False
+    if self.task_keys is not None:
+      return task['key'] in self.task_keys
+    return len(task['inputs']) > 0
+
+  def open_transport(self, worker):
+    if worker.startswith('ssh:'):
+      destination, _, remote_dir = worker[len('ssh:'):].partition(':')
+      remote_cmd = 'cd {} && python3 -m btool worker stdio'.format(remote_dir or 'loci')
+      proc = subprocess.Popen(['ssh', '-o', 'BatchMode=yes', destination, remote_cmd], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+      def close():
+        proc.stdin.close()
+        proc.stdout.close()
+        proc.wait()
+      return proc.stdout, proc.stdin, close
+    host, _, port = worker.rpartition(':')
+    conn = socket.create_connection((host, int(port or REMOTE_WORKER_PORT)), timeout=REMOTE_CONNECT_TIMEOUT_S)
+    conn.settimeout(None)
+    r = conn.makefile('rb')
+    w = conn.makefile('wb')
+    def close():
+      r.close()
+      w.close()
+      conn.close()
+    return r, w, close
+
+  # Returns the worker's result dict (exit_code 0 means outputs were unpacked locally).
+  # Raises on transport failures so the caller can retry elsewhere.
+  def run_on(self, worker, task, snapshot_file, manifest, log):
+    r, w, close = self.open_transport(worker)
+    try:
+      send_frame(w, b'H', json.dumps({
+        'task': task['key'],
+        'token': '' if worker.startswith('ssh:') else self.token,
+        'args': self.remote_args,
+        'env': self.remote_env,
+        'outputs': [os.path.relpath(o) for o in task['outputs']],
+      }).encode('utf-8'))
+      kind, payload = recv_frame(r)
+      if kind == b'X':
+        raise Exception(json.loads(payload.decode('utf-8'))['error'])
+      send_file_frames(w, b'S', snapshot_file)
+      send_frame(w, b'E', json.dumps(manifest).encode('utf-8'))
+
+      with tempfile.TemporaryDirectory(prefix='btool-remote-') as tmp_dir:
+        archive_file = os.path.join(tmp_dir, 'outputs.tar.gz')
+        with open(archive_file, 'wb') as archive_fd:
+          while True:
+            kind, payload = recv_frame(r)
+            if kind == b'L':
+              log.write(payload.decode('utf-8', errors='replace'))
+            elif kind == b'A':
+              archive_fd.write(payload)
+            elif kind == b'X':
+              result = json.loads(payload.decode('utf-8'))
+              break
+        if result['exit_code'] == 0:
+          unpack_outputs(archive_file, task['outputs'])
+        return result
+    finally:
+      close()
+
+  # Returns True when the task was built remotely, False to build it locally instead
+  def run(self, task, dep_outputs, log, first_worker=0):
+    with tempfile.TemporaryDirectory(prefix='btool-snapshot-') as tmp_dir:
+      snapshot_file = os.path.join(tmp_dir, 'snapshot.tar.gz')
+      manifest = make_snapshot(snapshot_file, dep_outputs)
+      for attempt in range(REMOTE_ATTEMPTS):
+        worker = self.workers[(first_worker + attempt) % len(self.workers)]
+        try:
+          result = self.run_on(worker, task, snapshot_file, manifest, log)
+        except Exception as e:
+          log.write('\nRemote worker {} failed ({}), trying the next one\n'.format(worker, e))
+          continue
+        if result['exit_code'] == 0:
+          log.write('\nBuilt on {} ({}) in {}s\n'.format(worker, result['host'], result['duration_s']))
+          return True
+        # The build itself failed; building locally shows (or rules out) a worker problem
+        log.write('\nTask failed on {} with exit code {}\n'.format(worker, result['exit_code']))
+        return False
+      return False
@@ -0,0 +1,146 @@
+# Resource accounting for subprocesses spawned by btool.
+#
+# Every command run through c()/c_targets() records user+system CPU time and
+# peak RSS (from os.wait4, which includes the command's own reaped children
+# such as rustc under cargo) plus read/write bytes from /proc/<pid>/io.
+# Records are appended as json lines by whichever process ran the command and
+# write_build_report() rolls them up per task and target into out/build-report.json.
+
+import os
+import json
+import time
+
+USAGE_LOG = os.path.join('build', 'resource-usage.jsonl')
+
+# Set by silenced_task/noisy_task so commands know which task they belong to
+_current_task = None
+
+def set_current_task(task_name):
+  global _current_task
+  _current_task = task_name
+
+# Maps cargo --target triples, dotnet -r runtime ids and gradle to out/<target> names
+TARGET_NAMES = {
+  'x86_64-pc-windows-gnu': 'win64',
+  'x86_64-unknown-linux-gnu': 'linux_x86_64',
+  'aarch64-unknown-linux-gnu': 'linux_aarch64',
+  'aarch64-linux-android': 'android',
+  'win10-x64': 'win64',
+  'linux-x64': 'linux_x86_64',
+  'linux-arm64': 'linux_aarch64',
+}
+
+def cmd_target(cmd):
+  for i, arg in enumerate(cmd[:-1]):
+    if arg in ('--target', '-r') and cmd[i+1] in TARGET_NAMES:
+      return TARGET_NAMES[cmd[i+1]]
+  if len(cmd) > 0 and os.path.basename(cmd[0]).startswith('gradle'):
+    return 'android'
+  return 'all'
+
+def usage_log_file():
+  return os.path.abspath(os.path.join(os.environ.get('LOCI_REPO_DIR', '.'), USAGE_LOG))
+
+def read_proc_io(pid):
+  io_counters = {}
+  try:
+    with open('/proc/{}/io'.format(pid), 'r') as fd:
+      for line in fd:
+        key, value = line.split(':', 1)
+        io_counters[key.strip()] = int(value.strip())
+  except (OSError, ValueError):
+    return None
+  return io_counters
+
+# Waits for a subprocess.Popen and returns (exit_code, usage dict or None).
+# /proc/<pid>/io is read while the child is a zombie (waitid + WNOWAIT),
+# then os.wait4 reaps it and reports its rusage.
+def wait_measured(proc):
+  if not hasattr(os, 'wait4') or not hasattr(os, 'waitid'):
+    return proc.wait(), None
+
+  os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+  io_counters = read_proc_io(proc.pid)
+  pid, status, rusage = os.wait4(proc.pid, 0)
+  proc.returncode = os.waitstatus_to_exitcode(status)
+
+  usage = {
+    'user_s': round(rusage.ru_utime, 3),
+    'sys_s': round(rusage.ru_stime, 3),
+    'max_rss_kb': rusage.ru_maxrss, # kilobytes on linux
+  }
+  if io_counters is not None:
+    usage['read_bytes'] = io_counters.get('read_bytes', 0)
+    usage['write_bytes'] = io_counters.get('write_bytes', 0)
+  return proc.returncode, usage
+
+def record_usage(record):
+  os.makedirs(os.path.dirname(usage_log_file()), exist_ok=True)
+  with open(usage_log_file(), 'a') as fd:
+    fd.write(json.dumps(record)+'\n')
+
+def record_cmd_usage(cmd, exit_code, wall_s, usage):
+  record = {
+    'kind': 'cmd',
+    'task': _current_task,
+    'target': cmd_target(cmd),
+    'cmd': list(cmd),
+    'exit_code': exit_code,
+    'wall_s': round(wall_s, 3),
+  }
+  if usage is not None:
+    record.update(usage)
+  record_usage(record)
+
+def record_task_usage(task_name, wall_s, skipped, error=False):
+  record_usage({'kind': 'task', 'task': task_name, 'wall_s': round(wall_s, 3), 'skipped': skipped, 'error': error})
+
+def reset_usage_log():
+  if os.path.exists(usage_log_file()):
+    os.remove(usage_log_file())
+
+def read_usage_log():
+  records = []
+  if os.path.exists(usage_log_file()):
+    with open(usage_log_file(), 'r') as fd:
+      for line in fd:
+        try:
+          records.append(json.loads(line))
+        except ValueError:
+          continue
+  return records
+
+def write_build_report(report_file, build_duration_s):
+  records = read_usage_log()
+  tasks = {}
+
+  for r in records:
+    task_name = r['task'] or '(no task)'
+    task = tasks.setdefault(task_name, {'wall_s': 0, 'skipped': False, 'error': False, 'targets': {}})
+    if r['kind'] == 'task':
+      task['wall_s'] = r['wall_s']
+      task['skipped'] = r['skipped']
+      task['error'] = r['error']
+      continue
+
+    target = task['targets'].setdefault(r['target'], {
+      'commands': 0, 'wall_s': 0, 'user_s': 0, 'sys_s': 0, 'max_rss_kb': 0, 'read_bytes': 0, 'write_bytes': 0,
+    })
+    target['commands'] += 1
+    for key in ['wall_s', 'user_s', 'sys_s', 'read_bytes', 'write_bytes']:
+      target[key] = round(target[key] + r.get(key, 0), 3)
+    target['max_rss_kb'] = max(target['max_rss_kb'], r.get('max_rss_kb', 0))
+
+  report = {
+    'generated_epoch_s': int(time.time()),
+    'build_duration_s': build_duration_s,
+    'peak_rss_kb': max([r.get('max_rss_kb', 0) for r in records if r['kind'] == 'cmd'] + [0]),
+    'tasks': tasks,
+    'commands': [r for r in records if r['kind'] == 'cmd'],
+  }
+
+  os.makedirs(os.path.dirname(os.path.abspath(report_file)), exist_ok=True)
+  with open(report_file, 'w') as fd:
+    json.dump(report, fd, indent=2)
+  return report
+
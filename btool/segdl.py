@@ -0,0 +1,183 @@
+# Resumable, multi-connection downloader for very large files
+# (the OSM planet file, SDK archives).
+#
+# The file is split into HTTP Range segments fetched concurrently into
+# <dst>.part, and a json journal <dst>.journal records how many bytes
+# of each segment are safely on disk. After a crash or ctrl+c the next
+# call resumes every segment where it stopped.
+# Servers without Range support (or which answer a Range request with the
+# whole file) fall back to a single stream.
+
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+# urllib.request (http.client, email, ssl) is imported where used, it dominates btool's import time
+import concurrent.futures
+
+CHUNK_BYTES = 1024 * 1024
+# Segments are fsync'ed and journaled after this many new bytes
+JOURNAL_EVERY_BYTES = 16 * 1024 * 1024
+# Files smaller than this are not worth splitting
+MIN_SEGMENT_BYTES = 8 * 1024 * 1024
+SEGMENT_RETRIES = 5
+HTTP_TIMEOUT_S = 30
+
+def hash_file_sha256(path):
+  h = hashlib.sha256()
+  with open(path, 'rb') as fd:
+    while True:
+      chunk = fd.read(CHUNK_BYTES)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.hexdigest()
+
+# Returns (final url after redirects, size or None, supports ranges, validator)
+def probe_url(url):
+  import urllib.request
+  req = urllib.request.Request(url, method='HEAD')
+  with urllib.request.urlopen(req, timeout=HTTP_TIMEOUT_S) as r:
+    size = r.headers.get('Content-Length', None)
+    accepts_ranges = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    validator = r.headers.get('ETag', None) or r.headers.get('Last-Modified', None) or ''
+    return r.geturl(), (int(size) if size is not None else None), accepts_ranges, validator
+
+def single_stream_download(url, part_file):
+  import urllib.request
+  with urllib.request.urlopen(url, timeout=HTTP_TIMEOUT_S) as response:
+    with open(part_file, 'wb') as fd:
+      while True:
+        chunk = response.read(CHUNK_BYTES)
+        if not chunk:
+          break
+        fd.write(chunk)
+
+def read_journal(journal_file):
+  try:
+    with open(journal_file, 'r') as fd:
+      return json.load(fd)
+  except:
+    return None
+
+def write_journal(journal_file, journal):
+  with open(journal_file+'.tmp', 'w') as fd:
+    json.dump(journal, fd)
+  os.replace(journal_file+'.tmp', journal_file)
+
+# Downloads url to dst_file using up to `segments` concurrent Range requests.
+# When sha256 is given the finished file must match it.
+# Returns the sha256 hex digest of dst_file if sha256 or hash_result are set, else None.
+def segmented_download(url, dst_file, segments=8, sha256=None, hash_result=False, show_progress=False):
+  part_file = dst_file+'.part'
+  journal_file = dst_file+'.journal'
+
+  try:
+    final_url, size, accepts_ranges, validator = probe_url(url)
+  except Exception as e:
+    # Some servers refuse HEAD requests, a plain GET still works
+    final_url, size, accepts_ranges, validator = url, None, False, ''
+
+  if size is None or not accepts_ranges or size < MIN_SEGMENT_BYTES:
+    single_stream_download(final_url, part_file)
+
+  else:
+    journal = read_journal(journal_file)
+    if journal is None or journal['url'] != url or journal['size'] != size or journal['validator'] != validator or not os.path.exists(part_file):
+      # Fresh start: pre-size the .part file and split it into [start, end, done_bytes] segments (end inclusive)
+      segments = max(1, min(segments, size // MIN_SEGMENT_BYTES))
+      segment_len = size // segments
+      journal = {'url': url, 'size': size, 'validator': validator, 'segments': []}
+      for i in range(segments):
+        start = i * segment_len
+        end = size - 1 if i == segments - 1 else start + segment_len - 1
+        journal['segments'].append([start, end, 0])
+      with open(part_file, 'wb') as fd:
+        fd.truncate(size)
+      write_journal(journal_file, journal)
+    else:
+      print('Resuming download of {} ({:,} of {:,} bytes done)'.format(url, sum(s[2] for s in journal['segments']), size))
+
+    journal_lock = threading.Lock()
+    # Set when the server answers a Range request with the whole file
+    range_ignored = threading.Event()
+
+    def save_progress(i, done):
+      with journal_lock:
+        journal['segments'][i][2] = done
+        write_journal(journal_file, journal)
+
+    def fetch_segment(i):
+      import urllib.request
+      last_error = None
+      for attempt in range(SEGMENT_RETRIES):
+        start, end, done = journal['segments'][i]
+        if start + done > end:
+          return
+        try:
+          req = urllib.request.Request(final_url, headers={'Range': 'bytes={}-{}'.format(start + done, end)})
+          with urllib.request.urlopen(req, timeout=HTTP_TIMEOUT_S) as r:
+            if r.status != 206:
+              range_ignored.set()
+              return
+            with open(part_file, 'r+b') as fd:
+              fd.seek(start + done)
+              unsynced = 0
+              while start + done <= end:
+                chunk = r.read(min(CHUNK_BYTES, end - (start + done) + 1))
+                if not chunk:
+                  break
+                fd.write(chunk)
+                done += len(chunk)
+                unsynced += len(chunk)
+                if unsynced >= JOURNAL_EVERY_BYTES:
+                  fd.flush()
+                  os.fsync(fd.fileno())
+                  save_progress(i, done)
+                  unsynced = 0
+              fd.flush()
+              os.fsync(fd.fileno())
+          save_progress(i, done)
+          if start + done > end:
+            return
+          last_error = 'connection closed at byte {} of {}'.format(start + done, end + 1)
+        except Exception as e:
+          last_error = e
+          time.sleep(1 + attempt)
+      raise Exception('Segment {} of {} failed after {} attempts: {}'.format(i, url, SEGMENT_RETRIES, last_error))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(journal['segments'])) as pool:
+      futures = [pool.submit(fetch_segment, i) for i in range(len(journal['segments']))]
+      not_done = futures
+      while len(not_done) > 0:
+        done_futures, not_done = concurrent.futures.wait(not_done, timeout=10)
+        if show_progress:
+          done_bytes = sum(s[2] for s in journal['segments'])
+          print('  {:.1f}% of {:,}mb'.format(100.0 * done_bytes / size, int(size / (1000*1000))), flush=True)
+      errors = [f.exception() for f in futures if f.exception() is not None]
+      if len(errors) > 0 and not range_ignored.is_set():
+        # .part and journal stay behind so the next call resumes
+        raise errors[0]
+
+    if range_ignored.is_set():
+      print('{} ignored Range requests, downloading it as a single stream'.format(final_url))
+      os.remove(journal_file)
+      single_stream_download(final_url, part_file)
+
+  result_sha256 = None
+  if sha256 is not None or hash_result:
+    result_sha256 = hash_file_sha256(part_file)
+    if sha256 is not None and result_sha256 != sha256:
+      os.remove(part_file)
+      if os.path.exists(journal_file):
+        os.remove(journal_file)
+      raise Exception('Checksum mismatch for {}: expected sha256 {} but downloaded {}'.format(url, sha256, result_sha256))
+
+  os.replace(part_file, dst_file)
+  if os.path.exists(journal_file):
+    os.remove(journal_file)
+
+  return result_sha256
+
@@ -0,0 +1,101 @@
+# Startup time of the python entry points.
+#
+#   python -m btool startup_benchmark
+#
+# Runs each command STARTUP_RUNS times in a fresh interpreter, appends the
+# medians to build/startup-history.jsonl and prints them next to the median of
+# earlier runs, along with the slowest imports of "import btool", so import-time
+# regressions (eg a 3rd-party package imported at module level) show up.
+
+import os
+import sys
+import json
+import time
+import statistics
+import subprocess
+
+STARTUP_HISTORY = os.path.join('build', 'startup-history.jsonl')
+STARTUP_RUNS = 7
+# Earlier runs the comparison is taken over
+STARTUP_HISTORY_RUNS = 10
+SLOWEST_IMPORTS = 8
+
+STARTUP_COMMANDS = {
+  'python -c pass': ['-c', 'pass'], # interpreter baseline
+  'import btool': ['-c', 'import btool'],
+  'btool --version': ['-m', 'btool', '--version'],
+  'code_query_tool': ['-m', 'code_query_tool'],
+}
+
+def startup_history_file():
+  return os.path.abspath(os.path.join(os.environ.get('LOCI_REPO_DIR', '.'), STARTUP_HISTORY))
+
+def time_command(cmd_args):
+  durations = []
+  for run in range(STARTUP_RUNS):
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + cmd_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    durations.append(time.perf_counter() - start)
+  return round(1000 * statistics.median(durations), 1)
+
+# Returns [(cumulative ms, module)] for the slowest modules imported directly by btool
+def slowest_imports():
+  stderr = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-c', 'import btool'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True
+  ).stderr.decode('utf-8', errors='replace')
+  children = []
+  for line in stderr.splitlines():
+    # "import time: self [us] | cumulative | imported package", nested imports are
+    # indented 2 spaces per level and listed before the module importing them
+    parts = line.split('|')
+    if len(parts) != 3 or not parts[1].strip().isdigit():
+      continue
+    module = parts[2].rstrip()
+    depth = (len(module) - len(module.lstrip()) - 1) // 2
+    if depth == 0:
+      if module.strip() == 'btool':
+        return sorted(children, reverse=True)[:SLOWEST_IMPORTS]
+      children = []
+    elif depth == 1:
+      children.append((int(parts[1]) / 1000, module.strip()))
+  return []
+
+def read_startup_history():
+  if not os.path.exists(startup_history_file()):
+    return []
+  history = []
+  with open(startup_history_file(), 'r') as fd:
+    for line in fd:
+      try:
+        history.append(json.loads(line))
+      except ValueError:
+        continue
+  return history
+
+def startup_benchmark():
+  history = read_startup_history()[-STARTUP_HISTORY_RUNS:]
+  results_ms = {}
+  print('Median of {} runs (ms), earlier median over the last {} benchmarks:'.format(STARTUP_RUNS, len(history)))
+  for name, cmd_args in STARTUP_COMMANDS.items():
+    results_ms[name] = time_command(cmd_args)
+    earlier = [h['results_ms'][name] for h in history if name in h['results_ms']]
+    if len(earlier) > 0:
+      earlier_ms = statistics.median(earlier)
+      print('  {:<18} {:>8.1f}  was {:>8.1f}  ({:+.1f}%)'.format(name, results_ms[name], earlier_ms, 100 * (results_ms[name] - earlier_ms) / earlier_ms))
+    else:
+      print('  {:<18} {:>8.1f}'.format(name, results_ms[name]))
+
+  print('')
+  print('Slowest imports under "import btool" (cumulative ms):')
+  for ms, module in slowest_imports():
+    print('  {:>8.1f}  {}'.format(ms, module))
+
+  git_hash = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False).stdout.decode('utf-8').strip()
+  os.makedirs(os.path.dirname(startup_history_file()), exist_ok=True)
+  with open(startup_history_file(), 'a') as fd:
+    fd.write(json.dumps({
+      'epoch_s': int(time.time()),
+      'git_hash': git_hash,
+      'python': sys.version.split()[0],
+      'results_ms': results_ms,
+    })+'\n')
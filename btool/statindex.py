@@ -0,0 +1,253 @@
+# Persistent index of directory summaries used by get_newest_file_mtime()
+# and directory_size() over huge trees such as app-lib/target/.
+#
+# For each directory we keep its own mtime plus the newest mtime and total size
+# of the files directly inside it. A directory whose mtime changed is re-listed.
+# Files rewritten in place do not change their directory's mtime though, so an
+# unchanged directory's summary is re-used as is only when
+#  - watch_stat_index() (the build daemon) follows it with inotify, or
+#  - it is inside a tree only btool and cargo write (TOOL_WRITTEN_DIR_NAMES):
+#    btool invalidates what it writes, and cargo and the linkers replace
+#    artifacts by creating new files rather than rewriting them.
+# Other directories (source trees) also record each file's size and mtime, so
+# an unchanged one costs one stat per file and no listing.
+#
+# btool's own writers call invalidate_stat_index(), which only queues the paths;
+# they are dropped from the index on the next lookup or flush_stat_index(), so
+# the index file is rewritten once per task instead of once per copied file.
+
+import os
+import json
+import threading
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+from btool.inotify import *
+
+STAT_INDEX_FILE = os.path.join('build', 'stat-index.json')
+
+# Top level directories (relative to the repo) and directory names whose contents only btool or cargo write
+TOOL_WRITTEN_DIR_NAMES = ['target', 'out']
+
+_index = None
+_index_mtime_ns = None
+_index_lock = threading.Lock()
+# Queued by invalidate_stat_index()
+_pending_invalidations = set()
+# InotifyWatcher started by watch_stat_index()
+_watcher = None
+
+# Anchored to the repo root because lookups may happen inside within(sub_dir, ...)
+def _index_file():
+  return os.path.abspath(os.path.join(os.environ.get('LOCI_REPO_DIR', '.'), STAT_INDEX_FILE))
+
+# Serializes read-modify-write of the index file across forked task processes.
+def _file_lock():
+  if fcntl is None:
+    return None
+  os.makedirs(os.path.dirname(_index_file()), exist_ok=True)
+  lock_fd = open(_index_file()+'.lock', 'w')
+  fcntl.flock(lock_fd, fcntl.LOCK_EX)
+  return lock_fd
+
+def _file_unlock(lock_fd):
+  if lock_fd is not None:
+    fcntl.flock(lock_fd, fcntl.LOCK_UN)
+    lock_fd.close()
+
+# Re-reads the index only when another process has written it since we last did.
+def _load_index():
+  global _index, _index_mtime_ns
+  try:
+    mtime_ns = os.stat(_index_file()).st_mtime_ns
+  except FileNotFoundError:
+    if _index is None:
+      _index = {}
+    return _index
+
+  if _index is None or mtime_ns != _index_mtime_ns:
+    try:
+      with open(_index_file(), 'r') as fd:
+        _index = json.load(fd)
+    except:
+      _index = {}
+    _index_mtime_ns = mtime_ns
+  return _index
+
+def _save_index():
+  global _index_mtime_ns
+  os.makedirs(os.path.dirname(_index_file()), exist_ok=True)
+  tmp_file = '{}.{}.tmp'.format(_index_file(), os.getpid())
+  with open(tmp_file, 'w') as fd:
+    json.dump(_index, fd)
+  os.replace(tmp_file, _index_file())
+  _index_mtime_ns = os.stat(_index_file()).st_mtime_ns
+
+def _tool_written(path):
+  rel_parts = os.path.relpath(path, os.path.abspath(os.environ.get('LOCI_REPO_DIR', '.'))).split(os.sep)
+  return rel_parts[0] != '..' and any(part in TOOL_WRITTEN_DIR_NAMES for part in rel_parts)
+
+# Directories whose unchanged mtime means an unchanged summary
+def _trusted(path):
+  if _watcher is not None and _watcher.fd >= 0 and path in _watcher.watched:
+    return True
+  return _tool_written(path)
+
+# Lists path, returning a fresh index entry. files (name -> [size, mtime]) is kept for untrusted directories.
+def _list_dir(path, st, keep_files):
+  newest_mtime_s = 0
+  total_size = 0
+  subdirs = []
+  files = {}
+  with os.scandir(path) as it:
+    for de in it:
+      try:
+        if de.is_dir(follow_symlinks=False):
+          subdirs.append(de.name)
+        else:
+          f_st = de.stat()
+          total_size += f_st.st_size
+          if f_st.st_mtime > newest_mtime_s:
+            newest_mtime_s = f_st.st_mtime
+          files[de.name] = [f_st.st_size, f_st.st_mtime]
+      except OSError:
+        continue # Broken symlinks, files removed while listing
+  entry = {
+    'mtime_ns': st.st_mtime_ns,
+    'newest_mtime_s': newest_mtime_s,
+    'size': total_size,
+    'subdirs': subdirs,
+  }
+  if keep_files:
+    entry['files'] = files
+  return entry
+
+# Re-stats the recorded files of an unchanged, untrusted directory, returning the
+# updated entry or None when a file vanished (so the directory is re-listed)
+def _restat_files(path, entry):
+  newest_mtime_s = 0
+  total_size = 0
+  files = {}
+  for name in entry['files']:
+    try:
+      f_st = os.stat(os.path.join(path, name))
+    except OSError:
+      return None
+    total_size += f_st.st_size
+    if f_st.st_mtime > newest_mtime_s:
+      newest_mtime_s = f_st.st_mtime
+    files[name] = [f_st.st_size, f_st.st_mtime]
+  return dict(entry, newest_mtime_s=newest_mtime_s, size=total_size, files=files)
+
+def _summarize(path, index, changed):
+  st = os.stat(path)
+  entry = index.get(path, None)
+  new_entry = None
+  if entry is None or entry['mtime_ns'] != st.st_mtime_ns:
+    new_entry = _list_dir(path, st, not _trusted(path))
+  elif not _trusted(path):
+    if 'files' in entry:
+      new_entry = _restat_files(path, entry)
+    if new_entry is None:
+      new_entry = _list_dir(path, st, True)
+  if new_entry is not None:
+    if new_entry != entry:
+      index[path] = new_entry
+      changed[0] = True
+    entry = new_entry
+
+  newest_mtime_s = entry['newest_mtime_s']
+  total_size = entry['size']
+  for subdir in entry['subdirs']:
+    try:
+      sub_newest_mtime_s, sub_size = _summarize(os.path.join(path, subdir), index, changed)
+    except OSError:
+      continue
+    if sub_newest_mtime_s > newest_mtime_s:
+      newest_mtime_s = sub_newest_mtime_s
+    total_size += sub_size
+
+  return newest_mtime_s, total_size
+
+# Drops queued paths (and everything under them) from index in one pass over its keys
+def _apply_pending(index):
+  if len(_pending_invalidations) < 1:
+    return False
+  # The parent holds the summary of a path if it is a file
+  for path in _pending_invalidations:
+    index.pop(os.path.dirname(path), None)
+  for key in list(index.keys()):
+    path = key
+    while True:
+      if path in _pending_invalidations:
+        index.pop(key)
+        break
+      parent = os.path.dirname(path)
+      if parent == path:
+        break
+      path = parent
+  _pending_invalidations.clear()
+  return True
+
+# Returns (newest file mtime, total file size) of everything under directory.
+def summarize_dir(directory):
+  directory = os.path.abspath(directory)
+  with _index_lock:
+    lock_fd = _file_lock()
+    try:
+      index = _load_index()
+      changed = [_apply_pending(index)]
+      summary = _summarize(directory, index, changed)
+      if changed[0]:
+        _save_index()
+    finally:
+      _file_unlock(lock_fd)
+  return summary
+
+# Forget everything known about paths (files or directories) so the next lookup re-lists them.
+# Cheap: the index file is only updated by the next lookup or flush_stat_index().
+def invalidate_stat_index(*paths):
+  with _index_lock:
+    _pending_invalidations.update(os.path.abspath(p) for p in paths)
+
+# Writes queued invalidations to the index file, so other processes see them
+def flush_stat_index():
+  with _index_lock:
+    if len(_pending_invalidations) < 1:
+      return
+    lock_fd = _file_lock()
+    try:
+      _apply_pending(_load_index())
+      _save_index()
+    finally:
+      _file_unlock(lock_fd)
+
+# Starts a daemon thread invalidating index entries as inotify reports changes under directories.
+# Returns the watcher (so callers may close() it) or None if inotify is unavailable.
+def watch_stat_index(directories):
+  global _watcher
+  if not inotify_available():
+    return None
+  watcher = InotifyWatcher(directories)
+  _watcher = watcher
+
+  def watch_loop():
+    while watcher.fd >= 0:
+      try:
+        changed = watcher.read(timeout_s=1.0)
+      except OSError:
+        return
+      if changed is None:
+        # Queue overflowed, anything under the watched dirs may be stale
+        changed = list(directories)
+      if len(changed) > 0:
+        invalidate_stat_index(*changed)
+        flush_stat_index()
+
+  t = threading.Thread(target=watch_loop, daemon=True)
+  t.start()
+  return watcher
+
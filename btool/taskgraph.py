@@ -0,0 +1,173 @@
+# Dependency graph of build tasks.
+# Each task declares the keys of the tasks it depends on, and
+# TaskGraph.run() executes independent tasks concurrently
+# using up to max_workers forked child processes.
+
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+import multiprocessing.connection
+
+# Internal libs
+from btool.utils import *
+
+def deps(*items):
+  return list(items)
+
+class TaskGraph():
+  def __init__(self):
+    # key -> task dict, insertion ordered
+    self.tasks = {}
+    self.executor = None
+
+  # runner is silenced_task or noisy_task, remaining args are passed to it.
+  # task_uses (see uses() in btool.utils) lists the tools and flags the outputs depend on.
+  def add(self, key, depends_on, runner, task_name, input_files, output_files, *cmds, task_uses=uses()):
+    if key in self.tasks:
+      raise Exception('Duplicate task key: {}'.format(key))
+    for d in depends_on:
+      if not d in self.tasks:
+        raise Exception('Task {} depends on unknown task {} (dependencies must be added first)'.format(key, d))
+
+    # Dependencies' inputs, tools and flags count as our own (eg app-lib/src for crates using app-lib),
+    # so fingerprints and watch mode rebuild dependents when a dependency changes.
+    dep_inputs = [i for d in depends_on for i in self.tasks[d]['inputs'] if not i in input_files]
+    task_uses = merge_uses(task_uses, *[self.tasks[d]['uses'] for d in depends_on])
+
+    self.tasks[key] = {
+      'key': key,
+      'deps': list(depends_on),
+      'runner': runner,
+      'name': task_name,
+      'inputs': input_files + list(dict.fromkeys(dep_inputs)),
+      'outputs': output_files,
+      'uses': task_uses,
+      'cmds': list(cmds),
+    }
+
+  # Keys of tasks with an input at or under any of changed_paths, plus every task depending on them
+  def affected_by(self, changed_paths):
+    changed_paths = [os.path.abspath(p) for p in changed_paths]
+    affected = set()
+    for task in self.tasks.values():
+      for i in task['inputs']:
+        i = os.path.abspath(i)
+        if any(p == i or p.startswith(i+os.sep) for p in changed_paths):
+          affected.add(task['key'])
+          break
+    # Tasks are added after their dependencies, so one ordered pass finds all dependents
+    for task in self.tasks.values():
+      if any(d in affected for d in task['deps']):
+        affected.add(task['key'])
+    return affected
+
+  # Keys of every task key depends on, directly or not
+  def all_deps(self, key):
+    found = []
+    for d in self.tasks[key]['deps']:
+      for k in self.all_deps(d) + [d]:
+        if not k in found:
+          found.append(k)
+    return found
+
+  def run_task(self, task):
+    if self.executor is not None and self.executor.wants(task):
+      dep_outputs = [o for d in self.all_deps(task['key']) for o in self.tasks[d]['outputs']]
+      # Spread tasks over the workers by their position in the graph
+      if remote_task(self.executor, task, dep_outputs, first_worker=list(self.tasks.keys()).index(task['key'])):
+        return
+    task['runner'](task['name'], task['inputs'], task['outputs'], *task['cmds'], task_uses=task['uses'])
+
+  # only_keys limits the run to those tasks, the others count as already done.
+  # executor (eg a RemoteExecutor) may take over tasks it wants() from the runner.
+  def run(self, max_workers=1, only_keys=None, executor=None):
+    self.executor = executor
+    tasks = [t for t in self.tasks.values() if only_keys is None or t['key'] in only_keys]
+
+    # fork() is required to hand lambdas to child processes,
+    # so windows hosts always build one task at a time.
+    if max_workers <= 1 or host_is_win():
+      for task in tasks:
+        self.run_task(task)
+      return
+
+    fork_ctx = multiprocessing.get_context('fork')
+
+    pending = list(tasks)
+    running = {} # key -> (process, result_pipe)
+    done = set(k for k in self.tasks.keys() if only_keys is not None and not k in only_keys)
+    failed = []
+
+    while len(pending) > 0 or len(running) > 0:
+      # Start every task whose dependencies have completed, unless something already failed
+      if len(failed) < 1:
+        for task in list(pending):
+          if len(running) >= max_workers:
+            break
+          if all(d in done for d in task['deps']):
+            pending.remove(task)
+            parent_conn, child_conn = fork_ctx.Pipe(duplex=False)
+            proc = fork_ctx.Process(target=self._child_main, args=(task, child_conn, ))
+            proc.start()
+            child_conn.close()
+            running[task['key']] = (proc, parent_conn)
+      elif len(running) < 1:
+        break
+
+      # Wait for any running child to report back
+      ready = multiprocessing.connection.wait([conn for proc, conn in running.values()])
+      for key, (proc, conn) in list(running.items()):
+        if not conn in ready:
+          continue
+        try:
+          result = conn.recv()
+        except EOFError:
+          result = {'ok': False, 'log_file': self.console_log_file(self.tasks[key])}
+          print('{} process exited without reporting a result'.format(self.tasks[key]['name']))
+        conn.close()
+        proc.join()
+        running.pop(key)
+
+        copy_log_to(result['log_file'], sys.stdout)
+        sys.stdout.flush()
+        silent_rm(result['log_file'])
+
+        if result['ok'] and proc.exitcode == 0:
+          done.add(key)
+        else:
+          failed.append(key)
+
+    for task in pending:
+      print('{} SKIPPED (build stopped after a failed task)'.format(task['name']))
+
+    if len(failed) > 0:
+      raise Exception('Build tasks failed: {}'.format(', '.join(failed)))
+
+  # What a forked task prints goes to this log instead of the console
+  def console_log_file(self, task):
+    return task_log_file(task['name']+' (console)')
+
+  # Runs in a forked child; task output is streamed to a log file which the
+  # parent copies to the console once the task is done, so concurrent tasks
+  # do not interleave lines and the output is never held in memory.
+  def _child_main(self, task, conn):
+    trace_process_name(task['name'])
+    orig_stdout = sys.stdout
+    console_log = TaskLog(task['name']+' (console)')
+    sys.stdout = console_log
+    ok = True
+    try:
+      self.run_task(task)
+    except Exception as e:
+      # silenced_task/noisy_task have already printed details
+      print('{} FAILED ({})'.format(task['name'], e))
+      ok = False
+    sys.stdout = orig_stdout
+    console_log.close()
+    # Invalidations queued by this task, for the parent and the tasks after it
+    flush_stat_index()
+    conn.send({'ok': ok, 'log_file': console_log.log_file})
+    conn.close()
+
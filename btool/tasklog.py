@@ -0,0 +1,98 @@
+# Streaming per-task build logs.
+#
+# silenced_task() points sys.stdout/sys.stderr at a TaskLog while its commands run.
+# Output is written straight to a gzip file under build/logs/ instead of being held
+# in memory, and only the first error-looking lines plus a short tail are kept
+# for the console summary of failed tasks.
+
+import os
+import re
+import gzip
+import threading
+import collections
+
+LOG_DIR = os.path.join('build', 'logs')
+
+MAX_ERROR_LINES = 20
+MAX_TAIL_LINES = 30
+# Output without newlines (progress bars) is cut into lines of this size
+MAX_LINE_CHARS = 16 * 1024
+
+# cargo/rustc, gradle, dotnet (csc/msbuild) and python failures
+ERROR_LINE_RE = re.compile(r'^\s*(error\b|error\[|FAILURE:|BUILD FAILED|Traceback)|: error \w*\d*:?|\berror (CS|MSB|NU)\d+|Exception:')
+
+def task_log_file(task_name):
+  return os.path.abspath(os.path.join(
+    os.environ.get('LOCI_REPO_DIR', '.'), LOG_DIR, re.sub(r'[^A-Za-z0-9_.-]+', '_', task_name)+'.log.gz'
+  ))
+
+class TaskLog():
+  def __init__(self, task_name, echo_to=None):
+    self.log_file = task_log_file(task_name)
+    os.makedirs(os.path.dirname(self.log_file), exist_ok=True)
+    self.fd = gzip.open(self.log_file, 'wt', encoding='utf-8', compresslevel=6)
+    self.echo_to = echo_to
+    self.lock = threading.Lock()
+    self.partial_line = ''
+    self.error_lines = []
+    self.tail_lines = collections.deque(maxlen=MAX_TAIL_LINES)
+    self.encoding = 'utf-8'
+
+  def write(self, text):
+    with self.lock:
+      self.fd.write(text)
+      if self.echo_to is not None:
+        self.echo_to.write(text)
+
+      lines = (self.partial_line + text).split('\n')
+      self.partial_line = lines.pop()
+      if len(self.partial_line) > MAX_LINE_CHARS:
+        lines.append(self.partial_line)
+        self.partial_line = ''
+      for line in lines:
+        self._scan_line(line.rstrip('\r'))
+    return len(text)
+
+  def _scan_line(self, line):
+    self.tail_lines.append(line)
+    if len(self.error_lines) < MAX_ERROR_LINES and ERROR_LINE_RE.search(line):
+      self.error_lines.append(line)
+
+  def flush(self):
+    with self.lock:
+      self.fd.flush()
+      if self.echo_to is not None:
+        self.echo_to.flush()
+
+  def isatty(self):
+    return False
+
+  def close(self):
+    with self.lock:
+      if len(self.partial_line) > 0:
+        self._scan_line(self.partial_line)
+        self.partial_line = ''
+      self.fd.close()
+
+  # Lines printed to the console when the task failed
+  def summary(self):
+    lines = []
+    if len(self.error_lines) > 0:
+      lines.append('First error lines:')
+      lines += ['  '+l for l in self.error_lines]
+    lines.append('Last {} lines of output:'.format(len(self.tail_lines)))
+    lines += ['  '+l for l in self.tail_lines]
+    lines.append('Full log: {}'.format(self.log_file))
+    return '\n'.join(lines)
+
+# Streams a (possibly truncated, if its writer died) log file to dst_stream without loading it whole
+def copy_log_to(log_file, dst_stream):
+  try:
+    with gzip.open(log_file, 'rt', encoding='utf-8', errors='replace') as fd:
+      while True:
+        text = fd.read(MAX_LINE_CHARS)
+        if not text:
+          break
+        dst_stream.write(text)
+  except (OSError, EOFError) as e:
+    dst_stream.write('(log {} is incomplete: {})\n'.format(log_file, e))
@@ -0,0 +1,91 @@
+# Cached toolchain environment.
+#
+# download_tools() runs for every btool, tests and docs invocation, and once
+# the toolchains under build/ exist all it does is put them on the PATH - which
+# includes a pathlib rglob('bin') over the whole rustup tree. After a full run
+# the resulting PATH entries and TOOLCHAIN_ENV_VARS are written to
+# build/toolchain-env.json; later runs apply that instead of calling the
+# download_* functions.
+#
+# The manifest is keyed on the host, btool/tools.py (which pins every toolchain
+# version in its download urls) and the mtimes of the directories directly
+# inside each toolchain dir, so adding/removing a toolchain, a rustup toolchain
+# or a cargo-installed binary re-runs the setup. The toolchain dirs' own mtimes
+# are left out: cargo creates and deletes lock/journal files in CARGO_HOME on
+# every build. Delete the manifest to force the setup.
+
+import os
+import sys
+import json
+import hashlib
+import platform
+
+TOOLCHAIN_ENV_MANIFEST = os.path.join('build', 'toolchain-env.json')
+
+# Set by the download_* functions in btool.tools, in addition to PATH
+TOOLCHAIN_ENV_VARS = ['JAVA_HOME', 'ANDROID_SDK_ROOT', 'CARGO_HOME', 'RUSTUP_HOME', 'CC']
+
+TOOLCHAIN_DIRS = [
+  'linux-dotnet', 'linux-rust', 'linux-java8', 'linux-gradle', 'linux-android',
+  'win-dotnet', 'win-rust', 'win-base-devel-bins-x86_64', 'win-java8', 'win-gradle', 'win-android',
+]
+
+def toolchain_env_manifest_file():
+  return os.path.abspath(os.path.join(os.environ.get('LOCI_REPO_DIR', '.'), TOOLCHAIN_ENV_MANIFEST))
+
+# One stat per directory directly inside toolchain_dir, no recursion
+def toolchain_dir_mtimes(toolchain_dir):
+  try:
+    mtimes = {}
+    with os.scandir(toolchain_dir) as entries:
+      for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+          mtimes[entry.name] = entry.stat(follow_symlinks=False).st_mtime_ns
+    return mtimes
+  except OSError:
+    return None
+
+def toolchain_env_key():
+  with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools.py'), 'rb') as fd:
+    tools_sha256 = hashlib.sha256(fd.read()).hexdigest()
+  build_dir = os.path.join(os.environ.get('LOCI_REPO_DIR', '.'), 'build')
+  return {
+    'host': [sys.platform, platform.machine()],
+    'tools_sha256': tools_sha256,
+    'dirs': {d: toolchain_dir_mtimes(os.path.join(build_dir, d)) for d in TOOLCHAIN_DIRS},
+  }
+
+# Applies the manifest to os.environ, returns False (having changed nothing) when it is missing or stale
+def load_toolchain_env():
+  try:
+    with open(toolchain_env_manifest_file(), 'r') as fd:
+      manifest = json.load(fd)
+  except (OSError, ValueError):
+    return False
+  if manifest.get('key', None) != toolchain_env_key():
+    return False
+
+  os.environ['PATH'] = os.pathsep.join(manifest['path_prepend'] + [os.environ.get('PATH', '')] + manifest['path_append'])
+  os.environ.update(manifest['env'])
+  return True
+
+# Records what the download_* functions changed relative to env_before
+def save_toolchain_env(env_before):
+  path_before = env_before.get('PATH', '')
+  path = os.environ.get('PATH', '')
+  # The download_* functions only ever prepend and append to PATH
+  i = path.find(path_before)
+  if len(path_before) < 1 or i < 0:
+    return
+  prepend = [p for p in path[:i].split(os.pathsep) if len(p) > 0]
+  append = [p for p in path[i+len(path_before):].split(os.pathsep) if len(p) > 0]
+
+  os.makedirs(os.path.dirname(toolchain_env_manifest_file()), exist_ok=True)
+  with open(toolchain_env_manifest_file()+'.tmp', 'w') as fd:
+    json.dump({
+      'key': toolchain_env_key(),
+      'path_prepend': prepend,
+      'path_append': append,
+      'env': {k: os.environ[k] for k in TOOLCHAIN_ENV_VARS if k in os.environ and env_before.get(k, None) != os.environ[k]},
+    }, fd, indent=2)
+  os.replace(toolchain_env_manifest_file()+'.tmp', toolchain_env_manifest_file())
@@ -4,8 +4,6 @@
 import os
 import sys
 import subprocess
-import inspect
-import urllib.request
 import tarfile
 import shutil
 import time
@@ -268,6 +266,53 @@ def download_android_sdk():
     os.environ['PATH'] = os.path.abspath(j(win_android_dir, 'platform-tools'))+os.pathsep+os.environ['PATH']
     os.environ['PATH'] = os.path.abspath(j(win_android_dir, 'emulator'))+os.pathsep+os.environ['PATH']
 
+# Returns a "cargo build" command for the given target triple.
+# Concurrent cargo builds of one crate would block on the shared target/ directory lock,
+# so with the "parallel_targets" flag each triple gets its own target dir.
+# target_dir= builds somewhere of its own (pgo, variants) regardless of the target dir flags
+def cargo_build_cmd(target_triple, toolchain='stable', target_dir=None):
+  cmd = ['rustup', 'run', toolchain, 'cargo', 'build', '--release', '--target', target_triple]
+  if target_dir is not None:
+    cmd += ['--target-dir', target_dir]
+  elif flag_set('shared_cargo_target'):
+    cmd += ['--target-dir', shared_cargo_target_dir(target_triple)]
+  elif flag_set('parallel_targets'):
+    cmd += ['--target-dir', j('target', 'par', target_triple)]
+  return cmd
+
+# With the "shared_cargo_target" flag every crate builds into build/target/<triple>/,
+# so app-lib and the crates.io dependencies are compiled once per triple instead of
+# once per crate. Crates building the same triple then take turns on cargo's lock.
+def shared_cargo_target_dir(target_triple):
+  return os.path.abspath(j(os.environ.get('LOCI_REPO_DIR', '.'), 'build', 'target', target_triple))
+
+# Where cargo_build_cmd() leaves release binaries for crate_dir
+def cargo_release_dir(crate_dir, target_triple):
+  if flag_set('shared_cargo_target'):
+    return j(shared_cargo_target_dir(target_triple), target_triple, 'release')
+  if flag_set('parallel_targets'):
+    return j(crate_dir, 'target', 'par', target_triple, target_triple, 'release')
+  return j(crate_dir, 'target', target_triple, 'release')
+
+# With the "parallel_targets" flag runtimes are restored together beforehand,
+# so concurrent publishes must not each re-run the restore.
+# msbuild gets an equal share of the jobserver budget per concurrent publish.
+def dotnet_publish_cmd(runtime_id):
+  cmd = ['dotnet', 'publish', '-c', 'Release', '-r', runtime_id]
+  concurrent = 1
+  if flag_set('parallel_targets'):
+    cmd += ['--no-restore']
+    concurrent = len([t for t in enabled_targets() if t != 'android'])
+  cmd += ['-maxcpucount:{}'.format(jobserver_worker_share(concurrent))]
+  return cmd
+
+# The android gradle build runs beside the cargo and dotnet tasks, so its
+# worker pool gets 1/GRADLE_BUDGET_SHARE of the jobserver budget instead of all of it
+GRADLE_BUDGET_SHARE = 2
+
+def gradle_cmd(*tasks):
+  return ['gradle'] + list(tasks) + ['--max-workers={}'.format(jobserver_worker_share(GRADLE_BUDGET_SHARE))]
+
 def run_within_cargo_android_arm64_ndk_env(cmd):
   env_vars_changed = [
     'PATH', 'CC', 'TARGET', 'TARGET_CC',
@@ -289,7 +334,7 @@ def run_within_cargo_android_arm64_ndk_env(cmd):
   # Misc env vars
   os.environ['TARGET'] = 'aarch64-linux-android28'
   #os.environ['RUSTFLAGS'] = '--sysroot={}'.format(sysroot)
-  os.environ['TARGET_CC'] = 'aarch64-linux-android28-clang'
+  os.environ['TARGET_CC'] = compiler_cache_cc('aarch64-linux-android28-clang')
 
   # We expect cargo & co, so let's create a config file in each sub-program if it does not exist
   # to inform rustc which linkers to use:
@@ -352,6 +397,59 @@ def download_curl():
   if not shutil.which('curl'):
     die('download_curl failed to add program "curl" to PATH')
 
+# See btool/compilercache.py
+# Pin the new release's upstream sha256 with "python -m btool pin_downloads" after changing it
+SCCACHE_VERSION = 'v0.7.7'
+
+# C compilers cc-rs picks for our cross targets, wrapped when they are installed
+CROSS_C_COMPILERS = [
+  ('x86_64-unknown-linux-gnu', 'cc'),
+  ('x86_64-pc-windows-gnu', 'x86_64-w64-mingw32-gcc'),
+  ('aarch64-unknown-linux-gnu', 'aarch64-linux-gnu-gcc'),
+]
+
+def download_sccache():
+  if compiler_cache_max_mb() < 1:
+    return
+
+  # From https://github.com/mozilla/sccache/releases
+  if host_is_linux():
+    linux_sccache_dir = j('build', 'linux-sccache')
+    if not e(j(linux_sccache_dir, 'sccache')):
+      dl_archive_to(
+        'https://github.com/mozilla/sccache/releases/download/{v}/sccache-{v}-{arch}-unknown-linux-musl.tar.gz'.format(
+          v=SCCACHE_VERSION, arch='aarch64' if host_is_linux_aarch64() else 'x86_64'
+        ),
+        linux_sccache_dir
+      )
+      c('chmod', '+x', j(linux_sccache_dir, 'sccache'))
+    os.environ['PATH'] = os.path.abspath(linux_sccache_dir)+os.pathsep+os.environ['PATH']
+
+  elif host_is_win():
+    win_sccache_dir = j('build', 'win-sccache')
+    if not e(j(win_sccache_dir, 'sccache.exe')):
+      dl_archive_to(
+        'https://github.com/mozilla/sccache/releases/download/{v}/sccache-{v}-x86_64-pc-windows-msvc.tar.gz'.format(v=SCCACHE_VERSION),
+        win_sccache_dir
+      )
+    os.environ['PATH'] = os.path.abspath(win_sccache_dir)+os.pathsep+os.environ['PATH']
+
+  # Builds still work without it, only slower
+  if not shutil.which('sccache'):
+    print('WARNING: download_sccache failed to add program "sccache" to PATH, building without a compiler cache')
+    return
+
+  os.environ['SCCACHE_DIR'] = compiler_cache_dir()
+  os.environ['SCCACHE_CACHE_SIZE'] = '{}M'.format(compiler_cache_max_mb())
+  os.environ['RUSTC_WRAPPER'] = COMPILER_CACHE_WRAPPER
+
+  if 'CC' in os.environ:
+    os.environ['CC'] = compiler_cache_cc(os.environ['CC'])
+  for triple, compiler in CROSS_C_COMPILERS:
+    var = 'CC_'+triple.replace('-', '_')
+    if not var in os.environ and shutil.which(compiler):
+      os.environ[var] = compiler_cache_cc(compiler)
+
 # TODO build/download GDAL in a cross-platform way so we can write build tools to extract segments of OSM map data to ship as basemaps.
 # def download_gdal():
 #   if host_is_linux():
@@ -0,0 +1,89 @@
+# Chrome/Perfetto trace-event export for btool builds.
+#
+#   python -m btool trace=out/build-trace.json
+#
+# Spans are appended as json lines to <trace file>.events by whichever process
+# records them (forked task processes included), and write_trace() merges them
+# into a trace-event file viewable in chrome://tracing or ui.perfetto.dev.
+# Each process is a trace "process" and each thread gets its own lane.
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+TRACE_ENV_VAR = '_BTOOL_TRACE_FILE'
+
+def trace_enabled():
+  return len(os.environ.get(TRACE_ENV_VAR, '')) > 0
+
+def trace_now_us():
+  return int(time.time() * 1000000)
+
+def trace_event(event):
+  if not trace_enabled():
+    return
+  event.setdefault('pid', os.getpid())
+  event.setdefault('tid', threading.get_ident())
+  # One short O_APPEND write per event, so concurrent processes do not interleave lines
+  with open(os.environ[TRACE_ENV_VAR]+'.events', 'a') as fd:
+    fd.write(json.dumps(event)+'\n')
+
+# Complete ("X") event for work which already happened, eg a subprocess we waited on
+def trace_complete(name, cat, start_us, end_us, tid=None, **args):
+  event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': start_us, 'dur': max(0, end_us - start_us), 'args': args}
+  if tid is not None:
+    event['tid'] = tid
+  trace_event(event)
+
+def trace_instant(name, cat, **args):
+  trace_event({'name': name, 'cat': cat, 'ph': 'i', 's': 't', 'ts': trace_now_us(), 'args': args})
+
+# Labels the current process (eg with the task it runs) in the trace viewer
+def trace_process_name(name):
+  trace_event({'name': 'process_name', 'ph': 'M', 'args': {'name': name}})
+
+# with trace_span('Building app-lib', 'task', targets='win64'):
+# Extra args may be added to the yielded dict while the span is open.
+@contextlib.contextmanager
+def trace_span(name, cat, **args):
+  if not trace_enabled():
+    yield args
+    return
+  start_us = trace_now_us()
+  try:
+    yield args
+  finally:
+    trace_complete(name, cat, start_us, trace_now_us(), **args)
+
+def start_trace(trace_file):
+  os.environ[TRACE_ENV_VAR] = os.path.abspath(trace_file)
+  os.makedirs(os.path.dirname(os.environ[TRACE_ENV_VAR]), exist_ok=True)
+  if os.path.exists(os.environ[TRACE_ENV_VAR]+'.events'):
+    os.remove(os.environ[TRACE_ENV_VAR]+'.events')
+  trace_process_name('btool')
+
+def stop_trace():
+  os.environ.pop(TRACE_ENV_VAR, None)
+
+# Merges recorded events into the Chrome trace-event json file
+def write_trace():
+  if not trace_enabled():
+    return None
+  trace_file = os.environ[TRACE_ENV_VAR]
+  events = []
+  if os.path.exists(trace_file+'.events'):
+    with open(trace_file+'.events', 'r') as fd:
+      for line in fd:
+        try:
+          events.append(json.loads(line))
+        except ValueError:
+          continue # Line cut short by a killed process
+    os.remove(trace_file+'.events')
+
+  os.makedirs(os.path.dirname(trace_file), exist_ok=True)
+  with open(trace_file, 'w') as fd:
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fd)
+  return trace_file
+
@@ -2,8 +2,6 @@
 import os
 import sys
 import subprocess
-import inspect
-import urllib.request
 import tarfile
 import shutil
 import time
@@ -15,30 +13,48 @@ import tempfile
 import re
 import glob
 import platform
-import pkgutil
+import importlib
+import importlib.util
+import codecs
+import json
+import hashlib
+import zipfile, bz2, lzma, gzip
+import concurrent.futures
+
+# Internal leaf libs (stdlib-only, must never import btool.utils)
+from btool.fingerprint import *
+from btool.statindex import *
+from btool.dlcache import *
+from btool.linkcopy import *
+from btool.tasklog import *
+from btool.trace import *
+from btool.resources import *
+from btool.jobserver import *
+from btool.artifactcache import *
+from btool.remote import *
+from btool.compilercache import *
+from btool.debuginfo import *
+from btool.toolenv import *
 
 def maybe_install_w_pip(pip_package_name, import_name=None):
   if import_name is None:
     import_name = pip_package_name
-  pkg_l = pkgutil.find_loader(import_name)
-  if not pkg_l:
+  if importlib.util.find_spec(import_name.split('.')[0]) is None:
     print('WARNING: python package "{}" not found (could not import {}), attempting to install...'.format(pip_package_name, import_name))
     cmd = [sys.executable, '-m', 'pip', 'install', '--user', pip_package_name]
     print('Running: {}'.format(' '.join(cmd)))
     subprocess.run(cmd, check=False)
-
-# python3 -m pip install --user requests
-maybe_install_w_pip('requests')
-import requests, zipfile, tarfile, bz2, lzma, gzip, io
-
-# Used to extract 7zip for windows libusb
-# python3 -m pip install --user py7zr
-maybe_install_w_pip('py7zr')
-import py7zr
-
-# python3 -m pip install --user Pillow
-maybe_install_w_pip('Pillow', 'PIL')
-from PIL import Image
+    importlib.invalidate_caches()
+
+# 3rd-party packages are imported where they are used, so fast paths
+# ("btool shell", forwarding to the daemon) never load them.
+def import_or_install(import_name, pip_package_name=None):
+  try:
+    return importlib.import_module(import_name)
+  except ImportError:
+    # python3 -m pip install --user <pip_package_name>
+    maybe_install_w_pip(pip_package_name or import_name, import_name)
+    return importlib.import_module(import_name)
 
 def flag_name(name):
   return '_BUILD_FLAG_{}'.format(name)
@@ -49,37 +65,121 @@ def set_flag(name):
 def flag_set(name):
   return flag_name(name) in os.environ and len(os.environ[flag_name(name)]) > 0
 
+# Reads "name=value" style arguments, eg "python -m btool jobs=4"
+def arg_value(args, name, default=None):
+  for arg in args:
+    if arg.startswith(name+'='):
+      return arg[len(name)+1:]
+  return default
+
+
+# Bytes read from child stdout/stderr per call
+C_READ_BYTES = 64 * 1024
 
 def c(*cmd, check=True, cwd=None):
   #print('cmd= {}'.format(' '.join(list(cmd))))
+  with trace_span(' '.join(cmd)[:96], 'cmd', cmd=list(cmd), cwd=os.path.abspath(cwd or '.')) as span_args:
+    code = c_inner(list(cmd), cwd)
+    span_args['exit_code'] = code
+
+  if check:
+    if code != 0:
+      raise Exception("Process exited with code {}".format(code))
+
+# Runs cmd forwarding its output to sys.stdout/sys.stderr, returns the exit code
+def c_inner(cmd, cwd):
+  # Holds a jobserver token (or a gradle/dotnet worker limit's worth) while cmd runs
+  with job_tokens(cmd):
+    return c_inner_with_tokens(cmd, cwd)
+
+def c_inner_with_tokens(cmd, cwd):
+  start = time.time()
   c_proc = subprocess.Popen(
     list(cmd),
     cwd=cwd,
-    bufsize=0,
     stdout=subprocess.PIPE,
     stderr=subprocess.PIPE,
+    **jobserver_popen_kwargs()
   )
   
-  def fwd_stream(proc, src_stream, dst_stream):
-    buff = []
-    while proc.poll() is None:
-      buff = src_stream.read(16)
-      dst_stream.write(str(buff, 'utf-8'))
-
-  # Spawn 2 threads to forward stderr + stdout
-  t1 = threading.Thread(target=fwd_stream, args=(c_proc, c_proc.stdout, sys.stdout, ))
+  def fwd_stream(src_stream, dst_stream):
+    # Incremental decoding keeps multibyte characters split across reads intact
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while True:
+      buff = src_stream.read1(C_READ_BYTES)
+      if not buff:
+        break
+      dst_stream.write(decoder.decode(buff))
+    dst_stream.write(decoder.decode(b'', final=True))
+
+  # Spawn 2 threads to forward stderr + stdout until the child closes them
+  t1 = threading.Thread(target=fwd_stream, args=(c_proc.stdout, sys.stdout, ))
   t1.start()
-  t2 = threading.Thread(target=fwd_stream, args=(c_proc, c_proc.stderr, sys.stderr, ))
+  t2 = threading.Thread(target=fwd_stream, args=(c_proc.stderr, sys.stderr, ))
   t2.start()
 
-  # While process is executing or there is buffer to print
-  while c_proc.poll() is None:
-    time.sleep(0.2)
+  code, usage = wait_measured(c_proc)
+  t1.join()
+  t2.join()
+  record_cmd_usage(cmd, code, time.time() - start, usage)
+  return code
+
+# Runs each command (a list, or None to skip) as a concurrent subprocess when
+# the "parallel_targets" flag is set, otherwise one after another using c().
+# Every command gets its own captured output and exit code, and we only
+# raise after all of them have finished.
+def c_targets(*cmds, cwd=None):
+  cmds = [list(cmd) for cmd in cmds if cmd]
+  if not flag_set('parallel_targets') or len(cmds) < 2:
+    for cmd in cmds:
+      c(*cmd, cwd=cwd)
+    return
 
-  if check:
-    code = c_proc.poll()
+  # One thread per command waits for jobserver tokens, runs it and reaps it,
+  # so a finished command hands its tokens on before the others are collected.
+  def run_captured(cmd):
+    log_f = tempfile.TemporaryFile(mode='w+b')
+    try:
+      with job_tokens(cmd):
+        start_us = trace_now_us()
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=log_f, stderr=subprocess.STDOUT, **jobserver_popen_kwargs())
+        code, usage = wait_measured(proc)
+        end_us = trace_now_us()
+    except:
+      # eg FileNotFoundError from Popen; the collection loop reports it
+      log_f.close()
+      raise
+    # Own lane per concurrent process
+    trace_complete(' '.join(cmd)[:96], 'cmd', start_us, end_us, tid=proc.pid, cmd=cmd, exit_code=code)
+    record_cmd_usage(cmd, code, (end_us - start_us) / 1000000.0, usage)
+    return code, log_f
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=len(cmds)) as pool:
+    running = [(cmd, pool.submit(run_captured, cmd)) for cmd in cmds]
+
+  failed_cmds = []
+  for cmd, future in running:
+    try:
+      code, log_f = future.result()
+    except Exception as e:
+      print('--- {} (could not run: {}) ---'.format(' '.join(cmd), e))
+      failed_cmds.append(' '.join(cmd))
+      continue
+    log_f.seek(0)
+    print('--- {} (exit code {}) ---'.format(' '.join(cmd), code))
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while True:
+      buff = log_f.read(C_READ_BYTES)
+      if not buff:
+        break
+      sys.stdout.write(decoder.decode(buff))
+    print(decoder.decode(b'', final=True))
+    log_f.close()
     if code != 0:
-      raise Exception("Process exited with code {}".format(code))
+      failed_cmds.append(' '.join(cmd))
+
+  if len(failed_cmds) > 0:
+    raise Exception("Processes failed or exited with non-zero codes: {}".format(', '.join(failed_cmds)))
 
 def j(*parts):
   return os.path.join(*list(parts))
@@ -88,6 +188,7 @@ def e(*parts):
   return os.path.exists(j(*parts))
 
 def die(msg):
+  import inspect
   caller = inspect.getframeinfo(inspect.stack()[1][0])
   print("{}:{} {}".format(caller.filename, caller.lineno, msg))
   sys.exit(1)
@@ -111,107 +212,76 @@ def host_is_linux_aarch64():
   return host_is_linux() and ('aarch64' in uname or 'armv8' in uname)
 
 
-def dl_archive_to(url, dst_path, extension=None):
-  print('downloading {} to {}'.format(url, dst_path))
+# Size of chunks read from HTTP responses and archives; bounds memory use
+# no matter how large the downloaded archive is.
+STREAM_CHUNK_BYTES = 1024 * 1024
 
-  if extension is None:
-    if url.endswith('.zip') or url.endswith('.jar'):
-      extension = '.zip'
-    elif url.endswith('.tar.bz2'):
-      extension = '.tar.bz2'
-    elif url.endswith('.tar.xz'):
-      extension = '.tar.xz'
-    elif url.endswith('.txz'):
-      extension = '.tar.xz'
-    elif url.endswith('.7z'):
-      extension = '.7z'
-    else:
-      extension = url
-  
-  if extension.endswith('.zip'):
-    if os.path.exists(url):
-      with open(url, 'rb') as zip_content:
-        zip_mem = zipfile.ZipFile(io.BytesIO(zip_content))
-        if not os.path.exists(dst_path):
-          os.makedirs(dst_path)
-        print('extracting to {}'.format(dst_path))
-        zip_mem.extractall(dst_path)
+# zip needs random access so downloads are spooled, staying in memory only while small
+ZIP_SPOOL_MAX_BYTES = 64 * 1024 * 1024
 
-    else:
-      zip_r = requests.get(url)
-      zip_mem = zipfile.ZipFile(io.BytesIO(zip_r.content))
-      if not os.path.exists(dst_path):
-        os.makedirs(dst_path)
-      print('extracting to {}'.format(dst_path))
-      zip_mem.extractall(dst_path)
-
-  elif extension.endswith('.tar.bz2'):
-    if os.path.exists(url):
-      with open(url, 'rb') as tar_bz2_content:
-        tar_bz2_bytes = tar_bz2_content.read()
-        tar_mem = tarfile.open(
-          fileobj=io.BytesIO(bz2.decompress( tar_bz2_bytes ))
-        )
-        if not os.path.exists(dst_path):
-          os.makedirs(dst_path)
-        print('extracting to {}'.format(dst_path))
-        tar_mem.extractall(dst_path)
+def http_stream(url):
+  requests = import_or_install('requests')
+  response = requests.get(url, stream=True)
+  response.raise_for_status()
+  response.raw.decode_content = True
+  return response
 
+def extract_zip_concurrently(zip_f, dst_path):
+  members = zip_f.infolist()
+  # Create all directories first so workers never race on os.makedirs()
+  for member in members:
+    if member.is_dir():
+      os.makedirs(os.path.join(dst_path, member.filename), exist_ok=True)
     else:
-      tar_bz2_r = requests.get(url)
-      tar_mem = tarfile.open(
-        fileobj=io.BytesIO(bz2.decompress( tar_bz2_r.content ))
-      )
-      if not os.path.exists(dst_path):
-        os.makedirs(dst_path)
-      print('extracting to {}'.format(dst_path))
-      tar_mem.extractall(dst_path)
+      os.makedirs(os.path.join(dst_path, os.path.dirname(member.filename)), exist_ok=True)
+
+  # ZipFile serializes reads from the underlying file, decompression runs in parallel
+  with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as pool:
+    for f in [pool.submit(zip_f.extract, m, dst_path) for m in members if not m.is_dir()]:
+      f.result()
 
+def extract_archive_to(url, dst_path, extension):
+  tar_compression = None
+  if extension.endswith('.tar.bz2'):
+    tar_compression = 'bz2'
   elif extension.endswith('.tar.xz'):
+    tar_compression = 'xz'
+  elif extension.endswith('.tar.gz'):
+    tar_compression = 'gz'
+
+  os.makedirs(dst_path, exist_ok=True)
+
+  if extension.endswith('.zip'):
     if os.path.exists(url):
-      with open(url, 'rb') as tar_xz_content:
-        tar_xz_bytes = tar_xz_content.read()
-        tar_mem = tarfile.open(
-          fileobj=io.BytesIO(lzma.decompress( tar_xz_bytes ))
-        )
-        if not os.path.exists(dst_path):
-          os.makedirs(dst_path)
+      with zipfile.ZipFile(url) as zip_f:
         print('extracting to {}'.format(dst_path))
-        tar_mem.extractall(dst_path)
+        extract_zip_concurrently(zip_f, dst_path)
 
     else:
-      tar_xz_r = requests.get(url)
-      tar_mem = tarfile.open(
-        fileobj=io.BytesIO(lzma.decompress( tar_xz_r.content ))
-      )
-      if not os.path.exists(dst_path):
-        os.makedirs(dst_path)
-      print('extracting to {}'.format(dst_path))
-      tar_mem.extractall(dst_path)
-
-  elif extension.endswith('.tar.gz'):
+      with tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_BYTES) as spool_f:
+        with http_stream(url) as zip_r:
+          shutil.copyfileobj(zip_r.raw, spool_f, STREAM_CHUNK_BYTES)
+        spool_f.seek(0)
+        with zipfile.ZipFile(spool_f) as zip_f:
+          print('extracting to {}'.format(dst_path))
+          extract_zip_concurrently(zip_f, dst_path)
+
+  elif tar_compression is not None:
     if os.path.exists(url):
-      with open(url, 'rb') as tar_gz_content:
-        tar_gz_bytes = tar_gz_content.read()
-        tar_mem = tarfile.open(
-          fileobj=io.BytesIO(gzip.decompress( tar_gz_bytes ))
-        )
-        if not os.path.exists(dst_path):
-          os.makedirs(dst_path)
+      with tarfile.open(url, mode='r:'+tar_compression) as tar_f:
         print('extracting to {}'.format(dst_path))
-        tar_mem.extractall(dst_path)
+        tar_f.extractall(dst_path)
 
     else:
-      tar_gz_r = requests.get(url)
-      tar_mem = tarfile.open(
-        fileobj=io.BytesIO(gzip.decompress( tar_gz_r.content ))
-      )
-      if not os.path.exists(dst_path):
-        os.makedirs(dst_path)
-      print('extracting to {}'.format(dst_path))
-      tar_mem.extractall(dst_path)
+      # "r|" is tarfile's streaming mode, members are extracted as the response arrives
+      with http_stream(url) as tar_r:
+        with tarfile.open(fileobj=tar_r.raw, mode='r|'+tar_compression, bufsize=STREAM_CHUNK_BYTES) as tar_f:
+          print('extracting to {}'.format(dst_path))
+          tar_f.extractall(dst_path)
 
   elif extension.endswith('.7z'):
+    # Used to extract 7zip for windows libusb
+    py7zr = import_or_install('py7zr')
     if os.path.exists(url):
       with py7zr.SevenZipFile(url, mode='r') as archive:
         print('extracting to {}'.format(dst_path))
@@ -219,13 +289,10 @@ def dl_archive_to(url, dst_path, extension=None):
 
     else:
       tmp_f = tempfile.NamedTemporaryFile(mode='w+b', delete=False)
+      with http_stream(url) as sevenZ_r:
+        shutil.copyfileobj(sevenZ_r.raw, tmp_f, STREAM_CHUNK_BYTES)
       tmp_f.close()
 
-      sevenZ_r = requests.get(url)
-      
-      with open(tmp_f.name, 'wb') as fd:
-        fd.write(sevenZ_r.content)
-
       with py7zr.SevenZipFile(tmp_f.name, mode='r') as archive:
         print('extracting to {}'.format(dst_path))
         archive.extractall(path=dst_path)
@@ -235,21 +302,71 @@ def dl_archive_to(url, dst_path, extension=None):
   else:
     raise Exception("Unknown archive type: {}".format(url))
 
-  # We move files up until there is more than 1 item at the root (dst_path)
+# Downloads go through build/dl-cache/ (see btool/dlcache.py) unless
+# DL_CACHE_MAX_MB=0, in which case archives stream straight into extraction.
+def dl_cache_enabled():
+  return dl_cache_max_bytes() > 0
+
+def dl_archive_to(url, dst_path, extension=None, sha256=None):
+  print('downloading {} to {}'.format(url, dst_path))
+
+  if extension is None:
+    if url.endswith('.zip') or url.endswith('.jar'):
+      extension = '.zip'
+    elif url.endswith('.tar.bz2'):
+      extension = '.tar.bz2'
+    elif url.endswith('.tar.xz'):
+      extension = '.tar.xz'
+    elif url.endswith('.txz'):
+      extension = '.tar.xz'
+    elif url.endswith('.7z'):
+      extension = '.7z'
+    else:
+      extension = url
+
+  # Streaming extraction may fail part-way, so remove what we created rather
+  # than leave a partial directory which dl_archive_to_once() would trust.
+  created_dst_path = not os.path.exists(dst_path)
+  # With link_assembly the files already in dst_path may be hardlinked into other
+  # out/<target>/ trees, so extract beside it and rename the files over (see btool/linkcopy.py)
+  extract_path = dst_path
+  if not created_dst_path and assemble_mode() == 'link':
+    extract_path = dst_path.rstrip(os.sep)+'.extracting'
+    shutil.rmtree(extract_path, ignore_errors=True)
+  try:
+    # Pinned downloads are verified before extraction, so they use the cache even when it is disabled
+    if not os.path.exists(url) and (dl_cache_enabled() or sha256 is not None or url in read_download_pins()):
+      archive_file = cached_download(url, sha256=sha256)
+      with trace_span('extract '+os.path.basename(dst_path), 'extract', url=url, dst=dst_path):
+        extract_archive_to(archive_file, extract_path, extension)
+    else:
+      with trace_span('download+extract '+os.path.basename(dst_path), 'extract', url=url, dst=dst_path):
+        extract_archive_to(url, extract_path, extension)
+  except:
+    if created_dst_path:
+      shutil.rmtree(dst_path, ignore_errors=True)
+    if extract_path != dst_path:
+      shutil.rmtree(extract_path, ignore_errors=True)
+    raise
+
+  # We move files up until there is more than 1 item at the root (extract_path)
   # This avoids messy issues where we extract to "ABC/" and get
   # "ABC/ABC-1.2.3/<actual stuff we wanted under ABC>"
   remaining_loops = 5
-  while len(os.listdir(dst_path)) < 2 and remaining_loops > 0:
+  while len(os.listdir(extract_path)) < 2 and remaining_loops > 0:
     remaining_loops -= 1
-    # Move everything in dst_path/<directory>/* into dst_path
-    child_dir = os.path.join(dst_path, os.listdir(dst_path)[0])
+    # Move everything in extract_path/<directory>/* into extract_path
+    child_dir = os.path.join(extract_path, os.listdir(extract_path)[0])
     for child_f in os.listdir(child_dir):
-      shutil.move(os.path.join(child_dir, child_f), os.path.join(dst_path, child_f))
+      shutil.move(os.path.join(child_dir, child_f), os.path.join(extract_path, child_f))
     os.rmdir(child_dir)
 
-def dl_archive2d_to(url, inner_archive_name, dst_path, extension=None):
+  if extract_path != dst_path:
+    replace_tree(extract_path, dst_path)
+
+def dl_archive2d_to(url, inner_archive_name, dst_path, extension=None, sha256=None):
   t_dir = tempfile.TemporaryDirectory()
-  dl_archive_to(url, t_dir.name, extension=extension)
+  dl_archive_to(url, t_dir.name, extension=extension, sha256=sha256)
   
   # now grab t_dir+/+inner_archive_name and extract to dst_path
   inner_archive_path = os.path.join(t_dir.name, inner_archive_name)
@@ -260,11 +377,11 @@ def dl_archive2d_to(url, inner_archive_name, dst_path, extension=None):
   dl_archive_to(inner_archive_path, dst_path)
 
 
-def dl_archive_to_once(url, dst_path, extension=None, and_then_with_dir=None):
+def dl_archive_to_once(url, dst_path, extension=None, and_then_with_dir=None, sha256=None):
   if os.path.exists(dst_path):
     return
 
-  dl_archive_to(url, dst_path, extension=extension)
+  dl_archive_to(url, dst_path, extension=extension, sha256=sha256)
 
   if and_then_with_dir:
     if isinstance(and_then_with_dir, list):
@@ -313,116 +430,376 @@ def get_newest_file_mtime(directory):
     return os.path.getmtime(directory)
 
   else:
-    newest_mtime_s = 0
-    for subdir, dirs, files in os.walk(directory):
-      for file in files:
-        file = os.path.join(subdir, file)
-        file_mtime_s = os.path.getmtime(file)
-        if file_mtime_s > newest_mtime_s:
-          newest_mtime_s = file_mtime_s
+    # Only directories which changed since the last call are re-listed, see btool/statindex.py
+    newest_mtime_s, total_size = summarize_dir(directory)
     return newest_mtime_s
 
-def silenced_task(task_name, input_files, output_files, *cmds):
+# Build flags and env vars which can change what a task produces. Each task
+# declares the ones it depends on with uses(), a change to those forces it to re-run.
+FINGERPRINT_FLAGS = ['debug_build', 'parallel_targets', 'shared_cargo_target', 'split_debuginfo']
+FINGERPRINT_ENV_VARS = ['RUSTFLAGS', 'CC', 'CARGO_TARGET_DIR']
+
+# What a task's outputs depend on besides its input files: tools from
+# tool_versions() plus entries of FINGERPRINT_FLAGS and FINGERPRINT_ENV_VARS.
+# Tasks which declare nothing (downloads) are not re-run when a compiler is
+# upgraded or a flag is toggled.
+# artifacts=False keeps a task out of the artifact cache, for tasks whose
+# declared outputs are not everything a rebuild would leave behind.
+def uses(tools=(), flags=(), env=(), artifacts=True):
+  return {'tools': sorted(set(tools)), 'flags': sorted(set(flags)), 'env': sorted(set(env)), 'artifacts': artifacts}
+
+# The first uses is the task's own, its artifacts setting is not inherited from deps
+def merge_uses(*all_uses):
+  return uses(
+    tools=[t for u in all_uses for t in u['tools']],
+    flags=[f for u in all_uses for f in u['flags']],
+    env=[v for u in all_uses for v in u['env']],
+    artifacts=all_uses[0].get('artifacts', True) if len(all_uses) > 0 else True,
+  )
+
+def enabled_targets():
+  return [t for t in ['win64', 'linux_x86_64', 'linux_aarch64', 'android'] if flag_set('build_'+t)]
+
+# Versions of the tools task_uses declares
+def task_tool_versions(task_uses):
+  return {tool: version for tool, version in tool_versions().items() if tool in task_uses['tools']}
+
+# CC holds a host path, possibly behind the compiler cache wrapper, so it is
+# fingerprinted as the compiler's name and version (see compiler_identity())
+def fingerprint_env_value(var):
+  value = without_compiler_cache(os.environ.get(var, ''))
+  if var == 'CC':
+    return compiler_identity(value)
+  return value
+
+# Flags and env vars task_uses declares, fingerprinted alongside tool versions
+def fingerprint_settings(task_uses):
+  return {
+    'flags': [f for f in task_uses['flags'] if flag_set(f)],
+    'env': {v: fingerprint_env_value(v) for v in task_uses['env']},
+  }
+
+def task_fingerprint(input_files, file_hash_cache, task_uses):
+  h = hashlib.sha256()
+  h.update(hash_inputs(input_files, file_hash_cache).encode('utf-8'))
+  h.update(json.dumps(task_tool_versions(task_uses), sort_keys=True).encode('utf-8'))
+  h.update(json.dumps(fingerprint_settings(task_uses), sort_keys=True).encode('utf-8'))
+  return h.hexdigest()
+
+# Outputs of a task built before fingerprints existed, ie with no fingerprint
+# store yet, are adopted for target when all of that target's outputs exist and
+# pass the old mtime test. Returns the adopted outputs, or None.
+def legacy_target_outputs(task_name, target, input_files, output_files):
+  if os.path.exists(fingerprint_store_path(task_name)):
+    return None
+  target_outputs = outputs_for_target(output_files, target)
+  if len(target_outputs) < 1 or not all(os.path.exists(o) for o in target_outputs):
+    return None
+  if get_newest_file_mtime(target_outputs) <= get_newest_file_mtime(input_files):
+    return None
+  return target_outputs
+
+# Why target has to be rebuilt, or None when it is up to date.
+# Shared by check_task_fingerprint() and "python -m btool explain".
+def target_rebuild_reason(task_name, target, store, fingerprint, input_files, output_files):
+  # Only code tasks (those with inputs) are forced, downloads stay cached
+  if flag_set('force_code_rebuilds') and len(input_files) > 0:
+    return 'force_code_rebuilds'
+  entry = store['targets'].get(target, None)
+  if entry is None:
+    if legacy_target_outputs(task_name, target, input_files, output_files) is not None:
+      return None
+    return 'never built for {}'.format(target)
+  if entry['fingerprint'] != fingerprint:
+    return 'inputs, tools or flags changed for {}'.format(target)
+  missing = [o for o in entry['outputs'] if not os.path.exists(o)]
+  if len(missing) > 0:
+    return 'output missing: {}'.format(missing[0])
+  return None
+
+# Returns (rebuild_reason, store, fingerprint); rebuild_reason is None when
+# every enabled target was last built from identical inputs, tools and flags
+# and its recorded outputs still exist.
+def check_task_fingerprint(task_name, input_files, output_files, task_uses):
+  store = read_fingerprint_store(task_name)
+  fingerprint = task_fingerprint(input_files, store['file_hashes'], task_uses)
+  rebuild_reason = None
+
+  for target in enabled_targets():
+    rebuild_reason = target_rebuild_reason(task_name, target, store, fingerprint, input_files, output_files)
+    if rebuild_reason is not None:
+      break
+    if not target in store['targets']:
+      store['targets'][target] = {
+        'fingerprint': fingerprint,
+        'outputs': legacy_target_outputs(task_name, target, input_files, output_files),
+      }
+
+  # Always save so updated file hashes are re-used next time
+  write_fingerprint_store(task_name, store)
+
+  return rebuild_reason, store, fingerprint
+
+# Artifact cache keys for every enabled target, as target -> (key, output files).
+# Unlike the local fingerprint these use repo-relative paths, so they match across machines.
+# Tasks without inputs (downloads) are left to the download cache.
+def task_artifact_keys(task_name, input_files, output_files, task_uses, store):
+  if not artifact_cache_enabled() or len(input_files) == 0 or not task_uses.get('artifacts', True):
+    return {}
+  input_hashes = {os.path.relpath(path): entry[2] for path, entry in store['file_hashes'].items()}
+  settings = {'tools': task_tool_versions(task_uses), 'settings': fingerprint_settings(task_uses)}
+  return {
+    target: (artifact_key(task_name, input_hashes, settings, target), outputs_for_target(output_files, target))
+    for target in enabled_targets()
+  }
+
+def fetch_task_artifacts(task_name, input_files, output_files, task_uses, store):
+  keys = task_artifact_keys(task_name, input_files, output_files, task_uses, store)
+  if len(keys) == 0 or flag_set('force_code_rebuilds'):
+    return False
+  try:
+    with trace_span('fetch artifacts '+task_name, 'artifact-cache', keys=[k for k, o in keys.values()]) as span_args:
+      hit = fetch_artifacts(keys)
+      span_args['hit'] = hit
+    return hit
+  except Exception as e:
+    print('(artifact cache fetch failed: {}) '.format(e), end='', flush=True)
+    return False
+
+def publish_task_artifacts(task_name, input_files, output_files, task_uses, store):
+  keys = task_artifact_keys(task_name, input_files, output_files, task_uses, store)
+  if len(keys) == 0 or artifact_cache_readonly():
+    return
+  try:
+    with trace_span('publish artifacts '+task_name, 'artifact-cache', keys=[k for k, o in keys.values()]):
+      publish_artifacts(keys)
+  except Exception as e:
+    print('WARNING: could not publish {} to the artifact cache: {}'.format(task_name, e))
+
+# Number of past build durations kept per task and target set, see "python -m btool explain"
+MAX_TASK_DURATIONS = 10
+
+# A task builds all enabled targets in one go, so its durations are kept per
+# set of enabled targets (eg "linux_x86_64" for hostonly, or all four).
+def durations_key(targets=None):
+  return ','.join(sorted(targets if targets is not None else enabled_targets()))
+
+# Recorded durations of builds of exactly targets (default: the enabled ones)
+def recorded_durations(store, targets=None):
+  durations = store.get('durations_s', {})
+  if not isinstance(durations, dict):
+    return [] # one list for every target set, from before durations were keyed
+  return durations.get(durations_key(targets), [])
+
+# Besides the fingerprint, keeps per target what went into it so "python -m btool explain"
+# can name the input file, tool or flag which changed since that target was built.
+def record_task_fingerprint(task_name, output_files, task_uses, store, fingerprint, duration_s=None):
+  built_inputs = {path: entry[2] for path, entry in store['file_hashes'].items()}
+  for target in enabled_targets():
+    store['targets'][target] = {
+      'fingerprint': fingerprint,
+      'outputs': [o for o in outputs_for_target(output_files, target) if os.path.exists(o)],
+      'built_epoch_s': int(time.time()),
+      'built_inputs': built_inputs,
+      'built_tools': task_tool_versions(task_uses),
+      'built_settings': fingerprint_settings(task_uses),
+    }
+  for key in ['built_inputs', 'built_tools', 'built_settings']:
+    store.pop(key, None) # task-wide, from before they were kept per target
+  if duration_s is not None:
+    durations = store.get('durations_s', {})
+    if not isinstance(durations, dict):
+      durations = {}
+    durations[durations_key()] = (durations.get(durations_key(), []) + [duration_s])[-MAX_TASK_DURATIONS:]
+    store['durations_s'] = durations
+  write_fingerprint_store(task_name, store)
+
+def silenced_task(task_name, input_files, output_files, *cmds, task_uses=uses()):
   print('{} '.format(task_name), end='', flush=True)
-  # Skip task if build files newer than source files
-  if get_newest_file_mtime(output_files) > get_newest_file_mtime(input_files):
-    print('SKIPPED (output newer than input)')
+  # Skip task if inputs, tools and flags match the last successful run
+  rebuild_reason, fp_store, fingerprint = check_task_fingerprint(task_name, input_files, output_files, task_uses)
+  if rebuild_reason is None:
+    print('SKIPPED (inputs unchanged)')
+    trace_instant(task_name, 'task', targets=enabled_targets(), skip_reason='inputs unchanged')
+    record_task_usage(task_name, 0, skipped=True)
+    return
+
+  # Another machine (or an earlier checkout) may already have built these exact inputs
+  if fetch_task_artifacts(task_name, input_files, output_files, task_uses, fp_store):
+    print('UNPACKED (artifact cache)')
+    trace_instant(task_name, 'task', targets=enabled_targets(), skip_reason='artifact cache hit')
+    record_task_usage(task_name, 0, skipped=True)
+    invalidate_stat_index(*output_files)
+    record_task_fingerprint(task_name, output_files, task_uses, fp_store, fingerprint)
     return
   
+  # Output streams to build/logs/<task>.log.gz, debug builds also echo it live
   orig_stdout = sys.stdout
   orig_stderr = sys.stderr
-  new_stdout = io.StringIO()
-  new_stderr = io.StringIO()
-  sys.stdout = new_stdout
-  if not flag_set('debug_build'):
-    sys.stderr = new_stderr
+  task_log = TaskLog(task_name, echo_to=orig_stdout if flag_set('debug_build') else None)
+  sys.stdout = task_log
+  sys.stderr = task_log
 
   start = time.time()
   error = False
-  for c in cmds:
-    if c:
-      try:
-        c()
-      except Exception as e:
-        traceback.print_exc()
-        error = True
-        break
+  set_current_task(task_name)
+  with trace_span(task_name, 'task', targets=enabled_targets(), rebuild_reason=rebuild_reason) as span_args:
+    for c in cmds:
+      if c:
+        try:
+          c()
+        except Exception as e:
+          traceback.print_exc()
+          error = True
+          break
+    span_args['error'] = error
 
   end = time.time()
   duration_s = round(end - start, 2)
+  set_current_task(None)
+  record_task_usage(task_name, end - start, skipped=False, error=error)
 
   sys.stdout = orig_stdout
   sys.stderr = orig_stderr
+  task_log.close()
 
-  if flag_set('debug_build') or error:
+  if error:
     print('')
-    print(new_stdout.getvalue())
-    print(new_stderr.getvalue())
+    print(task_log.summary())
 
   print('{}s'.format(duration_s))
 
   if error:
     raise Exception('unhandled error={}'.format(error))
 
-def noisy_task(task_name, input_files, output_files, *cmds):
+  record_task_fingerprint(task_name, output_files, task_uses, fp_store, fingerprint, duration_s=duration_s)
+  publish_task_artifacts(task_name, input_files, output_files, task_uses, fp_store)
+
+# Builds task on a remote worker (see btool/remote.py) when its fingerprint says it is out of date.
+# Returns False when the task should run locally instead: up to date, or the remote build failed.
+def remote_task(executor, task, dep_outputs, first_worker=0):
+  task_name = task['name']
+  rebuild_reason, fp_store, fingerprint = check_task_fingerprint(task_name, task['inputs'], task['outputs'], task['uses'])
+  if rebuild_reason is None:
+    return False # the local runner prints SKIPPED
+
+  print('{} '.format(task_name), end='', flush=True)
+  task_log = TaskLog(task_name+' (remote)', echo_to=sys.stdout if flag_set('debug_build') else None)
+  start = time.time()
+  with trace_span(task_name, 'task', targets=enabled_targets(), rebuild_reason=rebuild_reason, remote=True) as span_args:
+    built = executor.run(task, dep_outputs, task_log, first_worker=first_worker)
+    span_args['built_remotely'] = built
+  task_log.close()
+  duration_s = round(time.time() - start, 2)
+
+  if not built:
+    print('remote build failed after {}s (log: {}), building locally'.format(duration_s, task_log.log_file))
+    return False
+
+  print('REMOTE {}s'.format(duration_s))
+  record_task_usage(task_name, duration_s, skipped=False)
+  invalidate_stat_index(*task['outputs'])
+  record_task_fingerprint(task_name, task['outputs'], task['uses'], fp_store, fingerprint, duration_s=duration_s)
+  publish_task_artifacts(task_name, task['inputs'], task['outputs'], task['uses'], fp_store)
+  return True
+
+def noisy_task(task_name, input_files, output_files, *cmds, task_uses=uses()):
   print('{} '.format(task_name), end='', flush=True)
-  # Skip task if build files newer than source files
-  if get_newest_file_mtime(output_files) > get_newest_file_mtime(input_files):
-    print('SKIPPED (output newer than input)')
+  # Skip task if inputs, tools and flags match the last successful run
+  rebuild_reason, fp_store, fingerprint = check_task_fingerprint(task_name, input_files, output_files, task_uses)
+  if rebuild_reason is None:
+    print('SKIPPED (inputs unchanged)')
+    trace_instant(task_name, 'task', targets=enabled_targets(), skip_reason='inputs unchanged')
+    record_task_usage(task_name, 0, skipped=True)
+    return
+
+  # Another machine (or an earlier checkout) may already have built these exact inputs
+  if fetch_task_artifacts(task_name, input_files, output_files, task_uses, fp_store):
+    print('UNPACKED (artifact cache)')
+    trace_instant(task_name, 'task', targets=enabled_targets(), skip_reason='artifact cache hit')
+    record_task_usage(task_name, 0, skipped=True)
+    invalidate_stat_index(*output_files)
+    record_task_fingerprint(task_name, output_files, task_uses, fp_store, fingerprint)
     return
   
   start = time.time()
   error = False
-  for c in cmds:
-    if c:
-      try:
-        c()
-      except Exception as e:
-        traceback.print_exc()
-        error = True
-        break
+  set_current_task(task_name)
+  with trace_span(task_name, 'task', targets=enabled_targets(), rebuild_reason=rebuild_reason) as span_args:
+    for c in cmds:
+      if c:
+        try:
+          c()
+        except Exception as e:
+          traceback.print_exc()
+          error = True
+          break
+    span_args['error'] = error
 
   end = time.time()
   duration_s = round(end - start, 2)
+  set_current_task(None)
+  record_task_usage(task_name, end - start, skipped=False, error=error)
 
   print('{}s'.format(duration_s))
 
   if error:
     raise Exception('unhandled error={}'.format(error))
 
-def dl_once(url, file):
+  record_task_fingerprint(task_name, output_files, task_uses, fp_store, fingerprint, duration_s=duration_s)
+  publish_task_artifacts(task_name, input_files, output_files, task_uses, fp_store)
+
+def dl_once(url, file, sha256=None):
   directory = os.path.dirname(file)
   if not os.path.exists(directory):
     os.makedirs(directory)
 
   if not os.path.exists(file) or os.path.getsize(file) < 10:
     print('Downloading {} to {}'.format(url, file))
-    urllib.request.urlretrieve(url, file)
+    if dl_cache_enabled():
+      shutil.copy(cached_download(url, sha256=sha256), file)
+    else:
+      import urllib.request
+      with trace_span('download '+os.path.basename(file), 'download', url=url):
+        urllib.request.urlretrieve(url, file)
 
 def cp(src_f, dst_f):
   if not os.path.exists(dst_f) or os.path.getmtime(src_f) > os.path.getmtime(dst_f):
     print('Copying {} to {}'.format(src_f, dst_f))
-    shutil.copy(src_f, dst_f)
+    place_file(src_f, dst_f)
+    invalidate_stat_index(dst_f)
+
+# "link_assembly" reflinks/hardlinks into out/ instead of copying, see btool/linkcopy.py
+def assemble_mode():
+  return 'link' if flag_set('link_assembly') else 'copy'
 
 # Abstraction letting us avoid re-writing different assemble_in_* functions
 # by creating the implementation given assemble_dir
 def assemble_in_curried(assemble_dir):
   
   def curried(src_file_or_dir, target_name):
-    if not os.path.exists(assemble_dir):
-      os.makedirs(assemble_dir)
+    with trace_span('assemble '+target_name, 'assemble', target=os.path.basename(assemble_dir), src=src_file_or_dir):
+      assemble_in(src_file_or_dir, target_name)
+
+  def assemble_in(src_file_or_dir, target_name):
+    # exist_ok because concurrent tasks may assemble into the same directory
+    os.makedirs(assemble_dir, exist_ok=True)
     
     if os.path.isdir(src_file_or_dir):
       target_dir = j(assemble_dir, target_name)
-      if not os.path.exists(os.path.dirname(target_dir)) and len(os.path.dirname(target_dir)) > 1:
-        os.makedirs(os.path.dirname(target_dir))
-      shutil.copytree(src_file_or_dir, target_dir, dirs_exist_ok=True)
+      if len(os.path.dirname(target_dir)) > 1:
+        os.makedirs(os.path.dirname(target_dir), exist_ok=True)
+      place_tree(src_file_or_dir, target_dir, mode=assemble_mode())
+      invalidate_stat_index(target_dir)
 
     else:
       target_file = j(assemble_dir, target_name)
-      if not os.path.exists(os.path.dirname(target_file)) and len(os.path.dirname(target_file)) > 1:
-        os.makedirs(os.path.dirname(target_file))
-      shutil.copy(src_file_or_dir, target_file)
+      if len(os.path.dirname(target_file)) > 1:
+        os.makedirs(os.path.dirname(target_file), exist_ok=True)
+      # With "split_debuginfo" release binaries ship stripped, their debug info goes to out/symbols/<build-id>/
+      if not flag_set('split_debuginfo') or flag_set('debug_build') or not place_split_debuginfo(src_file_or_dir, target_file, os.path.basename(assemble_dir)):
+        place_file(src_file_or_dir, target_file, mode=assemble_mode())
+      invalidate_stat_index(target_file)
 
   return curried
 
@@ -466,7 +843,8 @@ def directory_size(directory):
   if not os.path.isdir(directory):
     return os.path.getsize(directory)
   else:
-    return sum(directory_size(d) for d in os.scandir(directory))
+    newest_mtime_s, total_size = summarize_dir(directory)
+    return total_size
 
 
 def set_env_from_dev_env_conf(dev_env_conf_file):
@@ -496,6 +874,7 @@ def scale_image_once(src_img, dst_img, new_size_wh):
   if not e(os.path.dirname(dst_img)):
     os.makedirs(os.path.dirname(dst_img))
 
+  Image = import_or_install('PIL.Image', 'Pillow')
   im = Image.open(src_img)
   im_r = im.resize(new_size_wh, Image.ANTIALIAS)
   out_format = 'JPEG'
@@ -513,4 +892,6 @@ def simple_replace(file, match, replacement):
   with open(file, 'w') as fd:
     fd.write(contents)
 
+  invalidate_stat_index(file)
+
 
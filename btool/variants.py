@@ -0,0 +1,169 @@
+# Release-profile variant matrix.
+#
+#   python -m btool variants
+#   python -m btool variants=baseline,lto-fat,opt-s
+#
+# Builds the host target of every rust binary once per variant with the same
+# stable toolchain as the normal build (cargo_build_cmd), each variant in
+# its own build/variants/<name>/ target dir with its [profile.release] overrides
+# passed as CARGO_PROFILE_RELEASE_* env vars (Cargo.toml files are untouched).
+# Every variant is then measured the same way: build time, binary sizes,
+# time from starting server-webgui to its first answer on port 7010 (median
+# of VARIANT_START_RUNS), HTTP requests/s from concurrent keep-alive clients,
+# and the desktop-cli sql-query loop. The results are printed as a table
+# and written to out/variants-report.json.
+
+import os
+import json
+import time
+import signal
+import statistics
+import threading
+
+from btool import *
+from btool.pgo import PGO_CRATES, PGO_PORT, PGO_IO_TIMEOUT_S, PGO_HTTP_PATHS, host_rust_target, with_env, wait_for_http, cli_query_loop
+
+VARIANTS_DIR = os.path.join('build', 'variants')
+
+# name -> [profile.release] overrides
+PROFILE_VARIANTS = {
+  'baseline': {},
+  'lto-thin': {'lto': 'thin'},
+  'lto-fat': {'lto': 'fat'},
+  'cgu1': {'codegen-units': '1'},
+  'opt-s': {'opt-level': 's'},
+  'panic-abort': {'panic': 'abort'},
+  'lto-fat-cgu1-abort': {'lto': 'fat', 'codegen-units': '1', 'panic': 'abort'},
+}
+
+VARIANT_START_RUNS = 5
+VARIANT_THROUGHPUT_S = 3
+VARIANT_THROUGHPUT_CONNECTIONS = 4
+
+def variants_dir(*parts):
+  return os.path.abspath(os.path.join(os.environ.get('LOCI_REPO_DIR', '.'), VARIANTS_DIR, *parts))
+
+def profile_env(overrides):
+  return {'CARGO_PROFILE_RELEASE_'+k.upper().replace('-', '_'): v for k, v in overrides.items()}
+
+# Returns ({out name: binary}, build seconds)
+def build_variant(name, triple):
+  target_dir = variants_dir(name)
+  start = time.time()
+  for crate_dir, bin_name, out_name in PGO_CRATES:
+    with_env(profile_env(PROFILE_VARIANTS[name]), lambda: within(
+      crate_dir,
+      lambda: c(*cargo_build_cmd(triple, target_dir=target_dir)),
+    ))
+  binaries = {out_name: j(target_dir, triple, 'release', bin_name) for crate_dir, bin_name, out_name in PGO_CRATES}
+  return binaries, round(time.time() - start, 2)
+
+def start_server(server_exe, env):
+  return subprocess.Popen([server_exe], cwd=os.path.dirname(server_exe), env=env,
+    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+def stop_server(proc):
+  try:
+    os.killpg(proc.pid, signal.SIGTERM)
+    proc.wait(timeout=10)
+  except subprocess.TimeoutExpired:
+    os.killpg(proc.pid, signal.SIGKILL)
+    proc.wait()
+  except ProcessLookupError:
+    pass
+
+def http_requests_per_s():
+  import http.client
+  counts = [0] * VARIANT_THROUGHPUT_CONNECTIONS
+  deadline = time.time() + VARIANT_THROUGHPUT_S
+  def client(i):
+    conn = http.client.HTTPConnection('127.0.0.1', PGO_PORT, timeout=PGO_IO_TIMEOUT_S)
+    while time.time() < deadline:
+      conn.request('GET', PGO_HTTP_PATHS[counts[i] % len(PGO_HTTP_PATHS)])
+      conn.getresponse().read()
+      counts[i] += 1
+    conn.close()
+  threads = [threading.Thread(target=client, args=(i, )) for i in range(VARIANT_THROUGHPUT_CONNECTIONS)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return round(sum(counts) / VARIANT_THROUGHPUT_S, 1)
+
+def measure_variant(binaries):
+  env = dict(os.environ)
+  env['XDG_DATA_HOME'] = variants_dir('data')
+  os.makedirs(env['XDG_DATA_HOME'], exist_ok=True)
+
+  start_times = []
+  for run in range(VARIANT_START_RUNS):
+    start = time.perf_counter()
+    proc = start_server(binaries['server-webgui'], env)
+    try:
+      if not wait_for_http(time.time() + 30):
+        raise Exception('server-webgui did not answer on port {}'.format(PGO_PORT))
+      start_times.append(time.perf_counter() - start)
+      # Throughput once, against the last start
+      requests_per_s = http_requests_per_s() if run == VARIANT_START_RUNS - 1 else None
+    finally:
+      stop_server(proc)
+
+  return {
+    'sizes_bytes': {out_name: os.path.getsize(f) for out_name, f in binaries.items()},
+    'start_ms': round(1000 * statistics.median(start_times), 1),
+    'http_requests_per_s': requests_per_s,
+    'cli_queries_s': round(cli_query_loop(binaries['desktop-cli'], env), 3),
+  }
+
+def print_variants_table(results):
+  out_names = [out_name for crate_dir, bin_name, out_name in PGO_CRATES]
+  columns = ['variant', 'build s'] + [n+' kb' for n in out_names] + ['start ms', 'http req/s', 'cli s']
+  rows = []
+  for name, r in results.items():
+    if 'error' in r:
+      rows.append([name, 'FAILED: '+r['error']])
+      continue
+    rows.append([name, r['build_s']] + ['{:,}'.format(int(r['sizes_bytes'][n] / 1024)) for n in out_names] +
+      [r['start_ms'], r['http_requests_per_s'], r['cli_queries_s']])
+  widths = [max(len(columns[i]), 20 if i == 0 else 10) for i in range(len(columns))]
+  print('')
+  for row in [columns] + rows:
+    print('  '.join(str(v).ljust(widths[i]) if i == 0 else str(v).rjust(widths[i]) for i, v in enumerate(row)))
+
+def variants_report(args):
+  if not host_is_linux():
+    die('variants builds are only supported on linux hosts')
+
+  names = list(PROFILE_VARIANTS.keys())
+  if arg_value(args, 'variants'):
+    names = arg_value(args, 'variants').split(',')
+    for name in names:
+      if not name in PROFILE_VARIANTS:
+        die('Unknown variant {}, expected one of {}'.format(name, ', '.join(PROFILE_VARIANTS.keys())))
+
+  triple, target_name = host_rust_target()
+  results = {}
+  for name in names:
+    print('')
+    print('Variant {} ({})'.format(name, ', '.join('{}={}'.format(k, v) for k, v in PROFILE_VARIANTS[name].items()) or 'Cargo.toml profiles'), flush=True)
+    try:
+      with trace_span('variant '+name, 'build'):
+        binaries, build_s = build_variant(name, triple)
+      results[name] = {'profile': PROFILE_VARIANTS[name], 'build_s': build_s}
+      results[name].update(measure_variant(binaries))
+    except Exception as e:
+      # eg panic=abort with a dependency which needs unwinding; the other variants still run
+      results[name] = {'profile': PROFILE_VARIANTS[name], 'error': str(e)}
+
+  print_variants_table(results)
+
+  report_file = j('out', 'variants-report.json')
+  os.makedirs(os.path.dirname(report_file), exist_ok=True)
+  with open(report_file, 'w') as fd:
+    json.dump({
+      'generated_epoch_s': int(time.time()),
+      'target': triple,
+      'variants': results,
+    }, fd, indent=2)
+  print('')
+  print('Wrote {}'.format(report_file))
@@ -0,0 +1,171 @@
+# Watch mode: rebuild only the tasks whose inputs changed.
+#
+#   python -m btool hostonly watch
+#   python -m btool hostonly watch restart    # also keep out/<host>/loci running
+#
+# Every task's inputs(...) are watched with inotify (or polled where inotify
+# is unavailable). A burst of changes is collected until the tree has been quiet
+# for WATCH_DEBOUNCE_S, then the affected tasks and their dependents are rebuilt.
+# With "restart" a rebuilt kernel is restarted, and rebuilt subprograms
+# (eg server-webgui) are stopped so the running kernel respawns the new binary.
+
+import os
+import sys
+import time
+import signal
+import subprocess
+import traceback
+
+from btool import *
+from btool.buildall import buildall, build_task_graph
+
+WATCH_DEBOUNCE_S = 0.3
+# A steady stream of changes (eg a long git checkout) still builds after this long
+WATCH_MAX_DELAY_S = 3.0
+WATCH_POLL_S = 1.0
+
+def host_kernel_exe():
+  if host_is_linux():
+    return j('out', 'linux_x86_64', 'loci')
+  elif host_is_win():
+    return j('out', 'win64', 'loci.exe')
+  return None
+
+# Returns (directories watched recursively, parents of single file inputs watched alone)
+def watched_input_dirs(g):
+  trees = set()
+  file_parents = set()
+  for task in g.tasks.values():
+    for i in task['inputs']:
+      if os.path.isdir(i):
+        trees.add(os.path.abspath(i))
+      elif os.path.exists(i):
+        # Not the whole tree, app-lib/Cargo.toml must not watch app-lib/target/
+        file_parents.add(os.path.dirname(os.path.abspath(i)))
+  return sorted(trees), sorted(file_parents)
+
+# Pids of running processes whose executable is one of exe_files (linux only)
+def pids_running(exe_files):
+  exe_files = set(os.path.realpath(f) for f in exe_files)
+  pids = []
+  if not os.path.isdir('/proc'):
+    return pids
+  for entry in os.listdir('/proc'):
+    if not entry.isdigit():
+      continue
+    try:
+      if os.path.realpath(os.readlink(j('/proc', entry, 'exe'))) in exe_files:
+        pids.append(int(entry))
+    except OSError:
+      continue
+  return pids
+
+class InputPoller():
+  def __init__(self, g):
+    self.g = g
+    self.mtimes = self.snapshot()
+
+  def snapshot(self):
+    return {key: get_newest_file_mtime(task['inputs']) for key, task in self.g.tasks.items()}
+
+  # Same contract as InotifyWatcher.read(): a list of changed paths
+  def read(self, timeout_s=None):
+    time.sleep(timeout_s or WATCH_POLL_S)
+    trees, file_parents = watched_input_dirs(self.g)
+    invalidate_stat_index(*trees, *file_parents)
+    mtimes = self.snapshot()
+    changed = []
+    for key, mtime in mtimes.items():
+      if mtime != self.mtimes.get(key, None):
+        changed += self.g.tasks[key]['inputs']
+    self.mtimes = mtimes
+    return changed
+
+  def close(self):
+    pass
+
+# Blocks until something changes, then returns every path changed before the tree went quiet
+def wait_for_changes(watcher):
+  changed = []
+  while len(changed) < 1:
+    batch = watcher.read(timeout_s=WATCH_POLL_S)
+    changed += batch if batch is not None else [os.path.abspath('.')]
+  first_change = time.time()
+  while time.time() - first_change < WATCH_MAX_DELAY_S:
+    batch = watcher.read(timeout_s=WATCH_DEBOUNCE_S)
+    if batch is not None and len(batch) < 1:
+      break
+    changed += batch if batch is not None else [os.path.abspath('.')]
+  return sorted(set(changed))
+
+def watch_builds(args):
+  restart = 'restart' in args
+  g = build_task_graph(args)
+
+  if inotify_available():
+    trees, file_parents = watched_input_dirs(g)
+    watcher = InotifyWatcher(trees)
+    for d in file_parents:
+      watcher.add_dir(d)
+  else:
+    print('inotify is unavailable, polling inputs every {}s'.format(WATCH_POLL_S))
+    watcher = InputPoller(g)
+
+  kernel_proc = None
+
+  def build(only_tasks):
+    try:
+      buildall(args, only_tasks=only_tasks)
+      return True
+    except Exception as e:
+      traceback.print_exc()
+      print('Build failed, waiting for the next change')
+      return False
+
+  def start_kernel():
+    if host_kernel_exe() is None or not e(host_kernel_exe()):
+      return None
+    print('Running {}'.format(host_kernel_exe()))
+    return subprocess.Popen([ host_kernel_exe() ])
+
+  try:
+    ok = build(None)
+    if restart and ok:
+      kernel_proc = start_kernel()
+
+    print('Watching inputs of {} tasks for changes (ctrl+c to stop)'.format(len(g.tasks)), flush=True)
+    while True:
+      changed = wait_for_changes(watcher)
+      invalidate_stat_index(*changed)
+      affected = g.affected_by(changed)
+      if len(affected) < 1:
+        continue
+
+      print('')
+      print('{} changed file(s), rebuilding: {}'.format(len(changed), ', '.join(k for k in g.tasks if k in affected)))
+      build_start = time.time()
+      ok = build(affected)
+      print('Rebuilt in {}s, watching for changes'.format(round(time.time() - build_start, 2)), flush=True)
+
+      if not restart or not ok:
+        continue
+
+      if 'app-kernel-desktop' in affected or kernel_proc is None or kernel_proc.poll() is not None:
+        if kernel_proc is not None and kernel_proc.poll() is None:
+          print('Restarting {}'.format(host_kernel_exe()))
+          kernel_proc.terminate()
+          kernel_proc.wait()
+        kernel_proc = start_kernel()
+      else:
+        # The kernel restarts subprograms which exit, picking up the new binaries
+        rebuilt_files = [o for k in affected for o in g.tasks[k]['outputs'] if os.path.isfile(o)]
+        for pid in pids_running(rebuilt_files):
+          print('Stopping pid {} so the kernel respawns it'.format(pid))
+          os.kill(pid, signal.SIGTERM)
+
+  except KeyboardInterrupt:
+    print('')
+  finally:
+    watcher.close()
+    if kernel_proc is not None and kernel_proc.poll() is None:
+      kernel_proc.terminate()
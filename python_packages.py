@@ -1,8 +1,9 @@
 
-import subprocess
+import os
 import sys
-import importlib
-import traceback
+import json
+import subprocess
+import importlib.util
 
 # This holds _all_ known 3rd-party python libs we depend on
 # in btool, tests, and docs.
@@ -15,13 +16,37 @@ required_packages = [
   ('matplotlib', 'matplotlib')
 ]
 
-subprocess.run([sys.executable, '-m', 'ensurepip', '--default-pip'], check=True)
+# Records the interpreter (path + version) and package list which last passed the check,
+# so later runs skip it until one of those changes.
+CHECKED_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build', 'python-packages-checked.json')
+
+def checked_key():
+  return {
+    'executable': sys.executable,
+    'version': sys.version,
+    'packages': [list(p) for p in required_packages],
+  }
 
-for module, module_pkg_name in required_packages:
+def ensure_packages():
   try:
-    importlib.import_module(module)
-  except:
-    traceback.print_exc()
-    subprocess.run([sys.executable, '-m', 'pip', 'install', '--user', module_pkg_name], check=True)
+    with open(CHECKED_FILE, 'r') as fd:
+      if json.load(fd) == checked_key():
+        return
+  except (OSError, ValueError):
+    pass
+
+  # find_spec locates packages without paying for importing them (matplotlib takes seconds)
+  missing = [pkg_name for module, pkg_name in required_packages if importlib.util.find_spec(module) is None]
+  if len(missing) > 0:
+    if importlib.util.find_spec('pip') is None:
+      subprocess.run([sys.executable, '-m', 'ensurepip', '--default-pip'], check=True)
+    subprocess.run([sys.executable, '-m', 'pip', 'install', '--user'] + missing, check=True)
+    importlib.invalidate_caches()
+
+  os.makedirs(os.path.dirname(CHECKED_FILE), exist_ok=True)
+  with open(CHECKED_FILE, 'w') as fd:
+    json.dump(checked_key(), fd)
 
+if __name__ == '__main__':
+  ensure_packages()
 
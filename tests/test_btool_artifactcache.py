@@ -0,0 +1,147 @@
+# btool.artifactcache against a local HTTP stand-in (tests.utils.LocalHTTPServer).
+# Run with "python -m pytest tests/test_btool_artifactcache.py" or as part of "python -m tests".
+
+import io
+import os
+import tarfile
+import tempfile
+
+from btool import artifactcache
+from tests.utils import LocalHTTPServer
+
+KEY = 'ab' * 32
+
+# Runs fn inside a temporary repo dir with LOCI_ARTIFACT_CACHE set to cache_location
+def in_tmp_repo(cache_location, fn):
+  orig_cwd = os.getcwd()
+  orig_env = os.environ.get(artifactcache.ARTIFACT_CACHE_ENV_VAR, None)
+  with tempfile.TemporaryDirectory() as tmp:
+    os.chdir(tmp)
+    os.environ[artifactcache.ARTIFACT_CACHE_ENV_VAR] = cache_location
+    try:
+      fn()
+    finally:
+      os.chdir(orig_cwd)
+      if orig_env is None:
+        os.environ.pop(artifactcache.ARTIFACT_CACHE_ENV_VAR)
+      else:
+        os.environ[artifactcache.ARTIFACT_CACHE_ENV_VAR] = orig_env
+
+def write_outputs():
+  os.makedirs(os.path.join('out', 'linux_x86_64'))
+  with open(os.path.join('out', 'linux_x86_64', 'loci'), 'wb') as fd:
+    fd.write(b'\x7fELF built binary')
+  return {'linux_x86_64': (KEY, [os.path.join('out', 'linux_x86_64', 'loci')])}
+
+def test_http_put_get_round_trip():
+  with LocalHTTPServer() as server:
+    def check():
+      keys = write_outputs()
+      artifactcache.publish_artifacts(keys)
+      assert ('PUT', '/cache/'+KEY+'.tar.gz', None) in server.requests
+      assert ('PUT', '/cache/'+KEY+'.tar.gz.sha256', None) in server.requests
+
+      os.remove(os.path.join('out', 'linux_x86_64', 'loci'))
+      assert artifactcache.fetch_artifacts(keys)
+      with open(os.path.join('out', 'linux_x86_64', 'loci'), 'rb') as fd:
+        assert fd.read() == b'\x7fELF built binary'
+
+      assert not artifactcache.fetch_artifacts({'linux_x86_64': ('cd' * 32, keys['linux_x86_64'][1])})
+    in_tmp_repo(server.url+'/cache', check)
+
+def test_http_get_rejects_digest_mismatch():
+  with LocalHTTPServer() as server:
+    def check():
+      keys = write_outputs()
+      artifactcache.publish_artifacts(keys)
+      server.files['/cache/'+KEY+'.tar.gz'] = server.files['/cache/'+KEY+'.tar.gz'][:-10]
+      os.remove(os.path.join('out', 'linux_x86_64', 'loci'))
+      try:
+        artifactcache.fetch_artifacts(keys)
+        assert False, 'fetch_artifacts unpacked a truncated archive'
+      except Exception as e:
+        assert 'sha256' in str(e)
+      assert not os.path.exists(os.path.join('out', 'linux_x86_64', 'loci'))
+    in_tmp_repo(server.url+'/cache', check)
+
+def test_archive_without_digest_is_a_miss():
+  with LocalHTTPServer() as server:
+    def check():
+      keys = write_outputs()
+      artifactcache.publish_artifacts(keys)
+      server.files.pop('/cache/'+KEY+'.tar.gz.sha256')
+      assert not artifactcache.fetch_artifacts(keys)
+    in_tmp_repo(server.url+'/cache', check)
+
+def test_local_dir_round_trip():
+  with tempfile.TemporaryDirectory() as cache_dir:
+    def check():
+      keys = write_outputs()
+      artifactcache.publish_artifacts(keys)
+      assert os.path.exists(os.path.join(cache_dir, KEY[:2], KEY+'.tar.gz.sha256'))
+      os.remove(os.path.join('out', 'linux_x86_64', 'loci'))
+      assert artifactcache.fetch_artifacts(keys)
+      assert os.path.exists(os.path.join('out', 'linux_x86_64', 'loci'))
+    in_tmp_repo(cache_dir, check)
+
+def make_archive(members):
+  archive = io.BytesIO()
+  with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+    for name, linkname in members:
+      info = tarfile.TarInfo(name)
+      if linkname is None:
+        info.size = 2
+        tar.addfile(info, io.BytesIO(b'hi'))
+      else:
+        info.type = tarfile.SYMTYPE
+        info.linkname = linkname
+        tar.addfile(info)
+  with open('artifact.tar.gz', 'wb') as fd:
+    fd.write(archive.getvalue())
+  return 'artifact.tar.gz'
+
+def test_unpack_rejects_members_outside_outputs():
+  def check():
+    output_files = [os.path.join('out', 'linux_x86_64')]
+    for members in [
+      [('out/linux_x86_64/loci', None), ('src/main.rs', None)],
+      [('out/linux_x86_64/../../evil', None)],
+      [('/etc/evil', None)],
+      [('out/linux_x86_64/link', '../../../etc/passwd')],
+      [('out/linux_x86_64/link', '/etc/passwd')],
+    ]:
+      try:
+        artifactcache.unpack_outputs(make_archive(members), output_files)
+        assert False, 'unpack_outputs accepted {}'.format(members)
+      except Exception as e:
+        assert 'Artifact member' in str(e)
+      assert not os.path.exists('src') and not os.path.exists('evil')
+      assert not os.path.lexists(os.path.join('out', 'linux_x86_64', 'link'))
+
+    artifactcache.unpack_outputs(make_archive([('out/linux_x86_64/loci', None)]), output_files)
+    assert os.path.exists(os.path.join('out', 'linux_x86_64', 'loci'))
+  in_tmp_repo('', check)
+
+def test_cc_path_and_wrapper_do_not_change_settings():
+  from btool import utils
+  orig_cc = os.environ.get('CC', None)
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    for d in ['a', 'b']:
+      os.makedirs(os.path.join(tmp_dir, d))
+      cc = os.path.join(tmp_dir, d, 'x86_64-linux-gnu-gcc')
+      with open(cc, 'w') as fd:
+        fd.write('#!/bin/sh\necho "gcc 12.2.0"\n')
+      os.chmod(cc, 0o755)
+    task_uses = utils.uses(env=['CC'])
+    try:
+      os.environ['CC'] = os.path.join(tmp_dir, 'a', 'x86_64-linux-gnu-gcc')
+      settings_a = utils.fingerprint_settings(task_uses)
+      os.environ['CC'] = 'sccache '+os.path.join(tmp_dir, 'b', 'x86_64-linux-gnu-gcc')
+      settings_b = utils.fingerprint_settings(task_uses)
+    finally:
+      if orig_cc is None:
+        os.environ.pop('CC', None)
+      else:
+        os.environ['CC'] = orig_cc
+  assert settings_a == settings_b
+  assert settings_a['env']['CC'] == 'x86_64-linux-gnu-gcc (gcc 12.2.0)'
@@ -0,0 +1,120 @@
+# btool.linkcopy dedupe and the replace-by-rename writes link_assembly relies on.
+# Run with "python -m pytest tests/test_btool_linkcopy.py" or as part of "python -m tests".
+
+import os
+import tempfile
+import zipfile
+
+from btool import linkcopy
+from btool import artifactcache
+from btool import utils
+
+FILE_BYTES = 8192
+
+def write(path, content):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'wb') as fd:
+    fd.write(content)
+
+def read(path):
+  with open(path, 'rb') as fd:
+    return fd.read()
+
+def same_inode(a, b):
+  return os.stat(a).st_ino == os.stat(b).st_ino
+
+# Two out/<target>/ trees holding the same files, deduped into shared inodes
+def make_deduped_trees(root):
+  trees = [os.path.join(root, 'out', t) for t in ('linux_x86_64', 'linux_aarch64')]
+  for tree in trees:
+    # Distinct sizes, equal-sized files with different contents are hashed on every run
+    for i, name in enumerate(('a.jar', 'lib/b.jar', 'lib/c.jar')):
+      write(os.path.join(tree, name), name.encode('utf-8') * (FILE_BYTES // len(name) + i))
+  linkcopy.dedupe_trees(trees)
+  return trees
+
+# Runs fn() counting the files linkcopy hashes
+def count_hashes(fn):
+  hashed = []
+  orig_file_sha256 = linkcopy.file_sha256
+  def counting_file_sha256(path):
+    hashed.append(path)
+    return orig_file_sha256(path)
+  linkcopy.file_sha256 = counting_file_sha256
+  try:
+    result = fn()
+  finally:
+    linkcopy.file_sha256 = orig_file_sha256
+  return result, hashed
+
+def test_dedupe_hashes_one_file_per_inode():
+  with tempfile.TemporaryDirectory() as root:
+    trees = [os.path.join(root, t) for t in ('x', 'y', 'z')]
+    write(os.path.join(trees[0], 'f.bin'), b'1' * FILE_BYTES)
+    for tree in trees[1:]:
+      os.makedirs(tree)
+      os.link(os.path.join(trees[0], 'f.bin'), os.path.join(tree, 'f.bin'))
+    write(os.path.join(root, 'w', 'f.bin'), b'1' * FILE_BYTES)
+    trees.append(os.path.join(root, 'w'))
+
+    saved_bytes, hashed = count_hashes(lambda: linkcopy.dedupe_trees(trees))
+    # Three paths share one inode, so two inodes are hashed
+    assert len(hashed) == 2
+    assert saved_bytes == FILE_BYTES
+    assert all(same_inode(os.path.join(trees[0], 'f.bin'), os.path.join(t, 'f.bin')) for t in trees)
+
+def test_dedupe_of_deduped_trees_hashes_nothing():
+  with tempfile.TemporaryDirectory() as root:
+    trees = make_deduped_trees(root)
+    assert same_inode(os.path.join(trees[0], 'lib', 'b.jar'), os.path.join(trees[1], 'lib', 'b.jar'))
+    saved_bytes, hashed = count_hashes(lambda: linkcopy.dedupe_trees(trees))
+    assert saved_bytes == 0
+    assert hashed == []
+
+def test_place_file_replaces_hardlinked_file():
+  with tempfile.TemporaryDirectory() as root:
+    trees = make_deduped_trees(root)
+    src = os.path.join(root, 'new.jar')
+    write(src, b'new')
+    linkcopy.place_file(src, os.path.join(trees[0], 'a.jar'), mode='link')
+    assert read(os.path.join(trees[0], 'a.jar')) == b'new'
+    assert read(os.path.join(trees[1], 'a.jar')) != b'new'
+
+def test_extract_in_link_mode_replaces_hardlinked_files():
+  orig_flag = os.environ.get(utils.flag_name('link_assembly'), None)
+  with tempfile.TemporaryDirectory() as root:
+    trees = make_deduped_trees(root)
+    archive = os.path.join(root, 'update.zip')
+    with zipfile.ZipFile(archive, 'w') as zf:
+      zf.writestr('update/lib/b.jar', 'new b')
+      zf.writestr('update/d.jar', 'new d')
+    utils.set_flag('link_assembly')
+    try:
+      utils.dl_archive_to(archive, trees[0])
+    finally:
+      if orig_flag is None:
+        os.environ.pop(utils.flag_name('link_assembly'), None)
+    assert read(os.path.join(trees[0], 'lib', 'b.jar')) == b'new b'
+    assert read(os.path.join(trees[0], 'd.jar')) == b'new d'
+    assert read(os.path.join(trees[1], 'lib', 'b.jar')) != b'new b'
+    # Untouched files stay shared
+    assert same_inode(os.path.join(trees[0], 'lib', 'c.jar'), os.path.join(trees[1], 'lib', 'c.jar'))
+    assert not os.path.exists(trees[0]+'.extracting')
+
+def test_unpack_outputs_replaces_hardlinked_files():
+  orig_cwd = os.getcwd()
+  with tempfile.TemporaryDirectory() as root:
+    trees = make_deduped_trees(root)
+    os.chdir(root)
+    try:
+      staging = os.path.join(root, 'staging')
+      write(os.path.join(staging, 'out', 'linux_x86_64', 'a.jar'), b'new a')
+      os.chdir(staging)
+      artifactcache.pack_outputs([os.path.join('out', 'linux_x86_64', 'a.jar')], os.path.join(root, 'a.tar.gz'))
+      os.chdir(root)
+      artifactcache.unpack_outputs(os.path.join(root, 'a.tar.gz'), [os.path.join('out', 'linux_x86_64')])
+    finally:
+      os.chdir(orig_cwd)
+    assert read(os.path.join(trees[0], 'a.jar')) == b'new a'
+    assert read(os.path.join(trees[1], 'a.jar')) != b'new a'
+    assert not os.path.exists(os.path.join(trees[0], 'a.jar.unpacking'))
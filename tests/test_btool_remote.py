@@ -0,0 +1,155 @@
+# btool.remote round trip against a TCP worker on 127.0.0.1.
+# The client repo holds a stand-in btool package, which the worker runs from
+# its workspace exactly like a real snapshot's btool.
+# Run with "python -m pytest tests/test_btool_remote.py" or as part of "python -m tests".
+
+import io
+import os
+import json
+import time
+import socket
+import tempfile
+import threading
+import subprocess
+
+from btool import remote
+
+STAND_IN_BTOOL = '''
+import os
+import sys
+import time
+import subprocess
+only_tasks = [a for a in sys.argv if a.startswith('only_tasks=')][0]
+print('building', only_tasks, 'CC='+os.environ.get('CC', ''), 'RUSTFLAGS='+os.environ.get('RUSTFLAGS', ''))
+if os.path.exists(os.path.join('src', 'hang')):
+  # A long compile: a child process which only a process group kill reaches
+  child = subprocess.Popen(['sleep', '60'])
+  with open('pids.txt', 'w') as fd:
+    fd.write('{} {}'.format(os.getpid(), child.pid))
+  print('hanging', flush=True)
+  time.sleep(60)
+os.makedirs(os.path.join('out', 'linux_x86_64'), exist_ok=True)
+with open(os.path.join('src', 'input.txt'), 'r') as src, open(os.path.join('out', 'linux_x86_64', 'result.txt'), 'w') as dst:
+  dst.write(src.read().upper())
+# Every source file the worker still has, after pruning
+print('workspace-files', sorted(os.listdir('src')))
+'''
+
+TASK = {'key': 'app', 'name': 'Building app', 'inputs': ['src'], 'outputs': [os.path.join('out', 'linux_x86_64', 'result.txt')]}
+
+def write(path, text):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'w') as fd:
+    fd.write(text)
+
+def start_worker(workspace, token):
+  server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  server.bind(('127.0.0.1', 0))
+  server.listen(4)
+  threading.Thread(target=remote.serve_tcp_connections, args=(server, workspace, token), daemon=True).start()
+  return server
+
+# Runs fn(client_dir, workspace, worker address) with a client git repo and a worker holding stale state
+def with_worker(fn):
+  orig_cwd = os.getcwd()
+  with tempfile.TemporaryDirectory() as tmp:
+    client_dir = os.path.join(tmp, 'client')
+    workspace = os.path.join(tmp, 'workspace')
+    write(os.path.join(client_dir, 'btool', '__init__.py'), '')
+    write(os.path.join(client_dir, 'btool', '__main__.py'), STAND_IN_BTOOL)
+    write(os.path.join(client_dir, 'src', 'input.txt'), 'hello worker')
+    subprocess.check_call(['git', 'init', '-q', client_dir])
+    # Left over from an earlier task: a source file since deleted on the client, a file the
+    # worker's build generated, a download and worker state
+    write(os.path.join(workspace, 'src', 'removed.rs'), 'fn stale() {}')
+    write(os.path.join(workspace, 'src', 'generated.rs'), 'fn generated() {}')
+    write(os.path.join(workspace, 'app-subprograms', 'server-webgui', 'www', 'lib', 'jquery.min.js'), '$')
+    write(os.path.join(workspace, 'build', 'fingerprints', 'app.json'), '{}')
+    write(os.path.join(workspace, remote.REMOTE_MANIFEST_FILE), json.dumps([
+      os.path.join('src', 'input.txt'),
+      os.path.join('src', 'removed.rs'),
+      os.path.join('app-subprograms', 'server-webgui', 'www', 'lib', 'jquery.min.js'),
+    ]))
+
+    server = start_worker(workspace, 'secret')
+    os.chdir(client_dir)
+    try:
+      fn(client_dir, workspace, '127.0.0.1:{}'.format(server.getsockname()[1]))
+    finally:
+      # The worker thread keeps accepting until the test process exits
+      os.chdir(orig_cwd)
+
+def test_tcp_round_trip():
+  def check(client_dir, workspace, worker):
+    executor = remote.RemoteExecutor([worker], ['targets=linux_x86_64'], {'CC': '/client/only/gcc', 'RUSTFLAGS': '-Copt-level=3'}, token='secret')
+    log = io.StringIO()
+    assert executor.run(TASK, [], log)
+    with open(os.path.join(client_dir, 'out', 'linux_x86_64', 'result.txt'), 'r') as fd:
+      assert fd.read() == 'HELLO WORKER'
+    output = log.getvalue()
+    assert 'building only_tasks=app' in output
+    assert not '/client/only/gcc' in output
+    assert 'RUSTFLAGS=-Copt-level=3' in output
+    assert "workspace-files ['generated.rs', 'input.txt']" in output
+    assert not os.path.exists(os.path.join(workspace, 'src', 'removed.rs'))
+    assert os.path.exists(os.path.join(workspace, 'app-subprograms', 'server-webgui', 'www', 'lib', 'jquery.min.js'))
+    assert os.path.exists(os.path.join(workspace, 'build', 'fingerprints', 'app.json'))
+    with open(os.path.join(workspace, remote.REMOTE_MANIFEST_FILE), 'r') as fd:
+      assert os.path.join('src', 'input.txt') in json.load(fd)
+  with_worker(check)
+
+def process_alive(pid):
+  try:
+    with open('/proc/{}/stat'.format(pid), 'r') as fd:
+      state = fd.read().rpartition(')')[2].split()[0]
+  except FileNotFoundError:
+    return False
+  return not state in ('Z', 'X')
+
+# Stops the client at the first log line its task prints
+class DisconnectingLog():
+  def write(self, text):
+    if 'hanging' in text:
+      raise Exception('client went away')
+
+def test_client_disconnect_kills_task():
+  def check(client_dir, workspace, worker):
+    write(os.path.join(client_dir, 'src', 'hang'), '')
+    executor = remote.RemoteExecutor([worker], ['targets=linux_x86_64'], {}, token='secret')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      snapshot_file = os.path.join(tmp_dir, 'snapshot.tar.gz')
+      manifest = remote.make_snapshot(snapshot_file, [])
+      try:
+        executor.run_on(worker, TASK, snapshot_file, manifest, DisconnectingLog())
+        assert False, 'the task did not hang'
+      except Exception as e:
+        assert 'client went away' in str(e)
+    with open(os.path.join(workspace, 'pids.txt'), 'r') as fd:
+      pids = [int(p) for p in fd.read().split()]
+    deadline = time.time() + 10
+    while any(process_alive(p) for p in pids) and time.time() < deadline:
+      time.sleep(0.1)
+    assert not any(process_alive(p) for p in pids)
+  with_worker(check)
+
+def test_wrong_token_is_rejected():
+  def check(client_dir, workspace, worker):
+    executor = remote.RemoteExecutor([worker], ['targets=linux_x86_64'], {}, token='not-the-secret')
+    log = io.StringIO()
+    assert not executor.run(TASK, [], log)
+    assert 'rejected the LOCI_REMOTE_TOKEN token' in log.getvalue()
+    assert not os.path.exists(os.path.join(client_dir, 'out'))
+    # Nothing was unpacked or pruned
+    assert os.path.exists(os.path.join(workspace, 'src', 'removed.rs'))
+  with_worker(check)
+
+def test_tcp_worker_requires_token():
+  orig = os.environ.pop(remote.REMOTE_TOKEN_ENV_VAR, None)
+  try:
+    remote.serve_tcp_worker(0, tempfile.gettempdir())
+    assert False, 'serve_tcp_worker started without a token'
+  except Exception as e:
+    assert remote.REMOTE_TOKEN_ENV_VAR in str(e)
+  finally:
+    if orig is not None:
+      os.environ[remote.REMOTE_TOKEN_ENV_VAR] = orig
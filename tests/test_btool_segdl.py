@@ -0,0 +1,108 @@
+# btool.segdl against a local http.server (tests.utils.LocalHTTPServer).
+# Run with "python -m pytest tests/test_btool_segdl.py" or as part of "python -m tests".
+
+import os
+import json
+import hashlib
+import tempfile
+
+from btool import segdl
+from tests.utils import LocalHTTPServer
+
+DATA = os.urandom(64 * 1024)
+
+def small_segments(fn):
+  def wrapped():
+    orig = segdl.MIN_SEGMENT_BYTES
+    segdl.MIN_SEGMENT_BYTES = 16 * 1024
+    try:
+      fn()
+    finally:
+      segdl.MIN_SEGMENT_BYTES = orig
+  wrapped.__name__ = fn.__name__
+  return wrapped
+
+def leftovers(dst):
+  return [f for f in [dst+'.part', dst+'.journal'] if os.path.exists(f)]
+
+@small_segments
+def test_segmented_download():
+  with LocalHTTPServer({'/f.bin': DATA}) as server, tempfile.TemporaryDirectory() as tmp:
+    dst = os.path.join(tmp, 'f.bin')
+    result = segdl.segmented_download(server.url+'/f.bin', dst, segments=4, hash_result=True)
+    with open(dst, 'rb') as fd:
+      assert fd.read() == DATA
+    assert result == hashlib.sha256(DATA).hexdigest()
+    assert len([r for r in server.requests if r[0] == 'GET']) == 4
+    assert leftovers(dst) == []
+
+@small_segments
+def test_resume_from_journal():
+  with LocalHTTPServer({'/f.bin': DATA}) as server, tempfile.TemporaryDirectory() as tmp:
+    url = server.url+'/f.bin'
+    dst = os.path.join(tmp, 'f.bin')
+    # An interrupted earlier run: segment 0 partly done, segment 1 done, 2 and 3 not started
+    part = bytearray(len(DATA))
+    part[0:10000] = DATA[0:10000]
+    part[16384:32768] = DATA[16384:32768]
+    with open(dst+'.part', 'wb') as fd:
+      fd.write(part)
+    with open(dst+'.journal', 'w') as fd:
+      json.dump({'url': url, 'size': len(DATA), 'validator': '"v1"', 'segments': [
+        [0, 16383, 10000], [16384, 32767, 16384], [32768, 49151, 0], [49152, 65535, 0],
+      ]}, fd)
+
+    segdl.segmented_download(url, dst, segments=4)
+    with open(dst, 'rb') as fd:
+      assert fd.read() == DATA
+    ranges = sorted(r[2] for r in server.requests if r[0] == 'GET')
+    assert ranges == ['bytes=10000-16383', 'bytes=32768-49151', 'bytes=49152-65535']
+    assert leftovers(dst) == []
+
+@small_segments
+def test_stale_journal_restarts():
+  with LocalHTTPServer({'/f.bin': DATA}) as server, tempfile.TemporaryDirectory() as tmp:
+    url = server.url+'/f.bin'
+    dst = os.path.join(tmp, 'f.bin')
+    with open(dst+'.part', 'wb') as fd:
+      fd.write(b'\0' * len(DATA))
+    # Recorded against another version of the file
+    with open(dst+'.journal', 'w') as fd:
+      json.dump({'url': url, 'size': len(DATA), 'validator': '"v0"', 'segments': [[0, 65535, 65536]]}, fd)
+
+    segdl.segmented_download(url, dst, segments=4)
+    with open(dst, 'rb') as fd:
+      assert fd.read() == DATA
+
+@small_segments
+def test_single_stream_without_accept_ranges():
+  with LocalHTTPServer({'/f.bin': DATA}, ranges=False) as server, tempfile.TemporaryDirectory() as tmp:
+    dst = os.path.join(tmp, 'f.bin')
+    segdl.segmented_download(server.url+'/f.bin', dst, segments=4)
+    with open(dst, 'rb') as fd:
+      assert fd.read() == DATA
+    assert [r[2] for r in server.requests if r[0] == 'GET'] == [None]
+    assert leftovers(dst) == []
+
+@small_segments
+def test_single_stream_when_range_ignored():
+  # Advertises Accept-Ranges but answers every Range request with 200 and the whole file
+  with LocalHTTPServer({'/f.bin': DATA}, ranges=False, advertise_ranges=True) as server, tempfile.TemporaryDirectory() as tmp:
+    dst = os.path.join(tmp, 'f.bin')
+    segdl.segmented_download(server.url+'/f.bin', dst, segments=4)
+    with open(dst, 'rb') as fd:
+      assert fd.read() == DATA
+    assert [r[2] for r in server.requests if r[0] == 'GET'][-1] is None
+    assert leftovers(dst) == []
+
+@small_segments
+def test_sha256_mismatch():
+  with LocalHTTPServer({'/f.bin': DATA}) as server, tempfile.TemporaryDirectory() as tmp:
+    dst = os.path.join(tmp, 'f.bin')
+    try:
+      segdl.segmented_download(server.url+'/f.bin', dst, segments=4, sha256='0'*64)
+      assert False, 'segmented_download accepted a wrong sha256'
+    except Exception as e:
+      assert 'Checksum mismatch' in str(e)
+    assert not os.path.exists(dst)
+    assert leftovers(dst) == []
@@ -0,0 +1,91 @@
+# btool.statindex without the daemon's inotify watcher.
+# Run with "python -m pytest tests/test_btool_statindex.py" or as part of "python -m tests".
+
+import os
+import time
+import tempfile
+
+from btool import statindex
+
+# Directories x files per directory of each generated tree
+TREE_DIRS = 100
+TREE_FILES = 50
+# A no-op lookup of both trees (10k files) must take less than this
+NO_OP_LIMIT_S = 0.5
+
+def make_tree(root):
+  for d in range(TREE_DIRS):
+    dir_path = os.path.join(root, 'd{}'.format(d // 10), 'd{}'.format(d))
+    os.makedirs(dir_path, exist_ok=True)
+    for f in range(TREE_FILES):
+      with open(os.path.join(dir_path, 'f{}'.format(f)), 'w') as fd:
+        fd.write('x' * f)
+
+# Runs fn(repo_dir) with a fresh index rooted at repo_dir, counting os.scandir calls in calls
+def with_repo(fn):
+  orig_repo_dir = os.environ.get('LOCI_REPO_DIR', None)
+  orig_scandir = os.scandir
+  with tempfile.TemporaryDirectory() as repo_dir:
+    os.environ['LOCI_REPO_DIR'] = repo_dir
+    statindex._index = None
+    statindex._index_mtime_ns = None
+    calls = []
+    def counting_scandir(path):
+      calls.append(path)
+      return orig_scandir(path)
+    os.scandir = counting_scandir
+    try:
+      fn(repo_dir, calls)
+    finally:
+      os.scandir = orig_scandir
+      statindex._index = None
+      statindex._index_mtime_ns = None
+      if orig_repo_dir is None:
+        os.environ.pop('LOCI_REPO_DIR')
+      else:
+        os.environ['LOCI_REPO_DIR'] = orig_repo_dir
+
+def test_no_op_lookup_lists_nothing():
+  def check(repo_dir, calls):
+    src_dir = os.path.join(repo_dir, 'app-lib', 'src')
+    target_dir = os.path.join(repo_dir, 'app-lib', 'target')
+    make_tree(src_dir)
+    make_tree(target_dir)
+    first = (statindex.summarize_dir(src_dir), statindex.summarize_dir(target_dir))
+    assert len(calls) > 2 * TREE_DIRS
+
+    # As a new btool process would: the index comes back from build/stat-index.json
+    statindex._index = None
+    calls.clear()
+    start = time.time()
+    second = (statindex.summarize_dir(src_dir), statindex.summarize_dir(target_dir))
+    elapsed_s = time.time() - start
+    assert second == first
+    assert calls == []
+    assert elapsed_s < NO_OP_LIMIT_S, 'no-op lookup took {:.3f}s'.format(elapsed_s)
+  with_repo(check)
+
+def test_in_place_edit_of_source_file_is_seen():
+  def check(repo_dir, calls):
+    src_dir = os.path.join(repo_dir, 'app-lib', 'src')
+    make_tree(src_dir)
+    newest_s, size = statindex.summarize_dir(src_dir)
+    edited = os.path.join(src_dir, 'd0', 'd3', 'f7')
+    # Rewritten in place: d3's own mtime does not change
+    with open(edited, 'w') as fd:
+      fd.write('y' * 1000)
+    os.utime(edited, (newest_s + 10, newest_s + 10))
+    assert statindex.summarize_dir(src_dir) == (newest_s + 10, size - 7 + 1000)
+  with_repo(check)
+
+def test_new_file_in_tool_written_tree_is_seen():
+  def check(repo_dir, calls):
+    target_dir = os.path.join(repo_dir, 'app-lib', 'target')
+    make_tree(target_dir)
+    newest_s, size = statindex.summarize_dir(target_dir)
+    time.sleep(0.01)
+    with open(os.path.join(target_dir, 'd0', 'd3', 'new-artifact'), 'w') as fd:
+      fd.write('z' * 5)
+    new_newest_s, new_size = statindex.summarize_dir(target_dir)
+    assert new_size == size + 5 and new_newest_s >= newest_s
+  with_repo(check)
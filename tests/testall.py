@@ -4,9 +4,20 @@ import pathlib
 import btool
 from tests import *
 from tests.utils import *
+from tests import test_btool_segdl
+from tests import test_btool_artifactcache
+from tests import test_btool_remote
+from tests import test_btool_statindex
+from tests import test_btool_linkcopy
 
 def run_all_tests(args):
 
+  python_test_module(test_btool_segdl)
+  python_test_module(test_btool_artifactcache)
+  python_test_module(test_btool_remote)
+  python_test_module(test_btool_statindex)
+  python_test_module(test_btool_linkcopy)
+
   cargo_test_cmd = ['cargo', 'test']
   package_arg = '--package'
   if btool.utils.host_is_linux() and not 'SKIP_TARPAULIN' in os.environ:
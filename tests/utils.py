@@ -10,6 +10,9 @@ import subprocess
 import time
 import socket
 import re
+import threading
+import traceback
+import http.server
 
 # Tests __init__
 from tests import *
@@ -130,3 +133,91 @@ def ws_ctx(url, *ws_cmds):
     cmd(ws)
   ws.close()
 
+
+# Runs every test_* function of a python test module (eg tests/test_btool_segdl.py,
+# which pytest can also run), counting them like the cargo unit tests.
+def python_test_module(module):
+  print('Running python tests in {}'.format(module.__name__))
+  check_procs = not ('ALLOW_TESTS_TO_FAIL' in os.environ and len(os.environ['ALLOW_TESTS_TO_FAIL']) > 0)
+  passed = 0
+  failed = 0
+  for name in sorted(dir(module)):
+    if not name.startswith('test_') or not callable(getattr(module, name)):
+      continue
+    try:
+      getattr(module, name)()
+      passed += 1
+    except Exception as e:
+      traceback.print_exc()
+      print('{}.{} FAILED'.format(module.__name__, name))
+      failed += 1
+  for var, count in [('UNIT_TESTS_TOTAL', passed + failed), ('UNIT_TESTS_PASSED', passed), ('UNIT_TESTS_FAILED', failed)]:
+    os.environ[var] = str(int(os.environ.get(var, '0')) + count)
+  if failed > 0 and check_procs:
+    raise Exception('{} python tests failed in {}'.format(failed, module.__name__))
+
+# In-process HTTP server on 127.0.0.1 standing in for download mirrors and cache servers.
+# files maps url paths to bytes; GET/HEAD serve them (honouring single Range headers
+# when ranges=True), PUT stores the body. Every request is appended to requests as
+# (method, path, Range header or None).
+class LocalHTTPServer():
+  def __init__(self, files=None, ranges=True, advertise_ranges=None):
+    self.files = dict(files or {})
+    self.ranges = ranges
+    self.advertise_ranges = ranges if advertise_ranges is None else advertise_ranges
+    self.requests = []
+    local_server = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      def log_message(self, *args):
+        pass
+
+      def do_HEAD(self):
+        self.serve(send_body=False)
+
+      def do_GET(self):
+        self.serve(send_body=True)
+
+      def do_PUT(self):
+        local_server.requests.append(('PUT', self.path, None))
+        body = self.rfile.read(int(self.headers.get('Content-Length', '0')))
+        local_server.files[self.path] = body
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+      def serve(self, send_body):
+        range_header = self.headers.get('Range', None)
+        local_server.requests.append((self.command, self.path, range_header))
+        if not self.path in local_server.files:
+          self.send_response(404)
+          self.send_header('Content-Length', '0')
+          self.end_headers()
+          return
+        data = local_server.files[self.path]
+        status = 200
+        if range_header is not None and local_server.ranges:
+          start, end = range_header.split('=')[1].split('-')
+          start, end = int(start), min(int(end), len(data) - 1)
+          data = data[start:end+1]
+          status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', '"v1"')
+        if local_server.advertise_ranges:
+          self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if send_body:
+          self.wfile.write(data)
+
+    self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+  def __enter__(self):
+    threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+    return self
+
+  def __exit__(self, *exc):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
@@ -32,8 +32,9 @@ import webbrowser
 import re
 import threading
 
-# Ensures 3rdparty packages exist
-subprocess.run([sys.executable, '-m', 'python_packages'], check=True)
+# Ensures 3rdparty packages exist (cached per interpreter, see python_packages.py)
+import python_packages
+python_packages.ensure_packages()
 
 # 3rd-party libs which we need pip to install (above) first
 import matplotlib